@@ -0,0 +1,65 @@
+"""
+Compare JPEG encoding of a main-stream frame through PIL (Picamera2's request.save path)
+against simplejpeg (libjpeg-turbo), at the capture resolutions we use.
+
+Run from src/: python -m benchmarks.jpeg_encode [--image path] [--repeat N]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from libs.imaging import CaptureProfile, encode_jpeg, encode_jpeg_pil
+
+RESOLUTIONS = [(4608, 2592), (2304, 1296), (1536, 864)]
+
+## Build an XBGR8888 frame ([R, G, B, 255]) from an image, or from noise-textured gradients
+def make_frame(size, image_path=None):
+  width, height = size
+  if image_path:
+    rgb = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+    rgb = cv2.resize(rgb, (width, height), interpolation=cv2.INTER_AREA)
+  else:
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    noise = np.random.default_rng(0).normal(0, 12, (height, width)).astype(np.float32)
+    rgb = np.dstack([x + 0 * y, y + 0 * x, (x + y) / 2]) + noise[:, :, None]
+    rgb = np.clip(rgb, 0, 255).astype(np.uint8)
+  return np.dstack([rgb, np.full((height, width), 255, dtype=np.uint8)])
+
+## Time an encoder, returning (mean ms, encoded bytes)
+def time_encoder(encode, repeat):
+  encode() # Warm up
+  start = time.perf_counter()
+  for _ in range(repeat):
+    data = encode()
+  elapsed = (time.perf_counter() - start) / repeat
+  return elapsed * 1000, len(data.getvalue())
+
+def main():
+  parser = argparse.ArgumentParser(description="JPEG encoder benchmark")
+  parser.add_argument("--image", help="Image to encode (default: synthetic frame)")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--quality", type=int, default=85)
+  args = parser.parse_args()
+
+  print(f"{'resolution':>10} {'encoder':<22} {'ms':>8} {'KiB':>8}")
+  for size in RESOLUTIONS:
+    frame = make_frame(size, args.image)
+    encoders = {
+      "PIL": lambda: encode_jpeg_pil(frame, args.quality),
+      "simplejpeg 444": lambda: encode_jpeg(frame, args.quality, "444"),
+      "simplejpeg 420": lambda: encode_jpeg(frame, args.quality, "420"),
+    }
+
+    # The classification path: crop the centre and downscale before encoding
+    profile = CaptureProfile(resolution=(1536, 864), roi=(0.25, 0.25, 0.5, 0.5), quality=args.quality)
+    encoders["profile + simplejpeg"] = lambda: profile.encode(profile.apply(frame))
+
+    for name, encode in encoders.items():
+      ms, size_bytes = time_encoder(encode, args.repeat)
+      print(f"{size[0]}x{size[1]:<5} {name:<22} {ms:8.1f} {size_bytes / 1024:8.0f}")
+
+if __name__ == "__main__":
+  main()
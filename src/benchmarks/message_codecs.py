@@ -0,0 +1,52 @@
+"""
+Compare the WebSocket message codecs on the messages the bin actually sends: encode and
+decode time, and payload size. Codecs whose package isn't installed are skipped.
+
+Run from src/: python -m benchmarks.message_codecs [--iterations N]
+"""
+import argparse
+import time
+
+from libs.message_codecs import CODECS
+
+# One of each message the server sends, plus the distance readings we plan to stream
+MESSAGES = {
+  "processing_recycle": {"type": "processing_recycle", "data": {"receptacleMaterial": "PLASTIC"}},
+  "can_recycle": {
+    "type": "can_recycle",
+    "data": {
+      "canBeRecycled": False,
+      "identifiedMaterial": "plastic",
+      "reasonForRejection": "The bottle still has liquid in it",
+      "receptacleMaterial": "PLASTIC",
+      "itemWeight": 7,
+    },
+  },
+  "qr_codes": {"type": "qr_codes", "data": ["https://rizzcycle.example/bin/42", "USER-8f3a9c21"]},
+  "pong": {"type": "pong"},
+  "distance": {"type": "distance", "data": {"distance": 0.4271, "timestamp": 1760508000.123456}},
+}
+
+## Mean seconds per call of `function(argument)`
+def time_call(function, argument, iterations):
+  started = time.perf_counter()
+  for _ in range(iterations):
+    function(argument)
+  return (time.perf_counter() - started) / iterations
+
+def main():
+  parser = argparse.ArgumentParser(description="WebSocket message codec benchmark")
+  parser.add_argument("--iterations", type=int, default=100_000)
+  args = parser.parse_args()
+
+  print(f"{'message':>18} {'codec':>8} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+  for name, message in MESSAGES.items():
+    for codec in CODECS.values():
+      payload = codec.encode(message)
+      size = len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+      encode = time_call(codec.encode, message, args.iterations)
+      decode = time_call(codec.decode, payload, args.iterations)
+      print(f"{name:>18} {codec.name:>8} {size:6d} {encode * 1e6:10.2f} {decode * 1e6:10.2f}")
+
+if __name__ == "__main__":
+  main()
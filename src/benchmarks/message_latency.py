@@ -0,0 +1,129 @@
+"""
+Measure how long a broadcast takes to reach WebSocket clients, with the WebSocket server on
+its own loop thread (the "threaded" runtime) and on the broadcasting loop ("single" runtime).
+Clients run on a separate thread and timestamp each message as it arrives; a ping/pong
+round trip is timed as well. Stalled clients (which never read) can be added to check that
+they're evicted without holding up everyone else.
+
+Run from src/: python -m benchmarks.message_latency [--clients 1 5 20] [--stalled N] [--payload BYTES] [--messages N] [--rate HZ] [--uvloop]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+
+from websockets.asyncio.client import connect
+
+from libs.socket_server import WEBSOCKET_EVICTIONS, WebSocketServer
+
+## Connect `count` clients (and `stalled` clients that never read) on their own loop thread, recording each broadcast's latency
+def start_clients(port, count, stalled, expected, latencies, ready):
+  async def client():
+    async with connect(f"ws://127.0.0.1:{port}") as websocket:
+      ready.release()
+      received = 0
+      while received < expected:
+        message = json.loads(await websocket.recv())
+        if message.get("type") == "bench":
+          latencies.append(time.perf_counter() - message["sent"])
+          received += 1
+
+  async def stalled_client(done):
+    # Stops reading once a message is buffered, so the server's writes back up
+    async with connect(f"ws://127.0.0.1:{port}", max_queue=1) as websocket:
+      ready.release()
+      await done.wait()
+
+  async def run():
+    done = asyncio.Event()
+    stalled_clients = [asyncio.create_task(stalled_client(done)) for _ in range(stalled)]
+    await asyncio.gather(*(client() for _ in range(count)))
+    done.set()
+    await asyncio.gather(*stalled_clients, return_exceptions=True)
+
+  thread = threading.Thread(target=lambda: asyncio.run(run()), daemon=True)
+  thread.start()
+  return thread
+
+## Time `count` ping/pong round trips from a client
+async def round_trips(port, count):
+  times = []
+  async with connect(f"ws://127.0.0.1:{port}") as websocket:
+    for _ in range(count):
+      started = time.perf_counter()
+      await websocket.send(json.dumps({"type": "ping"}))
+      while json.loads(await websocket.recv()).get("type") != "pong":
+        pass
+      times.append(time.perf_counter() - started)
+  return times
+
+async def run_mode(mode, port, clients, stalled, messages, rate, payload):
+  server = WebSocketServer(host="127.0.0.1", port=port, max_send_lag=1.0)
+  if mode == "threaded":
+    await server.start_server(threaded=True)
+    while not server.running:
+      await asyncio.sleep(0.01)
+  else:
+    await server.listen()
+
+  latencies = []
+  ready = threading.Semaphore(0)
+  thread = start_clients(port, clients, stalled, messages, latencies, ready)
+  for _ in range(clients + stalled):
+    await asyncio.to_thread(ready.acquire)
+
+  # Broadcast from this loop, as the pipeline does (random padding, so compression can't shrink it)
+  padding = os.urandom(payload // 2).hex()
+  broadcasts = []
+  for _ in range(messages):
+    started = time.perf_counter()
+    await server.broadcast_message({"type": "bench", "sent": started, "data": {"canBeRecycled": True, "padding": padding}})
+    broadcasts.append(time.perf_counter() - started)
+    await asyncio.sleep(1 / rate)
+  await asyncio.to_thread(thread.join, 10)
+
+  # Requests are handled on the server's loop, whichever it is
+  pings = await round_trips(port, 200)
+
+  if server.loop is asyncio.get_running_loop():
+    await server.stop_server()
+  else:
+    asyncio.run_coroutine_threadsafe(server.stop_server(), server.loop).result(5)
+  return latencies, pings, broadcasts
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def run(args):
+  print(f"{'mode':>8} {'clients':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ping p50 ms':>12} {'broadcast us':>13} {'evicted':>8}")
+  port = args.port
+  for clients in args.clients:
+    for mode in ("threaded", "single"):
+      evictions = sum(WEBSOCKET_EVICTIONS.get(reason=reason) for reason in ("queue", "lag"))
+      latencies, pings, broadcasts = await run_mode(mode, port, clients, args.stalled, args.messages, args.rate, args.payload)
+      evicted = sum(WEBSOCKET_EVICTIONS.get(reason=reason) for reason in ("queue", "lag")) - evictions
+      port += 1
+      ms = [latency * 1000 for latency in latencies]
+      print(f"{mode:>8} {clients:>7} {statistics.median(ms):8.3f} {percentile(ms, 0.95):8.3f} {percentile(ms, 0.99):8.3f} {statistics.median(pings) * 1000:12.3f} {statistics.mean(broadcasts) * 1e6:13.1f} {evicted:8.0f}")
+
+def main():
+  parser = argparse.ArgumentParser(description="WebSocket message latency benchmark")
+  parser.add_argument("--clients", type=int, nargs="+", default=[1, 5, 20])
+  parser.add_argument("--stalled", type=int, default=0, help="Clients that connect but never read")
+  parser.add_argument("--payload", type=int, default=0, help="Bytes of padding added to each message")
+  parser.add_argument("--messages", type=int, default=500)
+  parser.add_argument("--rate", type=float, default=200, help="Broadcasts per second")
+  parser.add_argument("--port", type=int, default=8865)
+  parser.add_argument("--uvloop", action="store_true", help="Run the broadcasting loop on uvloop")
+  args = parser.parse_args()
+  if args.uvloop:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+  asyncio.run(run(args))
+
+if __name__ == "__main__":
+  main()
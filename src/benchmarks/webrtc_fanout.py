@@ -0,0 +1,93 @@
+"""
+Measure the frame rate each WebRTC viewer receives as the number of viewers grows.
+Every viewer is a local aiortc peer connection fed by its own PiCameraStream.subscribe() track,
+receiving (and decoding) the passthrough H.264 stream.
+
+Run from src/: HARDWARE_BACKEND=sim python -m benchmarks.webrtc_fanout [--viewers 1 5 20] [--seconds N]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiortc import RTCPeerConnection
+from aiortc.mediastreams import MediaStreamError
+
+from libs.camera import PiCameraStream
+from libs.packet_fanout import STREAM_DROPPED
+from libs.videoStream import force_codec
+
+## Connect a viewer to a track over a local peer connection, counting the frames it decodes
+async def connect_viewer(track, viewer):
+  sender = RTCPeerConnection()
+  receiver = RTCPeerConnection()
+  force_codec(sender, sender.addTrack(track), "video/H264")
+
+  @receiver.on("track")
+  def on_track(remote):
+    viewer["task"] = asyncio.create_task(consume(remote, viewer))
+
+  await sender.setLocalDescription(await sender.createOffer())
+  await receiver.setRemoteDescription(sender.localDescription)
+  await receiver.setLocalDescription(await receiver.createAnswer())
+  await sender.setRemoteDescription(receiver.localDescription)
+  return sender, receiver, track
+
+async def consume(remote, viewer):
+  try:
+    while True:
+      await remote.recv()
+      if viewer["first_frame"] is None:
+        viewer["first_frame"] = time.monotonic()
+      viewer["frames"] += 1
+  except MediaStreamError:
+    pass
+
+## Run `count` viewers for `seconds`, returning each viewer's fps and time to first frame
+async def run_viewers(stream, count, seconds, warmup):
+  viewers = [{"frames": 0, "first_frame": None, "task": None} for _ in range(count)]
+  connections = []
+  started = time.monotonic()
+  for viewer in viewers:
+    connections.append(await connect_viewer(stream.subscribe(), viewer))
+
+  await asyncio.sleep(warmup)
+  for viewer in viewers:
+    viewer["frames"] = 0
+  await asyncio.sleep(seconds)
+  fps = [viewer["frames"] / seconds for viewer in viewers]
+  first_frames = [viewer["first_frame"] - started for viewer in viewers if viewer["first_frame"] is not None]
+
+  for sender, receiver, track in connections:
+    await sender.close()
+    await receiver.close()
+    track.stop()
+  for viewer in viewers:
+    if viewer["task"] is not None:
+      viewer["task"].cancel()
+  return fps, first_frames
+
+async def run(args):
+  stream = PiCameraStream(size=tuple(map(int, args.size.split("x"))), bitrate=args.bitrate)
+  try:
+    print(f"{'viewers':>7} {'min fps':>8} {'mean fps':>8} {'max fps':>8} {'first frame ms':>15} {'dropped':>8}")
+    for count in args.viewers:
+      dropped = STREAM_DROPPED.get()
+      fps, first_frames = await run_viewers(stream, count, args.seconds, args.warmup)
+      first_frame = statistics.mean(first_frames) * 1000 if first_frames else float("nan")
+      print(f"{count:>7} {min(fps):8.1f} {statistics.mean(fps):8.1f} {max(fps):8.1f} {first_frame:15.0f} {STREAM_DROPPED.get() - dropped:8.0f}")
+  finally:
+    stream.stop()
+
+def main():
+  parser = argparse.ArgumentParser(description="WebRTC fan-out benchmark")
+  parser.add_argument("--viewers", type=int, nargs="+", default=[1, 5, 20])
+  parser.add_argument("--seconds", type=float, default=10)
+  parser.add_argument("--warmup", type=float, default=3)
+  parser.add_argument("--size", default="640x360", help="Streamed resolution as WIDTHxHEIGHT (viewers decode every frame)")
+  parser.add_argument("--bitrate", type=int, default=1_000_000)
+  args = parser.parse_args()
+  asyncio.run(run(args))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,45 @@
+"""
+Measure what zero-shutter-lag buffering costs: the copy of every Nth main-stream frame into
+the FrameRingBuffer, done on the camera's request-completed callback. Run it on the Pi before
+turning CAMERA_ZSL_FRAMES on - the copies compete with the encoder and the classification
+capture for memory bandwidth.
+
+Run from src/: python -m benchmarks.zsl_copy [--fps 30] [--stride 3] [--slots 3] [--repeat N]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from libs.camera import FrameRingBuffer
+
+RESOLUTIONS = [(2304, 1296), (1536, 864), (1280, 720)]
+
+## Time one frame copy into the ring, returning mean ms
+def time_copy(ring, frame, repeat):
+  ring.write(frame, time.monotonic()) # Allocates the ring
+  start = time.perf_counter()
+  for _ in range(repeat):
+    ring.write(frame, time.monotonic())
+  return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+  parser = argparse.ArgumentParser(description="Zero-shutter-lag frame copy benchmark")
+  parser.add_argument("--fps", type=float, default=30, help="Main stream frame rate")
+  parser.add_argument("--stride", type=int, default=3, help="Copy every Nth frame (PiCameraStream's zsl_stride)")
+  parser.add_argument("--slots", type=int, default=3, help="Frames kept (CAMERA_ZSL_FRAMES)")
+  parser.add_argument("--repeat", type=int, default=50)
+  args = parser.parse_args()
+
+  copies_per_second = args.fps / max(1, args.stride)
+  print(f"{copies_per_second:.1f} copies/s ({args.fps:g} fps, every {args.stride})")
+  print(f"{'resolution':>10} {'MiB/frame':>10} {'ms/copy':>8} {'MiB/s':>8} {'% of a core':>12} {'ring MiB':>9}")
+  for width, height in RESOLUTIONS:
+    frame = np.random.default_rng(0).integers(0, 255, (height, width, 4), dtype=np.uint8) # XBGR8888
+    ring = FrameRingBuffer(args.slots)
+    ms = time_copy(ring, frame, args.repeat)
+    frame_mib = frame.nbytes / 2 ** 20
+    print(f"{width}x{height:<5} {frame_mib:10.1f} {ms:8.2f} {frame_mib * copies_per_second:8.0f} {ms * copies_per_second / 10:12.1f} {frame_mib * args.slots:9.0f}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,108 @@
+from typing import List, Optional, Sequence, Tuple
+
+from libs.metrics import counter, gauge
+
+"""
+Adaptive bitrate and resolution for the H.264 stream, driven by RTCP receiver reports
+"""
+
+STREAM_RUNG = gauge("bloobin_stream_adaptation_rung", "Current rung of the bitrate/resolution ladder (0 is the lowest)")
+STREAM_LOSS = gauge("bloobin_stream_viewer_fraction_lost", "Worst fraction of packets lost reported by a viewer")
+STREAM_RTT = gauge("bloobin_stream_viewer_rtt_seconds", "Worst round-trip time reported by a viewer")
+ADAPTATIONS = counter("bloobin_stream_adaptations_total", "Changes of the stream's bitrate and resolution", labels=("direction",))
+
+## Build a ladder of (size, bitrate) rungs, lowest first, scaling the full-quality size and bitrate down
+def build_ladder(size: Tuple[int, int], bitrate: int, scales: Sequence[float] = (1 / 3, 1 / 2, 2 / 3, 1)) -> List[Tuple[Tuple[int, int], int]]:
+    ladder = []
+    for scale in sorted(scales):
+        if scale >= 1:
+            # The top rung is the configured stream, exactly, so stepping back up restores it
+            width, height = size
+        else:
+            # Keep the encoder happy with dimensions aligned to macroblock-friendly multiples
+            width = max(32, int(size[0] * scale) // 32 * 32)
+            height = max(16, int(size[1] * scale) // 16 * 16)
+        # Bitrate follows the pixel count, with a floor so small rungs still look acceptable
+        rung_bitrate = max(250_000, int(bitrate * scale * scale))
+        ladder.append(((width, height), rung_bitrate))
+    return ladder
+
+class AdaptationController:
+    """
+    Steps the stream up and down a ladder of resolutions and bitrates based on the loss
+    and round-trip time viewers report. It follows the worst viewer (every viewer shares
+    one encoder), steps down quickly when the link degrades and steps up slowly once it
+    has been clean for a while, so the stream doesn't oscillate.
+    """
+    def __init__(self, ladder, down_loss: float = 0.08, up_loss: float = 0.02, max_rtt: float = 0.4, up_after: int = 5, settle: int = 2):
+        """
+        :param ladder: (size, bitrate) rungs, lowest first; the stream starts on the top rung
+        :param down_loss: Fraction of packets lost above which the stream steps down
+        :param up_loss: Fraction of packets lost below which an interval counts as clean
+        :param max_rtt: Round-trip time (seconds) above which the stream steps down
+        :param up_after: Consecutive clean intervals before stepping up
+        :param settle: Intervals ignored after a change, while reports still describe the old rung
+        """
+        if not ladder:
+            raise ValueError("The ladder needs at least one rung")
+
+        self.ladder = list(ladder)
+        self.rung = len(self.ladder) - 1
+        self.down_loss = down_loss
+        self.up_loss = up_loss
+        self.max_rtt = max_rtt
+        self.up_after = up_after
+        self.settle = settle
+
+        self._clean = 0
+        self._settling = 0
+        STREAM_RUNG.set(self.rung)
+
+    @property
+    def current(self) -> Tuple[Tuple[int, int], int]:
+        """The (size, bitrate) of the current rung."""
+        return self.ladder[self.rung]
+
+    def update(self, reports: Sequence[Tuple[Optional[float], Optional[float]]]) -> Optional[Tuple[Tuple[int, int], int]]:
+        """
+        Feed one interval of (fraction_lost, round_trip_time) reports, one per viewer
+        (either may be None if not known yet).
+        Returns the new (size, bitrate) if the stream should change, otherwise None.
+        """
+        losses = [loss for loss, _ in reports if loss is not None]
+        rtts = [rtt for _, rtt in reports if rtt is not None]
+        if not losses and not rtts:
+            return None
+
+        loss = max(losses, default=0.0)
+        rtt = max(rtts, default=0.0)
+        STREAM_LOSS.set(loss)
+        STREAM_RTT.set(rtt)
+
+        if self._settling > 0:
+            self._settling -= 1
+            return None
+
+        if loss > self.down_loss or rtt > self.max_rtt:
+            self._clean = 0
+            return self._step(-1)
+
+        if loss < self.up_loss:
+            self._clean += 1
+            if self._clean >= self.up_after:
+                self._clean = 0
+                return self._step(1)
+        else:
+            self._clean = 0
+        return None
+
+    def _step(self, direction: int):
+        rung = min(max(self.rung + direction, 0), len(self.ladder) - 1)
+        if rung == self.rung:
+            return None
+
+        self.rung = rung
+        self._settling = self.settle
+        STREAM_RUNG.set(rung)
+        ADAPTATIONS.inc(direction="up" if direction > 0 else "down")
+        return self.current
@@ -1,16 +1,34 @@
-from picamera2 import Picamera2, Preview
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import Output
-from libcamera import controls
+from libs.hardware import SIMULATED
+if SIMULATED:
+    from libs.simulation import Picamera2, Preview, MappedArray, H264Encoder, Output, controls
+else:
+    from picamera2 import Picamera2, Preview, MappedArray
+    from picamera2.encoders import H264Encoder
+    from picamera2.outputs import Output
+    from libcamera import controls
+from contextlib import contextmanager
 from io import BytesIO
+import numpy as np
 import time
 import av
 import asyncio
 from fractions import Fraction
 from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
 import threading
-import queue
+import contextvars
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from libs.packet_fanout import PacketFanout
+from libs.dvr import SegmentRecorder
+from libs.imaging import CaptureProfile, encode_jpeg, sharpness
+from libs.tracing import span
+from libs.metrics import counter, histogram
+
+MODE_SWITCH_SECONDS = histogram("bloobin_camera_mode_switch_seconds", "Time to switch the camera between its idle and still configurations", labels=("mode",), buckets=(0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2))
+FOCUS_SECONDS = histogram("bloobin_camera_focus_seconds", "Time from an autofocus trigger to the lens settling", labels=("outcome",), buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2))
+COALESCED_REQUESTS = counter("bloobin_camera_coalesced_requests_total", "Async camera requests that joined an identical request already in flight", labels=("operation",))
+OUTPUT_ERRORS = counter("bloobin_stream_output_errors_total", "Encoded frames that failed to be published")
+TIME_TO_FIRST_FRAME = histogram("bloobin_webrtc_time_to_first_frame_seconds", "Time from a viewer's track being created to its first video packet", buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2, 5))
 
 ## Initialise the camera
 def init_camera():
@@ -59,19 +77,152 @@ def captureImage(camera):
 #     time.sleep(20)
 
 
+# Constants
+AF_STATE_SCANNING = 1 # libcamera AfStateEnum values, as reported in request metadata
+AF_STATE_FOCUSED = 2
+AF_STATE_FAILED = 3
+
+"""
+Preallocated ring buffer of recent frames for zero-shutter-lag capture
+"""
+class FrameRingBuffer:
+    """
+    Keeps copies of the last N frames of a stream in a single preallocated array.
+    Written from the camera's request-completed callback; a frame being read is
+    checked out so the writer never overwrites it mid-read.
+    """
+    def __init__(self, slots=3):
+        if slots < 2:
+            raise ValueError("FrameRingBuffer needs at least two slots")
+
+        self.slots = slots
+        self.frames = None  # Allocated on the first frame, once the stream's shape is known
+        self.timestamps = np.zeros(slots, dtype=np.float64)  # Monotonic capture times (in seconds)
+        self.metadata = [None] * slots
+        self._valid = np.zeros(slots, dtype=bool)
+        self._checked_out = {}  # Slot -> number of readers
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def write(self, frame, timestamp, metadata=None):
+        """Copy a frame into the next free slot."""
+        with self._lock:
+            if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+                # (Re)allocate on the first frame, or when the stream was reconfigured
+                self.frames = np.empty((self.slots, *frame.shape), dtype=frame.dtype)
+                self._valid[:] = False
+
+            # Skip over any slot that is being read
+            slot = self._next
+            for _ in range(self.slots):
+                if slot not in self._checked_out:
+                    break
+                slot = (slot + 1) % self.slots
+            else:
+                return  # Every slot is being read; drop this frame
+
+            self._valid[slot] = False
+            self._next = (slot + 1) % self.slots
+
+        # Copy outside the lock - the slot is invalid until the copy completes
+        np.copyto(self.frames[slot], frame)
+
+        with self._lock:
+            self.timestamps[slot] = timestamp
+            self.metadata[slot] = metadata
+            self._valid[slot] = True
+
+    def clear(self):
+        with self._lock:
+            self._valid[:] = False
+
+    def _window(self, at, max_age):
+        # Caller holds the lock: valid slots captured within max_age of `at`, oldest first
+        return sorted(
+            (slot for slot in range(self.slots) if self._valid[slot] and abs(self.timestamps[slot] - at) <= max_age),
+            key=lambda slot: self.timestamps[slot],
+        )
+
+    def _select(self, at, max_age):
+        # Prefer the in-focus frame closest to `at`, falling back to the closest frame
+        candidates = self._window(at, max_age)
+        if not candidates:
+            return None
+        focused = [slot for slot in candidates if (self.metadata[slot] or {}).get("AfState") == AF_STATE_FOCUSED]
+        return min(focused or candidates, key=lambda slot: abs(self.timestamps[slot] - at))
+
+    def _checkout(self, slots):
+        # Caller holds the lock
+        for slot in slots:
+            self._checked_out[slot] = self._checked_out.get(slot, 0) + 1
+
+    def _release(self, slots):
+        with self._lock:
+            for slot in slots:
+                self._checked_out[slot] -= 1
+                if self._checked_out[slot] == 0:
+                    del self._checked_out[slot]
+
+    @contextmanager
+    def best(self, max_age=0.5, at=None):
+        """
+        Check out the best frame within max_age seconds of `at` (a monotonic time, default now),
+        yielding (frame, timestamp, metadata) or None.
+        The frame is a view into the buffer and is only valid inside the block.
+        """
+        at = time.monotonic() if at is None else at
+        with self._lock:
+            slot = self._select(at, max_age)
+            slots = [] if slot is None else [slot]
+            self._checkout(slots)
+
+        if slot is None:
+            yield None
+            return
+
+        try:
+            yield self.frames[slot], self.timestamps[slot], self.metadata[slot]
+        finally:
+            self._release(slots)
+
+    @contextmanager
+    def recent(self, max_age=0.5, at=None):
+        """
+        Check out every frame within max_age seconds of `at` (a monotonic time, default now),
+        yielding a list of (frame, timestamp, metadata), oldest first. Frames are only valid inside the block.
+        """
+        at = time.monotonic() if at is None else at
+        with self._lock:
+            slots = self._window(at, max_age)
+            self._checkout(slots)
+
+        try:
+            yield [(self.frames[slot], self.timestamps[slot], self.metadata[slot]) for slot in slots]
+        finally:
+            self._release(slots)
+
+## Copies handed to callers that joined another caller's capture
+def _copy_image(data):
+  return BytesIO(data.getvalue())
+
+def _copy_array(frame):
+  return frame.copy()
+
 """
 Custom aiortc-compatible output for Picamera2
 """
 class QueueOutput(Output):
     """
     Picamera2 Output that receives encoded H264 frames (bytes) and
-    puts av.Packet objects onto a thread-safe queue for consumption.
+    publishes av.Packet objects to the asyncio subscribers of a PacketFanout,
+    optionally teeing the raw frames into an on-disk SegmentRecorder.
     """
-    def __init__(self, queue, loop=None):
+    def __init__(self, fanout: PacketFanout, recorder: SegmentRecorder = None):
         super().__init__()
-        self.queue = queue
-        self.loop = loop  # Keep for backward compatibility but not required
+        self.fanout = fanout
+        self.recorder = recorder
         self.frame_index = 0
+        self.errors = 0
 
     def outputframe(self, frame: bytes, keyframe=True, timestamp=None, packet=None, audio=None):
         """
@@ -79,6 +230,10 @@ class QueueOutput(Output):
         Signature must match encoder expectations: (frame, keyframe, timestamp, packet, audio).
         """
         try:
+            if self.recorder is not None:
+                # Queued for the recorder's writer thread - never blocks on disk I/O
+                self.recorder.write(frame, keyframe, time.monotonic())
+
             pkt = av.Packet(frame)
 
             # attach PTS if available
@@ -91,27 +246,79 @@ class QueueOutput(Output):
                 pkt.pts = int(pts * 90 / 1000)
 
             pkt.time_base = Fraction(1, 90000)  # WebRTC expects 90kHz timebase
-            
-            # Put packet in the thread-safe queue
-            # Use put_nowait to avoid blocking the encoder thread
-            try:
-                self.queue.put_nowait(pkt)
-                self.frame_index += 1
-            except queue.Full:
-                # Queue is full, drop the oldest frame to make room
-                try:
-                    self.queue.get_nowait()  # Remove oldest
-                    self.queue.put_nowait(pkt)  # Add new
-                    self.frame_index += 1
-                except queue.Empty:
-                    # Queue was emptied by another thread, just add the new frame
-                    self.queue.put_nowait(pkt)
-                    self.frame_index += 1
-                    
+            pkt.is_keyframe = bool(keyframe)
+
+            # Hand the packet to every subscriber's loop without blocking the encoder thread
+            # (a subscriber whose bounded queue overflows skips ahead to the next keyframe)
+            self.fanout.publish(pkt, keyframe=bool(keyframe))
+            self.frame_index += 1
+
         except Exception as e:
-            import traceback
+            # Count every failure, but only print the traceback once - this runs on the encoder thread for every frame
+            self.errors += 1
+            OUTPUT_ERRORS.inc()
             print(f"Error in QueueOutput.outputframe: {e}")
-            traceback.print_exc()
+            if self.errors == 1:
+                import traceback
+                traceback.print_exc()
+
+"""
+Per-viewer MediaStreamTrack over the camera's encoded packets
+"""
+class PacketTrack(MediaStreamTrack):
+    """
+    A MediaStreamTrack with its own subscription to a PiCameraStream's packets.
+    The subscription starts with the cached GOP, so the first packet sent is a keyframe
+    and a viewer joining mid-GOP doesn't wait for the next one.
+    """
+    kind = "video"
+
+    def __init__(self, source: "PiCameraStream", maxsize: int = 30):
+        super().__init__()
+        self._source = source
+        self._maxsize = maxsize
+        self._subscriber = None
+        self._created_at = time.monotonic()
+        self._first_frame_at = None
+
+    @property
+    def time_to_first_frame(self):
+        """Seconds from creating the track to its first packet (None until then)."""
+        if self._first_frame_at is None:
+            return None
+        return self._first_frame_at - self._created_at
+
+    @property
+    def queued_bytes(self) -> int:
+        """Bytes of packets waiting to be sent to this viewer."""
+        return self._subscriber.queued_bytes if self._subscriber is not None else 0
+
+    async def recv(self):
+        if self.readyState != "live" or self._source._stopped:
+            raise MediaStreamError
+
+        # Subscribe on whichever loop is consuming the track
+        current_loop = asyncio.get_running_loop()
+        if self._subscriber is None or self._subscriber.loop is not current_loop:
+            if self._subscriber is not None:
+                self._source.packets.unsubscribe(self._subscriber)
+            self._subscriber = self._source.packets.subscribe(maxsize=self._maxsize, loop=current_loop, replay=True)
+
+        # Waits on the loop itself - no thread hop per packet, and no timeout ending the track
+        packet = await self._subscriber.get()
+        if packet is None:
+            # The stream was stopped
+            raise MediaStreamError
+
+        if self._first_frame_at is None:
+            self._first_frame_at = time.monotonic()
+            TIME_TO_FIRST_FRAME.observe(self.time_to_first_frame)
+        return packet
+
+    def stop(self):
+        if self._subscriber is not None:
+            self._source.packets.unsubscribe(self._subscriber)
+        super().stop()
 
 """
 Custom MediaStreamTrack for Picamera2 with thread-safe access
@@ -124,7 +331,20 @@ class PiCameraStream(MediaStreamTrack):
     """
     kind = "video"
 
-    def __init__(self, size=(1920, 1080), bitrate=10_000_000):
+    def __init__(self, size=(1920, 1080), bitrate=10_000_000, iperiod=30, idle_size=None, still_size=(4608, 2592), zsl_frames=0, zsl_stride=3, zsl_max_age=0.5, capture_profile: CaptureProfile = None, focus_timeout=0.5, focus_hold=5.0, recorder: SegmentRecorder = None):
+        """
+        :param iperiod: Frames between keyframes, which bounds the GOP replayed to a new viewer
+        :param idle_size: Main stream resolution between captures (None keeps still_size all the time)
+        :param still_size: Main stream resolution captures are taken at
+        :param zsl_frames: Number of recent main-stream frames kept for zero-shutter-lag capture (0 disables);
+            these are taken at idle_size, so keep it at least as large as the capture profile's resolution
+        :param zsl_stride: Keep every Nth frame, to bound the memory bandwidth spent copying
+        :param zsl_max_age: Furthest (in seconds) a buffered frame can be from the trigger for capture_image() to return it instead of taking a new one
+        :param capture_profile: How captured images are cropped, scaled and encoded (None keeps full-resolution JPEGs)
+        :param focus_timeout: Longest a capture waits (in seconds) for autofocus and exposure to settle
+        :param focus_hold: Seconds the focus from prefocus() is held before returning to continuous autofocus
+        :param recorder: Keeps a rolling on-disk recording of the stream (closed when the stream stops)
+        """
         super().__init__()
         
         # Store the thread ID where this instance was created (main thread)
@@ -134,31 +354,66 @@ class PiCameraStream(MediaStreamTrack):
         # Single worker ensures operations are serialized and thread-safe
         self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PiCameraExecutor")
         
-        # Thread-safe queue for H.264 encoded frames
-        self.queue = queue.Queue(maxsize=30)  # Limit buffer to prevent memory issues
+        # Fan-out of H.264 encoded frames to asyncio consumers (recv() and any other subscribers)
+        self.packets = PacketFanout()
+        self._track = None  # recv()'s own subscription, created on first use
         
         # Threading lock for thread-safe operations
         self._lock = threading.Lock()
+
+        # Async camera operations in flight, so identical concurrent requests share one
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
         
         # Camera initialization (must happen in main thread)
         self.picam2 = Picamera2()
         
         # Use an encoder-friendly format and resolution
-        video_config = self.picam2.create_video_configuration(
-            main={"size": (4608, 2592)},
-            lores={"size": size, "format": "YUV420"},
-            encode="lores",
-        )
-        self.picam2.configure(video_config)
+        self.size = size
+        self.bitrate = bitrate
+        self.iperiod = iperiod
+
+        # Run a modest main stream while idle, switching to full resolution only around captures
+        self.still_size = tuple(still_size)
+        self.idle_size = tuple(idle_size) if idle_size is not None else self.still_size
+        self.main_size = self.idle_size
+        self.mode = "idle"
+        self.last_switch_latency = None
+        self.picam2.configure(self._video_configuration(size))
 
-        self.picam2.set_controls({"AfMode": controls.AfModeEnum.Continuous, "AfRange": controls.AfRangeEnum.Macro, "AfSpeed": controls.AfSpeedEnum.Fast})
+        self._af_controls = {"AfMode": controls.AfModeEnum.Continuous, "AfRange": controls.AfRangeEnum.Macro, "AfSpeed": controls.AfSpeedEnum.Fast}
+        self.picam2.set_controls(self._af_controls)
+
+        # Keep recent frames so a capture can return immediately
+        self._zsl = FrameRingBuffer(zsl_frames) if zsl_frames > 0 else None
+        self._zsl_stride = max(1, zsl_stride)
+        self._zsl_max_age = zsl_max_age
+        self._frame_count = 0
+        self.capture_profile = capture_profile
+
+        # Autofocus/exposure state from request metadata, so captures can wait for the lens to settle
+        self._autofocus = "AfMode" in self.picam2.camera_controls
+        self.focus_timeout = focus_timeout
+        self.focus_hold = focus_hold
+        self.last_focus_time = None
+        self._focus = threading.Condition()
+        self._af_state = None
+        self._ae_locked = None
+        self._focus_triggered_at = None  # When prefocus() last triggered autofocus
+        self._focus_settled_at = None
+        self._focus_scanned = False
+        self._focus_frames = 0
+        self.picam2.post_callback = self._on_request_completed
         
-        # Create encoder with specified bitrate
-        self.encoder = H264Encoder(bitrate)
+        # Create encoder with specified bitrate; repeat the SPS/PPS headers on every keyframe
+        # so a cached GOP can be replayed to a new viewer on its own
+        self.encoder = self._create_encoder(bitrate)
         
         # Start recording to our QueueOutput
-        # Note: We don't bind to a specific event loop here
-        self.picam2.start_recording(self.encoder, QueueOutput(self.queue, None))
+        # Note: We don't bind to a specific event loop here - subscribers bring their own
+        self.recorder = recorder
+        self._output = QueueOutput(self.packets, recorder)
+        self.picam2.start_recording(self.encoder, self._output)
         
         print("PiCameraStream initialized with thread-safe access")
         
@@ -171,23 +426,226 @@ class PiCameraStream(MediaStreamTrack):
         aiortc will accept av.Packet from recv() if configured to use encoded mode.
         """
         if self._stopped:
-            raise asyncio.CancelledError()
+            raise MediaStreamError
+
+        if self._track is None:
+            self._track = PacketTrack(self)
+        return await self._track.recv()
 
+    def subscribe(self, maxsize=30) -> PacketTrack:
+        """
+        Create a track for a new viewer. Each viewer gets its own subscription (instead of
+        sharing this track through a MediaRelay) so it can start from the cached GOP.
+        """
+        return PacketTrack(self, maxsize)
+
+    def reconfigure(self, size=None, bitrate=None):
+        """
+        Change the streamed (lores) resolution and/or the encoder bitrate at runtime.
+        The track and its subscribers stay live; the stream resumes with a keyframe.
+        """
+        if threading.current_thread().ident == self._main_thread_id:
+            return self._reconfigure(size, bitrate)
+        future = self._executor.submit(self._reconfigure, size, bitrate)
+        return future.result(timeout=10.0)
+
+    def _reconfigure(self, size=None, bitrate=None):
+        """
+        Restart the encoder (and, for a new size, the camera) - only call from main thread or via executor.
+        """
+        if self._stopped:
+            raise RuntimeError("PiCameraStream is stopped")
+
+        size = tuple(size) if size is not None else self.size
+        bitrate = bitrate or self.bitrate
+        if size == self.size and bitrate == self.bitrate:
+            return False
+
+        with self._lock:
+            start = time.monotonic()
+            previous = f"{self.size[0]}x{self.size[1]} @ {self.bitrate / 1e6:.1f} Mbps"
+            if size != self.size:
+                # The lores size is part of the camera configuration, so the camera restarts too
+                self._restart_camera(self.mode, self.main_size, size, bitrate)
+            else:
+                self.picam2.stop_encoder()
+                self.encoder = self._create_encoder(bitrate)
+                self.picam2.start_encoder(self.encoder, self._output)
+                self.bitrate = bitrate
+
+            print(f"Stream reconfigured from {previous} to {size[0]}x{size[1]} @ {bitrate / 1e6:.1f} Mbps in {(time.monotonic() - start) * 1000:.0f} ms")
+        return True
+
+    @contextmanager
+    def _still_mode(self):
+        """
+        Switch the main stream to still_size for the duration of a capture - call with the lock held.
+        The lores stream (and so the WebRTC track) keeps running, only briefly restarting.
+        Waits for focus and exposure to settle (after the switch) before handing over.
+        """
+        if self.idle_size == self.still_size:
+            self._wait_for_focus()
+            yield
+            return
+
+        try:
+            self._switch_mode("still", self.still_size)
+            self._wait_for_focus()
+            yield
+        finally:
+            # (a failed switch to still has already fallen back to idle)
+            if self.mode != "idle":
+                self._switch_mode("idle", self.idle_size)
+
+    def _switch_mode(self, mode, main_size):
+        start = time.monotonic()
+        self._restart_camera(mode, main_size)
+        self.last_switch_latency = time.monotonic() - start
+        MODE_SWITCH_SECONDS.observe(self.last_switch_latency, mode=mode)
+
+    def _restart_camera(self, mode, main_size, size=None, bitrate=None):
+        """
+        Reconfigure and restart the camera with a new encoder - call with the lock held.
+        If that fails, the camera is restarted idle with the previous stream settings before
+        the error is raised, so the stream (and everything fed by it) doesn't stay down.
+        """
+        previous = (self.size, self.bitrate)
         try:
-            # Use run_in_executor to avoid blocking the event loop
-            # This converts the blocking queue.get() to an async operation
-            current_loop = asyncio.get_running_loop()
-            packet = await current_loop.run_in_executor(
-                None, 
-                lambda: self.queue.get(timeout=1.0)
-            )
-            return packet
-        except queue.Empty:
-            # Queue timeout - this is normal and expected
-            raise asyncio.CancelledError()
+            self._start_camera(mode, main_size, size or self.size, bitrate or self.bitrate)
         except Exception as e:
-            print(f"Error in recv(): {e}")
-            raise asyncio.CancelledError()
+            print(f"Error restarting the camera in {mode} mode: {e}")
+            try:
+                self._start_camera("idle", self.idle_size, *previous)
+            except Exception as recovery_error:
+                print(f"Error recovering the camera: {recovery_error}")
+            raise
+
+    def _start_camera(self, mode, main_size, size, bitrate):
+        self.picam2.stop_recording()
+        self.mode = mode
+        self.main_size = main_size
+        self.size = size
+        self.bitrate = bitrate
+        self.picam2.configure(self._video_configuration(size))
+        self.picam2.set_controls(self._af_controls)
+        with self._focus:
+            self._af_state = None  # Wait for metadata from the new configuration
+            prefocused = self._focus_triggered_at is not None
+        self.encoder = self._create_encoder(bitrate)
+        self.picam2.start_recording(self.encoder, self._output)
+        if prefocused:
+            # The restart lost the focus prefocus() found - find it again
+            self._trigger_focus()
+
+    def _video_configuration(self, size):
+        # The main stream can't be smaller than the lores stream
+        main_size = (max(self.main_size[0], size[0]), max(self.main_size[1], size[1]))
+        return self.picam2.create_video_configuration(
+            main={"size": main_size},
+            lores={"size": size, "format": "YUV420"},
+            encode="lores",
+        )
+
+    def _create_encoder(self, bitrate):
+        return H264Encoder(bitrate, repeat=True, iperiod=self.iperiod)
+
+    def stats(self) -> dict:
+        """Health of the encoded stream (see PacketFanout.stats), plus encoder output errors."""
+        return {
+            **self.packets.stats(),
+            "size": self.size,
+            "bitrate": self.bitrate,
+            "mode": self.mode,
+            "main_size": self.main_size,
+            "last_switch_latency": self.last_switch_latency,
+            "last_focus_time": self.last_focus_time,
+            "frames": self._output.frame_index,
+            "output_errors": self._output.errors,
+        }
+
+    def prefocus(self):
+        """
+        Start focusing ahead of a capture (e.g. when the sensor sees an item approaching).
+        Switches autofocus to a single triggered scan, held for focus_hold seconds, so the
+        next capture doesn't land mid-hunt. Safe to call from any thread; doesn't block, so
+        it is skipped while a capture or restart holds the camera (those handle focus themselves).
+        """
+        if self._stopped or not self._autofocus:
+            return False
+
+        if not self._lock.acquire(blocking=False):
+            return False  # Camera busy
+        try:
+            with self._focus:
+                if self._focus_triggered_at is not None and self._focus_settled_at is None:
+                    return False  # Already focusing
+            self._trigger_focus()
+            return True
+        finally:
+            self._lock.release()
+
+    def _trigger_focus(self):
+        # Caller holds self._lock
+        with self._focus:
+            self._focus_triggered_at = time.monotonic()
+            self._focus_settled_at = None
+            self._focus_scanned = False
+            self._focus_frames = 0
+        self.picam2.set_controls({"AfMode": controls.AfModeEnum.Auto, "AfTrigger": controls.AfTriggerEnum.Start})
+
+    def _track_focus(self, metadata):
+        """
+        Follow the autofocus and exposure state - called for every completed request.
+        """
+        release = False
+        with self._focus:
+            self._af_state = metadata.get("AfState")
+            self._ae_locked = metadata.get("AeLocked")
+
+            if self._focus_triggered_at is not None:
+                now = time.monotonic()
+                if self._focus_settled_at is None:
+                    # The trigger takes a few frames to show up in the metadata
+                    self._focus_frames += 1
+                    if self._af_state == AF_STATE_SCANNING:
+                        self._focus_scanned = True
+                    elif self._af_state in (AF_STATE_FOCUSED, AF_STATE_FAILED) and (self._focus_scanned or self._focus_frames >= 3):
+                        self._focus_settled_at = now
+                        self.last_focus_time = now - self._focus_triggered_at
+                        FOCUS_SECONDS.observe(self.last_focus_time, outcome="focused" if self._af_state == AF_STATE_FOCUSED else "failed")
+                elif now - self._focus_settled_at > self.focus_hold:
+                    # Hand back to continuous autofocus
+                    self._focus_triggered_at = None
+                    self._focus_settled_at = None
+                    release = True
+
+            self._focus.notify_all()
+
+        if release:
+            self.picam2.set_controls(self._af_controls)
+
+    def _focus_settled(self):
+        # Called with the focus condition held
+        if self._focus_triggered_at is not None and self._focus_settled_at is None:
+            return False
+        if self._af_state is None or self._af_state == AF_STATE_SCANNING:
+            return False
+        return self._ae_locked is not False  # Not every camera reports AeLocked
+
+    def _wait_for_focus(self):
+        """
+        Wait (up to focus_timeout) for autofocus and exposure to settle before capturing.
+        """
+        if not self._autofocus:
+            return True
+
+        with span("camera.focus_wait"), self._focus:
+            settled = self._focus.wait_for(self._focus_settled, timeout=self.focus_timeout)
+            if not settled and self._focus_triggered_at is not None and self._focus_settled_at is None:
+                FOCUS_SECONDS.observe(time.monotonic() - self._focus_triggered_at, outcome="timeout")
+        if not settled:
+            print(f"Warning: focus didn't settle within {self.focus_timeout} seconds")
+        return settled
 
     def capture_array(self):
         """
@@ -225,45 +683,264 @@ class PiCameraStream(MediaStreamTrack):
             print(f"Error capturing frame: {e}")
             return None
 
-    def capture_image(self):
+    def capture_image(self, triggered_at=None):
         """
         Thread-safe access to capture_image from any thread.
         Returns a BytesIO object containing the captured image.
+
+        :param triggered_at: Monotonic time the item was detected; buffered frames are picked around it
         """
-        if threading.current_thread().ident == self._main_thread_id:
-            # We're in the main thread, safe to call directly
-            return self._capture_image_direct()
+        with span("camera.capture"):
+            if threading.current_thread().ident == self._main_thread_id:
+                # We're in the main thread, safe to call directly
+                return self._capture_image_direct(triggered_at)
+            else:
+                # We're in a different thread, use executor
+                # (copying the context so spans recorded there join the caller's trace)
+                try:
+                    future = self._executor.submit(contextvars.copy_context().run, self._capture_image_direct, triggered_at)
+                    return future.result(timeout=10.0)  # Longer timeout for image capture
+                except TimeoutError:
+                    print("Warning: capture_image() timed out after 10 seconds")
+                    return None
+                except Exception as e:
+                    print(f"Error in capture_image(): {e}")
+                    return None
+
+    async def capture_image_async(self, triggered_at=None):
+        """
+        Capture an image without blocking the event loop. Returns a JPEG BytesIO, or None on failure.
+        Concurrent calls (for the same trigger) share a single capture.
+        """
+        with span("camera.capture"):
+            return await self._run_async("capture_image_async", self._capture_image_direct, triggered_at, timeout=10.0, share=_copy_image)
+
+    async def capture_array_async(self):
+        """
+        Capture a main-stream frame without blocking the event loop. Returns a numpy array, or None on failure.
+        Concurrent calls share a single capture.
+        """
+        return await self._run_async("capture_array_async", self._capture_frame_direct, timeout=5.0, share=_copy_array)
+
+    async def camera_info_async(self):
+        """
+        Camera information without blocking the event loop (None on failure).
+        """
+        return await self._run_async("camera_info_async", self._get_camera_info_direct, timeout=2.0, share=dict)
+
+    async def _run_async(self, name, function, *args, timeout, share=None):
+        """
+        Run a direct camera operation on the camera executor and await it with a deadline.
+        An identical call already in flight is joined instead of queueing another: the caller
+        that started it gets the result, the others get a copy made by `share`.
+        """
+        key = (name, args)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                if self._stopped:
+                    print(f"Error in {name}(): PiCameraStream is stopped")
+                    return None
+                # Copy the context so spans recorded on the executor join the caller's trace
+                future = self._executor.submit(contextvars.copy_context().run, function, *args)
+                self._inflight[key] = future
+
+        if leader:
+            future.add_done_callback(lambda done: self._forget_inflight(key, done))
         else:
-            # We're in a different thread, use executor
-            try:
-                future = self._executor.submit(self._capture_image_direct)
-                return future.result(timeout=10.0)  # Longer timeout for image capture
-            except TimeoutError:
-                print("Warning: capture_image() timed out after 10 seconds")
-                return None
-            except Exception as e:
-                print(f"Error in capture_image(): {e}")
+            COALESCED_REQUESTS.inc(operation=name)
+
+        try:
+            # Shielded, so a caller timing out doesn't cancel the operation for the others
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"Warning: {name}() timed out after {timeout} seconds")
+            return None
+        except Exception as e:
+            print(f"Error in {name}(): {e}")
+            return None
+
+        if not leader and share is not None and result is not None:
+            result = share(result)
+        return result
+
+    def _forget_inflight(self, key, future):
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def _on_request_completed(self, request):
+        """
+        Called by Picamera2 (in its camera thread) for every completed request.
+        Follows the autofocus state and copies every Nth main-stream frame into the zero-shutter-lag ring buffer.
+        """
+        try:
+            metadata = request.get_metadata()
+            if self._autofocus:
+                self._track_focus(metadata)
+        except Exception as e:
+            print(f"Error reading request metadata: {e}")
+            return
+
+        if self._zsl is None or self.mode != "idle":
+            return  # Keep the ring at the idle resolution rather than reallocating it around captures
+
+        self._frame_count += 1
+        if self._frame_count % self._zsl_stride != 0:
+            return
+
+        try:
+            sensor_timestamp = metadata.get("SensorTimestamp")  # CLOCK_MONOTONIC, in ns
+            timestamp = sensor_timestamp / 1e9 if sensor_timestamp else time.monotonic()
+            with MappedArray(request, "main") as mapped:
+                self._zsl.write(mapped.array, timestamp, metadata)
+        except Exception as e:
+            print(f"Error buffering frame: {e}")
+
+    def _encode_frame(self, frame):
+        """
+        Apply the capture profile to a main-stream frame and JPEG-encode it with simplejpeg.
+        """
+        profile = self.capture_profile
+        if profile is None:
+            with span("camera.jpeg_encode"):
+                return encode_jpeg(frame)
+
+        with span("camera.profile"):
+            frame = profile.apply(frame)
+        with span("camera.jpeg_encode"):
+            return profile.encode(frame)
+
+    def _score_frame(self, frame):
+        # Only the region of interest matters for sharpness
+        if self.capture_profile is not None:
+            frame = self.capture_profile.crop(frame)
+        return sharpness(frame)
+
+    def _capture_zsl_image(self, triggered_at=None):
+        """
+        Encode the best buffered frame around the trigger (or now), or return None if none is close enough.
+        """
+        with self._zsl.best(self._zsl_max_age, at=triggered_at) as buffered:
+            if buffered is None:
                 return None
+            frame, _, _ = buffered
+            return self._encode_frame(frame)
 
-    def _capture_image_direct(self):
+    def _capture_image_direct(self, triggered_at=None):
         """
         Direct image capture - only call from main thread or via executor.
+        Returns a buffered frame when zero-shutter-lag capture is enabled.
         """
         if self._stopped:
             raise RuntimeError("PiCameraStream is stopped")
+
+        # (buffered frames were exposed before the trigger, so they don't wait for focus)
+        if self._zsl is not None:
+            try:
+                with span("camera.zsl"):
+                    data = self._capture_zsl_image(triggered_at)
+                if data is not None:
+                    return data
+            except Exception as e:
+                print(f"Error capturing buffered frame: {e}")
         
         try:
-            with self._lock:
-                data = BytesIO()
-                request = self.picam2.capture_request()
-                # request.save("main", "test.jpg")
-                request.save("main", data, format="jpeg")
-                request.release()
-                return data
+            with self._lock, self._still_mode():
+                with span("camera.capture_request"):
+                    request = self.picam2.capture_request()
+                try:
+                    # Encode straight from the request's buffer rather than through request.save()'s PIL path
+                    with MappedArray(request, "main") as mapped:
+                        return self._encode_frame(mapped.array)
+                finally:
+                    request.release()
         except Exception as e:
             print(f"Error capturing image: {e}")
             return None
 
+    def capture_burst(self, count=3, triggered_at=None):
+        """
+        Thread-safe burst capture from any thread.
+        Scores `count` frames for sharpness and returns the sharpest as a JPEG BytesIO.
+        """
+        with span("camera.capture"):
+            if threading.current_thread().ident == self._main_thread_id:
+                return self._capture_burst_direct(count, triggered_at)
+            else:
+                try:
+                    future = self._executor.submit(contextvars.copy_context().run, self._capture_burst_direct, count, triggered_at)
+                    return future.result(timeout=10.0)
+                except TimeoutError:
+                    print("Warning: capture_burst() timed out after 10 seconds")
+                    return None
+                except Exception as e:
+                    print(f"Error in capture_burst(): {e}")
+                    return None
+
+    async def capture_burst_async(self, count=3, triggered_at=None):
+        """
+        Burst capture without blocking the event loop - capture and scoring
+        always run on the camera executor, even when called from the main thread.
+        """
+        with span("camera.capture"):
+            return await self._run_async("capture_burst_async", self._capture_burst_direct, count, triggered_at, timeout=10.0, share=_copy_image)
+
+    def _capture_burst_direct(self, count, triggered_at=None):
+        """
+        Direct burst capture - only call from main thread or via executor.
+        Scores the `count` buffered frames closest to the trigger (or now) when zero-shutter-lag
+        capture is enabled, otherwise captures `count` new requests. Only the sharpest frame is encoded.
+        """
+        if self._stopped:
+            raise RuntimeError("PiCameraStream is stopped")
+
+        # (buffered frames were exposed before the trigger, so they don't wait for focus)
+        if self._zsl is not None:
+            try:
+                at = time.monotonic() if triggered_at is None else triggered_at
+                with self._zsl.recent(self._zsl_max_age, at=at) as frames:
+                    frames = sorted(frames, key=lambda buffered: abs(buffered[1] - at))[:count]
+                    if frames:
+                        with span("camera.sharpness"):
+                            scores = [self._score_frame(frame) for frame, _, _ in frames]
+                        best = frames[scores.index(max(scores))][0]
+                        return self._encode_frame(best)
+            except Exception as e:
+                print(f"Error scoring buffered frames: {e}")
+
+        try:
+            with self._lock, self._still_mode():
+                best_request, best_score = None, None
+                try:
+                    for _ in range(count):
+                        with span("camera.capture_request"):
+                            request = self.picam2.capture_request()
+                        try:
+                            with span("camera.sharpness"), MappedArray(request, "main") as mapped:
+                                score = self._score_frame(mapped.array)
+                        except Exception:
+                            request.release()
+                            raise
+
+                        # Keep hold of the sharpest request so far, releasing the rest immediately
+                        if best_score is None or score > best_score:
+                            if best_request is not None:
+                                best_request.release()
+                            best_request, best_score = request, score
+                        else:
+                            request.release()
+
+                    with MappedArray(best_request, "main") as mapped:
+                        return self._encode_frame(mapped.array)
+                finally:
+                    if best_request is not None:
+                        best_request.release()
+        except Exception as e:
+            print(f"Error capturing burst: {e}")
+            return None
+
     def get_camera_info(self):
         """
         Thread-safe access to camera information.
@@ -305,6 +982,9 @@ class PiCameraStream(MediaStreamTrack):
             return
         
         self._stopped = True
+
+        # Wake up any consumer waiting for packets
+        self.packets.close()
         
         try:
             # Stop recording (may raise if already stopped - ignore)
@@ -317,6 +997,10 @@ class PiCameraStream(MediaStreamTrack):
             self.picam2.close()
         except Exception:
             pass
+
+        if self.recorder is not None:
+            # Write out what's still queued
+            self.recorder.close()
         
         try:
             # Shutdown the executor gracefully
@@ -0,0 +1,227 @@
+from gpiozero import DistanceSensor
+from typing import Callable
+import asyncio, threading, time
+import numpy as np
+
+# Constants
+DEFAULT_SAMPLE_RATE = 1 / 0.06 # gpiozero's built-in DistanceSensor sample rate (in Hz)
+MAX_PENDING_EVENTS = 8 # Maximum number of undelivered detection events kept
+
+class DistanceRingBuffer:
+  """
+  Fixed-size ring buffer of timestamped raw and filtered distance readings, backed by numpy arrays.
+  Nothing is allocated after construction.
+  """
+  def __init__(self, capacity: int = 256):
+    if capacity < 1:
+      raise ValueError("capacity must be at least one")
+
+    self.capacity = capacity
+    self.timestamps = np.zeros(capacity, dtype=np.float64)
+    self.raw = np.zeros(capacity, dtype=np.float64)
+    self.filtered = np.zeros(capacity, dtype=np.float64)
+    self.index = 0 # Next slot to write
+    self.count = 0 # Number of valid readings
+
+  def push(self, timestamp: float, raw: float, filtered: float = np.nan):
+    self.timestamps[self.index] = timestamp
+    self.raw[self.index] = raw
+    self.filtered[self.index] = filtered
+    self.index = (self.index + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def set_filtered(self, filtered: float):
+    """Set the filtered value of the most recent reading."""
+    self.filtered[(self.index - 1) % self.capacity] = filtered
+
+  def _order(self, n: int) -> np.ndarray:
+    n = min(n, self.count)
+    return (np.arange(self.index - n, self.index)) % self.capacity
+
+  def latest_raw(self, n: int) -> np.ndarray:
+    """Return a copy of the last n raw readings, oldest first."""
+    return self.raw[self._order(n)]
+
+  def snapshot(self, n: int = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return copies of the last n (default: all) timestamps, raw and filtered readings, oldest first."""
+    order = self._order(self.count if n is None else n)
+    return self.timestamps[order], self.raw[order], self.filtered[order]
+
+class SensorSampler:
+  """
+  Filters raw distance readings (median over a short window, then an EMA) and applies
+  enter/exit hysteresis, so a single "arrived" event is emitted per physical item.
+  An "approaching" event is emitted ahead of it, as soon as the (unsmoothed) median
+  comes within approach_distance, so the camera can start focusing early.
+  Readings are pushed from the sensor's sampling thread.
+  """
+  def __init__(self, enter_distance: float, exit_distance: float, median_window: int = 5, ema_alpha: float = 0.5, debounce: int = 2, capacity: int = 256, on_event: Callable[[str, float], None] = None, approach_distance: float = None):
+    if exit_distance < enter_distance:
+      raise ValueError("exit_distance must not be less than enter_distance")
+    if not 0 < ema_alpha <= 1:
+      raise ValueError("ema_alpha must be in (0, 1]")
+
+    self.enter_distance = enter_distance # Filtered distance (in m) below which an item has arrived
+    self.exit_distance = exit_distance # Filtered distance (in m) above which the item has left
+    self.approach_distance = approach_distance if approach_distance is not None else exit_distance # Median distance (in m) below which an item is approaching
+    self.median_window = median_window
+    self.ema_alpha = ema_alpha
+    self.debounce = debounce # Consecutive filtered readings needed to change state
+    self.on_event = on_event
+    self.buffer = DistanceRingBuffer(capacity)
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    """Forget the filter state, treating the chamber as empty."""
+    with self.lock:
+      self.ema = None
+      self.occupied = False
+      self.approached = False
+      self.streak = 0
+
+  @property
+  def distance(self):
+    """The latest filtered distance (in m), or None before the first reading."""
+    return self.ema
+
+  def push(self, distance: float, timestamp: float = None):
+    """Add a raw reading (in m), emitting an event if it changes the chamber's state."""
+    if timestamp is None:
+      timestamp = time.monotonic()
+
+    with self.lock:
+      self.buffer.push(timestamp, distance)
+
+      # Median rejects single-sample echo spikes, the EMA smooths what is left
+      median = float(np.median(self.buffer.latest_raw(self.median_window)))
+      self.ema = median if self.ema is None else self.ema_alpha * median + (1 - self.ema_alpha) * self.ema
+      self.buffer.set_filtered(self.ema)
+
+      events = [event for event in (self._update_approach(median), self._update_state()) if event is not None]
+
+    if self.on_event is not None:
+      for event in events:
+        self.on_event(event, timestamp)
+
+  def _update_approach(self, median):
+    # Fire once per item, before the filtered distance has crossed the enter threshold
+    if self.occupied:
+      return None
+    if median >= self.approach_distance:
+      self.approached = False
+      return None
+    if self.approached:
+      return None
+    self.approached = True
+    return "approaching"
+
+  def _update_state(self):
+    # Count consecutive readings on the far side of the threshold for the current state
+    if self.occupied:
+      crossing = self.ema > self.exit_distance
+    else:
+      crossing = self.ema < self.enter_distance
+    self.streak = self.streak + 1 if crossing else 0
+
+    if self.streak < self.debounce:
+      return None
+
+    self.streak = 0
+    self.occupied = not self.occupied
+    self.approached = True # Re-arm only once the median is back beyond approach_distance
+    return "arrived" if self.occupied else "departed"
+
+class SampledDistanceSensor(DistanceSensor):
+  """
+  DistanceSensor whose background sampling rate can be configured.
+  gpiozero hard-codes a 60ms wait between readings; this exposes it as a rate (in Hz).
+  Every valid reading is also fed to the attached SensorSampler, if any.
+  """
+  def __init__(self, *args, sample_rate: float = DEFAULT_SAMPLE_RATE, sampler: SensorSampler = None, **kwargs):
+    self.sampler = sampler
+    super().__init__(*args, **kwargs)
+    self.sample_rate = sample_rate
+
+  def _read(self):
+    # Runs on gpiozero's sampling thread
+    value = self._measure()
+    if value is not None and self.sampler is not None:
+      self.sampler.push(value * self.max_distance)
+    return value
+
+  def _measure(self):
+    """Take a single reading, normalised to max_distance (None if no echo)."""
+    return super()._read()
+
+  @property
+  def sample_rate(self) -> float:
+    return 1 / self._queue.sample_wait
+
+  @sample_rate.setter
+  def sample_rate(self, value: float):
+    if value <= 0:
+      raise ValueError("sample_rate must be positive")
+
+    # The sampling thread re-reads sample_wait on every iteration
+    self._queue.sample_wait = 1 / value
+
+class ObjectDetector:
+  """
+  Bridges the sampler's arrived/departed events (fired from gpiozero's
+  sampling thread) onto an asyncio loop, so detection needs no polling.
+  "approaching" events go straight to on_approach instead, without waiting for the loop.
+  """
+  def __init__(self, sensor: SampledDistanceSensor, on_approach: Callable[[float], None] = None):
+    self.sensor = sensor
+    self.sampler = sensor.sampler
+    self.on_approach = on_approach # Called from the sampling thread with the monotonic timestamp
+    self.loop = None
+    self.events = None # asyncio.Queue of (event, monotonic timestamp) tuples
+    self.in_range = False
+
+  def start(self, loop: asyncio.AbstractEventLoop = None):
+    """Attach to the sampler, delivering events onto the given (or running) loop."""
+    self.loop = loop or asyncio.get_running_loop()
+    self.events = asyncio.Queue(maxsize=MAX_PENDING_EVENTS)
+    self.in_range = False
+    self.sampler.reset()
+    self.sampler.on_event = self._publish
+
+  def stop(self):
+    """Detach from the sampler."""
+    self.sampler.on_event = None
+    self.loop = None
+
+  def _publish(self, event: str, timestamp: float):
+    # Called from gpiozero's thread
+    if event == "approaching":
+      # Every millisecond counts here, so don't hop onto the (possibly busy) loop
+      if self.on_approach is not None:
+        try:
+          self.on_approach(timestamp)
+        except Exception as e:
+          print(f"Error handling approach: {e}")
+      return
+
+    # Deliver on the loop thread
+    loop = self.loop
+    if loop is None or loop.is_closed():
+      return
+    loop.call_soon_threadsafe(self._deliver, event, timestamp)
+
+  def _deliver(self, event: str, timestamp: float):
+    self.in_range = event == "arrived"
+    try:
+      self.events.put_nowait((event, timestamp))
+    except asyncio.QueueFull:
+      # Nobody is consuming events; keep the newest
+      self.events.get_nowait()
+      self.events.put_nowait((event, timestamp))
+
+  async def wait_for_item(self) -> float:
+    """Wait until an object enters the threshold distance, returning the monotonic trigger time."""
+    while True:
+      event, timestamp = await self.events.get()
+      if event == "arrived":
+        return timestamp
@@ -0,0 +1,251 @@
+import os
+import queue
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import List, Optional
+
+from libs.metrics import counter, gauge
+
+"""
+Rolling on-disk recording of the encoded H.264 stream
+"""
+
+DVR_BYTES = gauge("bloobin_dvr_bytes", "Bytes of video held in the on-disk ring of segments")
+DVR_SEGMENTS = gauge("bloobin_dvr_segments", "Segments held in the on-disk ring")
+DVR_DROPPED = counter("bloobin_dvr_dropped_packets_total", "Packets not recorded because the writer fell behind")
+DVR_CLIPS = counter("bloobin_dvr_clips_total", "Clips cut from the recording")
+
+class Segment:
+    """
+    One segment file: raw H.264 (Annex B) starting on a keyframe, plus an in-memory index
+    of when each packet arrived and where it starts in the file.
+    """
+    def __init__(self, path: str, started_at: float):
+        self.path = path
+        self.started_at = started_at
+        self.ended_at = started_at
+        self.size = 0
+        self.flushed = 0  # Bytes known to be written out of the file's buffer
+        self.timestamps: List[float] = []  # Arrival time (monotonic) of each packet
+        self.offsets: List[int] = []  # File offset of each packet
+        self.keyframes: List[int] = []  # Indexes of the packets that are keyframes
+
+    def add(self, data: bytes, keyframe: bool, timestamp: float):
+        if keyframe:
+            self.keyframes.append(len(self.timestamps))
+        self.timestamps.append(timestamp)
+        self.offsets.append(self.size)
+        self.size += len(data)
+        self.ended_at = timestamp
+
+class SegmentRecorder:
+    """
+    Tees encoded packets into fixed-duration segment files in a circular on-disk buffer.
+    write() is called from the encoder thread and never blocks: packets are queued for a
+    writer thread (and dropped if it falls behind), which appends them with large buffered
+    writes and deletes the oldest segments to keep disk usage bounded.
+    """
+    def __init__(self, directory: str, segment_seconds: float = 10.0, max_bytes: int = 256 * 1024 * 1024, max_segments: int = 60, queue_size: int = 300, buffer_size: int = 1024 * 1024):
+        """
+        :param directory: Where segment files are kept (reused between runs; the recorder's old segment_*.h264 files are removed, anything else is left alone)
+        :param segment_seconds: Shortest segment; each one is closed on the first keyframe after this
+        :param max_bytes: Most bytes of video kept on disk
+        :param max_segments: Most segment files kept on disk
+        :param queue_size: Packets the writer can fall behind by before packets are dropped
+        :param buffer_size: Write buffer per segment file
+        """
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.buffer_size = buffer_size
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._segments = deque()  # Closed segments, oldest first, plus the one being written
+        self._file = None
+        self._sequence = 0
+        self._bytes = 0  # Bytes in self._segments
+        self._gap = False  # A packet was dropped since the last one queued (write()'s side)
+        self._waiting_for_keyframe = True  # The writer thread's side
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith("segment_") and name.endswith(".h264"):
+                os.remove(os.path.join(directory, name))
+
+        DVR_BYTES.set_function(lambda: self.stats()["bytes"])
+        DVR_SEGMENTS.set_function(lambda: self.stats()["segments"])
+
+        self._thread = threading.Thread(target=self._run, name="SegmentRecorder", daemon=True)
+        self._thread.start()
+
+    def write(self, data: bytes, keyframe: bool, timestamp: Optional[float] = None):
+        """Queue a packet for recording. Safe to call from any thread; never blocks."""
+        if timestamp is None:
+            timestamp = time.monotonic()
+        try:
+            # Tell the writer about any gap in band, so it restarts cleanly from the next keyframe
+            self._queue.put_nowait((bytes(data), keyframe, timestamp, self._gap))
+            self._gap = False
+        except queue.Full:
+            self.dropped += 1
+            DVR_DROPPED.inc()
+            self._gap = True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until every packet queued so far is on disk (or at least in the OS's buffers)."""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def clip(self, timestamp: float, before: float = 5.0, after: float = 5.0, path: str = None) -> Optional[str]:
+        """
+        Write the recording from `before` seconds ahead of a (monotonic) timestamp to `after`
+        seconds past it into a standalone H.264 file, without re-encoding. The clip starts on
+        the last keyframe at or before the window so it can be decoded on its own.
+        Returns the clip's path, or None if nothing of the window is recorded.
+        """
+        self.flush()
+        start, end = timestamp - before, timestamp + after
+        if path is None:
+            path = os.path.join(self.directory, f"clip_{int(time.time() * 1000)}.h264")
+
+        with self._lock:
+            segments = [segment for segment in self._segments if segment.ended_at >= start and segment.started_at <= end]
+            ranges = [self._clip_range(segment, start, end) for segment in segments]
+
+        written = 0
+        with open(path, "wb", buffering=self.buffer_size) as clip_file:
+            for segment, (first, last) in zip(segments, ranges):
+                if first >= last:
+                    continue
+                try:
+                    with open(segment.path, "rb") as segment_file:
+                        segment_file.seek(first)
+                        clip_file.write(segment_file.read(last - first))
+                        written += last - first
+                except FileNotFoundError:
+                    continue  # Rotated away in the meantime
+
+        if written == 0:
+            os.remove(path)
+            return None
+        DVR_CLIPS.inc()
+        return path
+
+    def stats(self) -> dict:
+        with self._lock:
+            segments = list(self._segments)
+        return {
+            "segments": len(segments),
+            "bytes": sum(segment.size for segment in segments),
+            "oldest": segments[0].started_at if segments else None,
+            "newest": segments[-1].ended_at if segments else None,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """Write out everything queued and stop the writer thread."""
+        try:
+            self._queue.put(None, timeout=5.0)
+        except queue.Full:
+            print("Warning: the video recorder is stuck; not waiting for it")
+            return
+        self._thread.join(timeout=5.0)
+
+    def _clip_range(self, segment: Segment, start: float, end: float):
+        # Called with the lock held: byte range of the segment covering [start, end]
+        first = bisect_right(segment.timestamps, start) - 1
+        # Back up to a keyframe so the clip decodes from its first byte
+        keyframe = bisect_right(segment.keyframes, max(first, 0)) - 1
+        first_offset = segment.offsets[segment.keyframes[keyframe]] if keyframe >= 0 else 0
+
+        last = bisect_left(segment.timestamps, end)
+        last_offset = segment.offsets[last] if last < len(segment.offsets) else segment.size
+        # Don't read past what's been written out (the segment being written may be ahead of its file)
+        return first_offset, min(last_offset, segment.flushed)
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            if isinstance(entry, threading.Event):
+                if self._file is not None:
+                    self._file.flush()
+                    with self._lock:
+                        self._segments[-1].flushed = self._segments[-1].size
+                entry.set()
+                continue
+
+            try:
+                self._record(*entry)
+            except OSError as e:
+                print(f"Error recording video: {e}")
+                self._close_segment()
+                self._waiting_for_keyframe = True
+
+        self._close_segment()
+
+    def _record(self, data: bytes, keyframe: bool, timestamp: float, gap: bool = False):
+        if gap:
+            self._waiting_for_keyframe = True
+        if self._waiting_for_keyframe:
+            if not keyframe:
+                return
+            self._waiting_for_keyframe = False
+            self._close_segment()
+
+        # Segments only start on keyframes, so each decodes on its own. A segment holding half
+        # the ring is also cut early, so rotating it out never empties the ring
+        segment = self._segments[-1] if self._file is not None else None
+        if segment is None or (keyframe and (timestamp - segment.started_at >= self.segment_seconds or segment.size >= self.max_bytes // 2)):
+            segment = self._open_segment(timestamp)
+
+        self._file.write(data)
+        with self._lock:
+            segment.add(data, keyframe, timestamp)
+            self._bytes += len(data)
+            over = self._bytes > self.max_bytes
+        if over:
+            self._rotate()
+
+    def _open_segment(self, timestamp: float) -> Segment:
+        self._close_segment()
+        self._sequence += 1
+        segment = Segment(os.path.join(self.directory, f"segment_{self._sequence:06d}.h264"), timestamp)
+        self._file = open(segment.path, "wb", buffering=self.buffer_size)
+        with self._lock:
+            self._segments.append(segment)
+        self._rotate()
+        return segment
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            with self._lock:
+                self._segments[-1].flushed = self._segments[-1].size
+
+    def _rotate(self):
+        # Delete the oldest closed segments until the ring is within its bounds
+        while True:
+            with self._lock:
+                if len(self._segments) <= 1:
+                    return
+                if len(self._segments) <= self.max_segments and self._bytes <= self.max_bytes:
+                    return
+                oldest = self._segments.popleft()
+                self._bytes -= oldest.size
+            try:
+                os.remove(oldest.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from typing import Callable, List
+
+from libs.metrics import counter, histogram
+
+"""
+Publish/subscribe events from any thread, delivered on one event loop
+"""
+
+EVENTS_PUBLISHED = counter("bloobin_events_published_total", "Events published on the event bus", labels=("type",))
+EVENT_BATCH_SIZE = histogram("bloobin_event_batch_size", "Events delivered together in one batch", buckets=(1, 2, 4, 8, 16, 32, 64))
+
+class EventBus:
+    """
+    Collects events published from any thread (camera, gpiozero callbacks, the event loop
+    itself) and hands them to subscribers on the bus's loop. publish() never blocks: it appends
+    the event and, if none is pending, schedules one delivery with call_soon_threadsafe, so every
+    event published before the loop gets to it is delivered in the same batch.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop
+        self._subscribers: List[Callable[[List[dict]], None]] = []
+        self._pending: List[dict] = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Deliver events on this loop, including any published before it was attached."""
+        with self._lock:
+            self.loop = loop
+            if self._pending and not self._scheduled:
+                self._scheduled = True
+                loop.call_soon_threadsafe(self._deliver)
+
+    def subscribe(self, callback: Callable[[List[dict]], None]) -> Callable[[], None]:
+        """
+        Call `callback` on the bus's loop with each batch of events (oldest first). It must not block.
+        Returns a function that unsubscribes it.
+        """
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+    def publish(self, type: str, data=None):
+        """Publish an event. Safe to call from any thread; never blocks on the loop."""
+        event = {"type": type} if data is None else {"type": type, "data": data}
+        EVENTS_PUBLISHED.inc(type=type)
+        with self._lock:
+            self._pending.append(event)
+            if self._scheduled or self.loop is None:
+                return
+            self._scheduled = True
+            loop = self.loop
+        try:
+            loop.call_soon_threadsafe(self._deliver)
+        except RuntimeError:
+            pass  # The loop is closed; nothing will deliver these
+
+    def _deliver(self):
+        # Runs on the bus's loop
+        with self._lock:
+            events, self._pending = self._pending, []
+            self._scheduled = False
+        if not events:
+            return
+
+        EVENT_BATCH_SIZE.observe(len(events))
+        for callback in list(self._subscribers):
+            try:
+                callback(events)
+            except Exception as e:
+                print(f"Error delivering events: {e}")
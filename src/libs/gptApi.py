@@ -3,6 +3,7 @@ import os, time, base64
 from dotenv import load_dotenv
 from openai import OpenAI
 from jinja2 import Environment, FileSystemLoader
+from libs.tracing import record, span
 
 load_dotenv(verbose=True, override=True)
 
@@ -52,7 +53,7 @@ def save_image(imageBase64, filename):
     image_file.write(base64.b64decode(imageBase64))
 
 ## Main function
-def is_recyclable(imageBase64, binMode):
+def is_recyclable(imageBase64, binMode, detail="auto"):
   # Check if image is provided
   if imageBase64 is None:
     # Obtain image to send
@@ -66,6 +67,7 @@ def is_recyclable(imageBase64, binMode):
 
   # Start time
   start_time = time.time()
+  request_start = time.monotonic()
   if binMode == "ATM":
     promptString = load_prompt("atm.txt")
   else:
@@ -90,6 +92,7 @@ def is_recyclable(imageBase64, binMode):
             "type": "image_url",
             "image_url": {
               "url": f"data:image/jpeg;base64,{imageBase64}",
+              "detail": detail, # low, high or auto - trades accuracy against image tokens
             },
           },
         ],
@@ -108,6 +111,7 @@ def is_recyclable(imageBase64, binMode):
   # End time
   end_time = time.time()
   timeTaken = end_time - start_time
+  record("gpt.request", request_start, time.monotonic())
 
   # Obtain and return response
   responseContent = response.choices[0].message.content
@@ -121,7 +125,8 @@ def is_recyclable(imageBase64, binMode):
 
   # Save the image to disk with the result
   print("Saving image to disk")
-  save_image(imageBase64, f"{binMode}_{canBeRecycled}_{timeTaken}_{identifiedMaterial}_{reasonForRejection}")
+  with span("gpt.save_image"):
+    save_image(imageBase64, f"{binMode}_{canBeRecycled}_{timeTaken}_{identifiedMaterial}_{reasonForRejection}")
 
   return canBeRecycled, identifiedMaterial, reasonForRejection
 
@@ -0,0 +1,28 @@
+import os
+from dotenv import load_dotenv
+
+# Load the hardware backend before any device is created
+load_dotenv(verbose=True, override=True)
+
+# Hardware backend: "pi" talks to the real pins and camera, "sim" simulates them (see libs.simulation)
+HARDWARE_BACKEND = os.environ.get("HARDWARE_BACKEND", "pi").lower()
+SIMULATED = HARDWARE_BACKEND == "sim"
+
+if HARDWARE_BACKEND not in ("pi", "sim"):
+  raise ValueError(f"Unknown HARDWARE_BACKEND: {HARDWARE_BACKEND} (expected pi or sim)")
+
+if SIMULATED:
+  # Every gpiozero device created from now on (sensor, motor) uses mock pins
+  from gpiozero import Device
+  from gpiozero.pins.mock import MockFactory, MockPWMPin
+  Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+
+# Functions
+# Create the ultrasonic sensor for the selected backend
+def create_distance_sensor(**kwargs):
+  if SIMULATED:
+    from libs.simulation import SimulatedDistanceSensor
+    return SimulatedDistanceSensor(**kwargs)
+
+  from libs.detection import SampledDistanceSensor
+  return SampledDistanceSensor(**kwargs)
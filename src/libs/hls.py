@@ -0,0 +1,163 @@
+import asyncio
+import io
+import math
+import threading
+import time
+from collections import deque
+from fractions import Fraction
+from typing import Optional
+
+import av
+
+from libs.metrics import counter, gauge
+from libs.packet_fanout import NAL_PPS, NAL_SPS, PTS_CLOCK, nal_type, split_nal_units
+
+"""
+HLS for viewers that can't do WebRTC: the encoded H.264 packets remuxed into MPEG-TS segments
+"""
+
+HLS_SEGMENTS = counter("bloobin_hls_segments_total", "HLS segments muxed")
+HLS_REQUESTS = counter("bloobin_hls_requests_total", "HLS playlist and segment requests", labels=("kind",))
+HLS_RUNNING = gauge("bloobin_hls_running", "Whether the HLS segmenter is running (it stops when nobody is watching)")
+
+class HlsSegmenter:
+    """
+    Cuts the stream's packets into short MPEG-TS segments kept in memory, remuxing them with
+    PyAV without decoding or re-encoding. One segmenter serves every HTTP viewer; it
+    subscribes to the stream on the first request and stops once nobody has asked for a while.
+    """
+    def __init__(self, stream, segment_seconds: float = 1.0, window: int = 6, idle_timeout: float = 30.0):
+        """
+        :param stream: A PiCameraStream (anything with a PacketFanout as `packets`)
+        :param segment_seconds: Shortest segment; each one is cut on the first keyframe after this
+        :param window: Segments listed in the playlist (older ones are forgotten)
+        :param idle_timeout: Seconds without requests before the segmenter stops
+        """
+        self.stream = stream
+        self.segment_seconds = segment_seconds
+        self.window = window
+        self.idle_timeout = idle_timeout
+
+        self.segments = deque(maxlen=window + 2)  # (sequence, duration, data), a little past the playlist for slow fetches
+        self._sequence = 0
+        self._template = None  # (SPS/PPS, demuxer, its stream) the segments' video stream is copied from
+        self._template_lock = threading.Lock()  # Held while muxing, which runs on a worker thread
+        self._task: Optional[asyncio.Task] = None
+        self._last_request = 0.0
+        self._updated = asyncio.Condition()
+
+    async def playlist(self, timeout: float = 10.0) -> Optional[str]:
+        """The live playlist, waiting for the first segment if needed (None if none arrives in time)."""
+        self._touch()
+        HLS_REQUESTS.inc(kind="playlist")
+        if not self.segments:
+            async with self._updated:
+                try:
+                    await asyncio.wait_for(self._updated.wait_for(lambda: bool(self.segments)), timeout)
+                except asyncio.TimeoutError:
+                    return None
+
+        segments = list(self.segments)[-self.window:]
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{math.ceil(max(duration for _, duration, _ in segments))}",
+            f"#EXT-X-MEDIA-SEQUENCE:{segments[0][0]}",
+        ]
+        for sequence, duration, _ in segments:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(f"segment_{sequence}.ts")
+        return "\n".join(lines) + "\n"
+
+    def segment(self, sequence: int) -> Optional[bytes]:
+        """A segment's MPEG-TS data, or None if it has been forgotten (or never existed)."""
+        self._touch()
+        HLS_REQUESTS.inc(kind="segment")
+        for number, _, data in self.segments:
+            if number == sequence:
+                return data
+        return None
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _touch(self):
+        self._last_request = time.monotonic()
+        if self._task is None or self._task.done():
+            self.segments.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # Start from the cached GOP, so the first segment begins on a keyframe straight away
+        subscriber = self.stream.packets.subscribe(maxsize=120, replay=True)
+        HLS_RUNNING.set(1)
+        packets = []
+        try:
+            while time.monotonic() - self._last_request < self.idle_timeout:
+                try:
+                    packet = await asyncio.wait_for(subscriber.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    continue
+                if packet is None:
+                    break  # The stream stopped
+
+                # (a little slack, so timestamp jitter doesn't push a cut to the keyframe after)
+                if packet.is_keyframe and packets and (packet.pts - packets[0].pts) / PTS_CLOCK >= self.segment_seconds * 0.9:
+                    await self._cut(packets, packet.pts)
+                    packets = []
+                if packets or packet.is_keyframe:
+                    packets.append(packet)
+        finally:
+            subscriber.close()
+            HLS_RUNNING.set(0)
+            self._close_template()
+
+    async def _cut(self, packets, next_pts):
+        duration = (next_pts - packets[0].pts) / PTS_CLOCK
+        # Muxing is a copy of the packets, but keep it off the loop anyway
+        data = await asyncio.to_thread(self._mux, packets)
+        self._sequence += 1
+        self.segments.append((self._sequence, duration, data))
+        HLS_SEGMENTS.inc()
+        async with self._updated:
+            self._updated.notify_all()
+
+    def _close_template(self):
+        # Waits for a mux still running on its thread (e.g. from a cancelled _cut) to finish with it
+        with self._template_lock:
+            if self._template is not None:
+                self._template[1].close()
+                self._template = None
+
+    def _stream_template(self, keyframe):
+        # Called with the template lock held. Demux the segment's first keyframe (which carries the SPS/PPS) for a stream to copy the
+        # codec parameters from, so muxing never opens an encoder. Kept until the parameters change
+        data = bytes(keyframe)
+        parameter_sets = b"".join(unit for unit in split_nal_units(data) if nal_type(unit) in (NAL_SPS, NAL_PPS))
+        if self._template is None or self._template[0] != parameter_sets:
+            if self._template is not None:
+                self._template[1].close()
+            source = av.open(io.BytesIO(data), format="h264")
+            self._template = (parameter_sets, source, source.streams.video[0])
+        return self._template[2]
+
+    def _mux(self, packets) -> bytes:
+        # Packets are Annex B H.264, which MPEG-TS carries as is; timestamps carry on across segments
+        data = io.BytesIO()
+        container = av.open(data, "w", format="mpegts")
+        with self._template_lock:
+            template = self._stream_template(packets[0])
+            # (add_stream_from_template replaced add_stream(template=...) in newer PyAV)
+            add_stream_from_template = getattr(container, "add_stream_from_template", None)
+            video = add_stream_from_template(template) if add_stream_from_template else container.add_stream(template=template)
+        video.time_base = Fraction(1, PTS_CLOCK)
+        for packet in packets:
+            copy = av.Packet(bytes(packet))
+            copy.pts = copy.dts = packet.pts
+            copy.time_base = video.time_base
+            copy.is_keyframe = packet.is_keyframe
+            copy.stream = video
+            container.mux(copy)
+        container.close()
+        return data.getvalue()
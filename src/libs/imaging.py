@@ -0,0 +1,120 @@
+from io import BytesIO
+import threading
+import cv2
+import numpy as np
+import simplejpeg
+from PIL import Image
+
+# Constants
+# simplejpeg colorspace for a frame, by channel count (main stream frames are XBGR8888, i.e. [R, G, B, 255])
+COLORSPACES = {1: "GRAY", 3: "RGB", 4: "RGBX"}
+
+# Functions
+# Extract the luma (Y) plane from a frame, optionally subsampled
+def luma(frame, step=1):
+  # Subsample first so the conversion only touches the pixels we keep
+  frame = frame[::step, ::step]
+
+  # Already single-channel (Y only)
+  if frame.ndim == 2:
+    return frame.astype(np.float32)
+
+  # RGB(X) -> Y using the BT.601 weights
+  r = frame[:, :, 0].astype(np.float32)
+  g = frame[:, :, 1].astype(np.float32)
+  b = frame[:, :, 2].astype(np.float32)
+  return 0.299 * r + 0.587 * g + 0.114 * b
+
+# Score the sharpness of a frame as the variance of the Laplacian of its luma
+# (blurred frames have weak edges, so a low variance)
+def sharpness(frame, step=2):
+  y = luma(frame, step)
+
+  # 4-neighbour Laplacian over the interior pixels
+  laplacian = (
+    y[:-2, 1:-1] + y[2:, 1:-1] + y[1:-1, :-2] + y[1:-1, 2:]
+    - 4 * y[1:-1, 1:-1]
+  )
+  return float(laplacian.var())
+
+# Crop a frame to a region of interest given as fractions (x, y, width, height) of the frame
+def crop(frame, roi):
+  height, width = frame.shape[:2]
+  x, y, w, h = roi
+  x0, y0 = int(round(x * width)), int(round(y * height))
+  x1, y1 = int(round((x + w) * width)), int(round((y + h) * height))
+  return frame[max(0, y0):min(height, y1), max(0, x0):min(width, x1)]
+
+# Downscale a frame to fit within size (width, height), keeping its aspect ratio
+def resize_to_fit(frame, size):
+  height, width = frame.shape[:2]
+  scale = min(size[0] / width, size[1] / height)
+  if scale >= 1:
+    return frame # Never upscale
+  return cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+
+# Encode a frame to JPEG with simplejpeg (libjpeg-turbo)
+def encode_jpeg(frame, quality=90, subsampling="420", fastdct=True):
+  frame = _jpeg_input(frame)
+  colorspace = COLORSPACES[1 if frame.ndim == 2 else frame.shape[2]]
+  if colorspace == "GRAY":
+    subsampling = "Gray"
+  return BytesIO(simplejpeg.encode_jpeg(frame, quality=quality, colorspace=colorspace, colorsubsampling=subsampling, fastdct=fastdct))
+
+# Encode a frame to JPEG with PIL (the path Picamera2's request.save takes), kept for benchmarking
+def encode_jpeg_pil(frame, quality=90):
+  data = BytesIO()
+  Image.fromarray(np.ascontiguousarray(frame[:, :, :3])).save(data, format="jpeg", quality=quality)
+  return data
+
+_staging = threading.local() # Reusable staging buffer, per thread
+
+# simplejpeg only needs each row's pixels to be contiguous (so crops of a frame can be encoded in place);
+# anything else is copied into a staging buffer that is reused between calls
+def _jpeg_input(frame):
+  if frame.ndim == 3 and frame.shape[2] == 1:
+    frame = frame[:, :, 0]
+  pixel_contiguous = frame.strides[-1] == frame.itemsize and (frame.ndim == 2 or frame.strides[-2] == frame.shape[-1] * frame.itemsize)
+  if pixel_contiguous:
+    return frame
+
+  staging = getattr(_staging, "buffer", None)
+  if staging is None or staging.shape != frame.shape or staging.dtype != frame.dtype:
+    staging = _staging.buffer = np.empty(frame.shape, dtype=frame.dtype)
+  np.copyto(staging, frame)
+  return staging
+
+class CaptureProfile:
+  """
+  How a captured frame is prepared for classification: cropped to a region of interest,
+  downscaled to fit a target resolution and JPEG-encoded at a given quality, plus the
+  image "detail" level requested from the model.
+  """
+  def __init__(self, resolution=None, roi=None, quality=90, detail="auto", subsampling="420"):
+    if detail not in ("low", "high", "auto"):
+      raise ValueError(f"Unknown detail level: {detail}")
+    if subsampling not in ("444", "422", "420", "440", "411"):
+      raise ValueError(f"Unknown chroma subsampling: {subsampling}")
+
+    self.resolution = resolution # (width, height), or None to keep the captured resolution
+    self.roi = roi # (x, y, width, height) as fractions of the frame, or None for the whole frame
+    self.quality = quality
+    self.detail = detail
+    self.subsampling = subsampling # JPEG chroma subsampling
+
+  def crop(self, frame):
+    return crop(frame, self.roi) if self.roi is not None else frame
+
+  def apply(self, frame):
+    """Crop and downscale a frame (the result may be a view of the input)."""
+    frame = self.crop(frame)
+    if self.resolution is not None:
+      frame = resize_to_fit(frame, self.resolution)
+    return frame
+
+  def encode(self, frame):
+    """Encode an already-applied frame to JPEG."""
+    return encode_jpeg(frame, self.quality, self.subsampling)
+
+  def __repr__(self):
+    return f"CaptureProfile(resolution={self.resolution}, roi={self.roi}, quality={self.quality}, subsampling={self.subsampling}, detail={self.detail})"
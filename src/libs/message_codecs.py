@@ -0,0 +1,57 @@
+import json
+from typing import Callable, Dict, Optional, Sequence
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+"""
+Encodings of the WebSocket protocol's messages, negotiated per client
+"""
+
+class MessageCodec:
+    """
+    Encodes and decodes protocol messages for the wire. Binary codecs are sent as binary
+    frames; JSON is sent as text, as it always has been.
+    """
+    def __init__(self, name: str, encode: Callable[[dict], object], decode: Callable[[object], dict], binary: bool):
+        self.name = name
+        self.subprotocol = f"bloobin.{name}"
+        self.encode = encode
+        self.decode = decode
+        self.binary = binary
+
+    def __repr__(self):
+        return f"MessageCodec({self.name})"
+
+JSON = MessageCodec("json", json.dumps, json.loads, binary=False)
+
+# Codecs the server can speak (the binary ones only if their package is installed)
+CODECS: Dict[str, MessageCodec] = {}
+if msgpack is not None:
+    CODECS["msgpack"] = MessageCodec("msgpack", msgpack.packb, msgpack.unpackb, binary=True)
+if cbor2 is not None:
+    CODECS["cbor"] = MessageCodec("cbor", cbor2.dumps, cbor2.loads, binary=True)
+CODECS["json"] = JSON
+
+SUBPROTOCOLS = [codec.subprotocol for codec in CODECS.values()]
+
+## The codec for a name ("msgpack") or subprotocol ("bloobin.msgpack"), if the server has it
+def find_codec(name: Optional[str]) -> Optional[MessageCodec]:
+    if name is None:
+        return None
+    return CODECS.get(name.removeprefix("bloobin."))
+
+## Pick the codec for the subprotocols a client offered: the first it lists that the server has, JSON otherwise
+def negotiate(offered: Sequence[str]) -> MessageCodec:
+    for name in offered:
+        codec = find_codec(name)
+        if codec is not None:
+            return codec
+    return JSON
@@ -0,0 +1,327 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Set
+
+import av
+
+from libs.metrics import counter, gauge, histogram
+
+"""
+Fan-out of encoded packets from the encoder thread to asyncio consumers
+"""
+
+# H.264 NAL unit types
+NAL_SPS = 7
+NAL_PPS = 8
+
+START_CODE = b"\x00\x00\x00\x01"
+
+PTS_CLOCK = 90000  # Packet PTS are in 90 kHz units
+RATE_WINDOW = 2.0  # Seconds of packets the fps and bytes/s rates are averaged over
+
+STREAM_PACKETS = counter("bloobin_stream_packets_total", "Encoded video packets published", labels=("type",))
+STREAM_BYTES = counter("bloobin_stream_bytes_total", "Bytes of encoded video published")
+STREAM_DROPPED = counter("bloobin_stream_dropped_packets_total", "Packets dropped from full subscriber queues")
+STREAM_FPS = gauge("bloobin_stream_fps", "Encoded packets per second")
+STREAM_BYTES_RATE = gauge("bloobin_stream_bytes_per_second", "Encoded bytes per second")
+STREAM_SUBSCRIBERS = gauge("bloobin_stream_subscribers", "Consumers subscribed to the encoded packets")
+STREAM_QUEUE_DEPTH = gauge("bloobin_stream_queue_depth", "Packets waiting in the fullest subscriber queue")
+STREAM_JITTER = gauge("bloobin_stream_pts_jitter_seconds", "Smoothed jitter between packet PTS and arrival times (RFC 3550 estimator)")
+STREAM_LATENCY = histogram("bloobin_stream_packet_latency_seconds", "Time from the encoder publishing a packet to a consumer receiving it", buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+## Split an Annex B byte stream into its NAL units (without start codes)
+def split_nal_units(data: bytes) -> List[bytes]:
+    units = []
+    start = data.find(b"\x00\x00\x01")
+    while start != -1:
+        start += 3
+        end = data.find(b"\x00\x00\x01", start)
+        unit = data[start:end if end != -1 else len(data)]
+        # A 4-byte start code leaves a trailing zero on the previous unit
+        if end != -1 and unit.endswith(b"\x00"):
+            unit = unit[:-1]
+        if unit:
+            units.append(unit)
+        start = end
+    return units
+
+## The type of a NAL unit
+def nal_type(unit: bytes) -> int:
+    return unit[0] & 0x1F
+
+class PacketSubscriber:
+    """
+    A bounded asyncio queue of packets, owned by a single event loop.
+    When the queue overflows (a slow consumer), everything queued is dropped and packets are
+    skipped until the next keyframe, since the delta frames in between couldn't be decoded anyway.
+    """
+    def __init__(self, fanout: "PacketFanout", loop: asyncio.AbstractEventLoop, maxsize: int = 30):
+        self.fanout = fanout
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)  # (published_at, packet)
+        self.dropped = 0
+        self.overflows = 0
+        self._skipping = False  # Dropping packets until the next keyframe
+        self.latency = None  # Smoothed publish-to-get latency, in seconds
+        self.queued_bytes = 0  # Size of the packets waiting in the queue
+        self.closed = False
+
+    def _put(self, entry):
+        # Runs on the subscriber's loop
+        if self.closed:
+            return
+
+        keyframe = entry[1].is_keyframe
+        if self.queue.full():
+            # Drop everything queued, rather than keep sending a stream with holes in it
+            self.overflows += 1
+            self._drop(self.queue.qsize())
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queued_bytes = 0
+            self._skipping = True
+
+        if self._skipping:
+            if not keyframe:
+                self._drop(1)
+                return
+            self._skipping = False
+        self.queue.put_nowait(entry)
+        self.queued_bytes += entry[1].size
+
+    def _drop(self, count):
+        self.dropped += count
+        STREAM_DROPPED.inc(count)
+
+    def _replay(self, entries):
+        # Runs on the subscriber's loop, before any packet published after subscribing
+        for entry in entries:
+            self._put(entry)
+
+    def _close(self):
+        # Runs on the subscriber's loop; wakes any waiting consumer with the end-of-stream marker
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue.full():
+            self.queued_bytes -= self.queue.get_nowait()[1].size
+        self.queue.put_nowait(None)
+
+    async def get(self):
+        """
+        Wait for the next packet. Returns None once the subscriber (or the whole fan-out) is closed.
+        """
+        if self.closed and self.queue.empty():
+            return None
+        entry = await self.queue.get()
+        if entry is None:
+            return None
+
+        published_at, packet = entry
+        self.queued_bytes -= packet.size
+        latency = time.monotonic() - published_at
+        self.latency = latency if self.latency is None else self.latency + (latency - self.latency) / 16
+        STREAM_LATENCY.observe(latency)
+        return packet
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "queued_bytes": self.queued_bytes,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "latency": self.latency,
+        }
+
+    def close(self):
+        """Stop receiving packets. Must be called from the subscriber's loop."""
+        self.fanout.unsubscribe(self)
+        self._close()
+
+class PacketFanout:
+    """
+    Delivers every published packet to every subscriber. publish() is called from the
+    encoder thread and never blocks: packets are handed to each subscriber's loop with
+    call_soon_threadsafe, batching all subscribers of the same loop into a single callback.
+
+    The current GOP (the latest keyframe and the packets since) is cached, so a new
+    subscriber can start decoding straight away instead of waiting for the next keyframe.
+    """
+    def __init__(self, gop_limit: int = 120):
+        """
+        :param gop_limit: Most packets cached for one GOP; longer GOPs aren't replayed
+        """
+        self._lock = threading.Lock()
+        self._subscribers: Set[PacketSubscriber] = set()
+        self.closed = False
+
+        self.gop_limit = gop_limit
+        self._gop: List[tuple] = []  # (published_at, packet)
+        self._parameter_sets = b""  # SPS/PPS NAL units (with start codes) from the stream's headers
+
+        # Health of the encoded stream
+        self.packets = 0
+        self.keyframes = 0
+        self.bytes = 0
+        self.pts_jitter = 0.0
+        self._recent = deque()  # (published_at, size) within the rate window
+        self._recent_bytes = 0
+        self._last_pts = None
+        self._last_published_at = None
+
+        STREAM_FPS.set_function(lambda: self.stats()["fps"])
+        STREAM_BYTES_RATE.set_function(lambda: self.stats()["bytes_per_second"])
+        STREAM_SUBSCRIBERS.set_function(lambda: self.subscriber_count)
+        STREAM_QUEUE_DEPTH.set_function(lambda: self.stats()["queue_depth"])
+        STREAM_JITTER.set_function(lambda: self.pts_jitter)
+
+    def subscribe(self, maxsize: int = 30, loop: Optional[asyncio.AbstractEventLoop] = None, replay: bool = False) -> PacketSubscriber:
+        """
+        Create a subscriber on the given (default: running) loop.
+
+        :param replay: Start with the cached GOP, so the first packet received is a keyframe
+        """
+        loop = loop or asyncio.get_running_loop()
+        with self._lock:
+            gop = list(self._gop) if replay else []
+            # Room for the replayed GOP on top of the live packets
+            subscriber = PacketSubscriber(self, loop, maxsize + len(gop))
+            if self.closed:
+                subscriber.closed = True
+                return subscriber
+
+            self._subscribers.add(subscriber)
+            if gop:
+                # Scheduled under the lock, so it runs before any packet published after this
+                loop.call_soon_threadsafe(subscriber._replay, gop)
+        return subscriber
+
+    def unsubscribe(self, subscriber: PacketSubscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    @property
+    def gop_length(self) -> int:
+        """Packets in the cached GOP (0 until the first keyframe)."""
+        with self._lock:
+            return len(self._gop)
+
+    def publish(self, packet, keyframe: bool = False):
+        """Hand a packet to every subscriber. Safe to call from any thread."""
+        if keyframe:
+            packet = self._with_parameter_sets(packet)
+        published_at = time.monotonic()
+        entry = (published_at, packet)
+
+        with self._lock:
+            if keyframe:
+                self._gop = [entry]
+            elif self._gop:
+                if len(self._gop) < self.gop_limit:
+                    self._gop.append(entry)
+                else:
+                    self._gop = []  # Too long to replay; wait for the next keyframe
+            self._measure(packet, keyframe, published_at)
+            subscribers = list(self._subscribers)
+        self._dispatch(subscribers, PacketSubscriber._put, entry)
+
+    def close(self):
+        """Close every subscriber, waking their consumers with None."""
+        with self._lock:
+            self.closed = True
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+            self._gop = []
+        self._dispatch(subscribers, lambda subscriber, _: subscriber._close(), None)
+
+    def stats(self) -> dict:
+        """Encoded stream health: rates over the last few seconds, totals, and per-subscriber queues."""
+        with self._lock:
+            self._expire(time.monotonic())
+            span = self._recent[-1][0] - self._recent[0][0] if len(self._recent) > 1 else 0
+            fps = (len(self._recent) - 1) / span if span > 0 else 0.0
+            bytes_per_second = (self._recent_bytes - self._recent[0][1]) / span if span > 0 else 0.0
+            subscribers = [subscriber.stats() for subscriber in self._subscribers]
+            return {
+                "packets": self.packets,
+                "keyframes": self.keyframes,
+                "bytes": self.bytes,
+                "fps": fps,
+                "bytes_per_second": bytes_per_second,
+                "pts_jitter": self.pts_jitter,
+                "gop_length": len(self._gop),
+                "queue_depth": max((subscriber["queued"] for subscriber in subscribers), default=0),
+                "dropped": sum(subscriber["dropped"] for subscriber in subscribers),
+                "subscribers": subscribers,
+            }
+
+    def _measure(self, packet, keyframe, published_at):
+        # Called with the lock held
+        size = packet.size
+        self.packets += 1
+        self.keyframes += 1 if keyframe else 0
+        self.bytes += size
+        self._recent.append((published_at, size))
+        self._recent_bytes += size
+        self._expire(published_at)
+
+        # Jitter between the encoder's timestamps and when packets actually arrive
+        if packet.pts is not None:
+            if self._last_pts is not None:
+                transit = (packet.pts - self._last_pts) / PTS_CLOCK - (published_at - self._last_published_at)
+                self.pts_jitter += (abs(transit) - self.pts_jitter) / 16
+            self._last_pts = packet.pts
+            self._last_published_at = published_at
+
+        STREAM_PACKETS.inc(type="key" if keyframe else "delta")
+        STREAM_BYTES.inc(size)
+
+    def _expire(self, now):
+        # Called with the lock held
+        while self._recent and now - self._recent[0][0] > RATE_WINDOW:
+            _, size = self._recent.popleft()
+            self._recent_bytes -= size
+
+    def _with_parameter_sets(self, packet):
+        # Remember the SPS/PPS the encoder sends with its first keyframe, and put them in front
+        # of keyframes that arrive without them, so any keyframe can start a decoder
+        data = bytes(packet)
+        units = split_nal_units(data)
+        types = {nal_type(unit) for unit in units}
+        if NAL_SPS in types and NAL_PPS in types:
+            self._parameter_sets = b"".join(START_CODE + unit for unit in units if nal_type(unit) in (NAL_SPS, NAL_PPS))
+            return packet
+        if not self._parameter_sets:
+            return packet
+
+        prefixed = av.Packet(self._parameter_sets + data)
+        prefixed.pts = packet.pts
+        prefixed.dts = packet.dts
+        prefixed.time_base = packet.time_base
+        prefixed.is_keyframe = True
+        return prefixed
+
+    def _dispatch(self, subscribers, deliver, packet):
+        by_loop = {}
+        for subscriber in subscribers:
+            by_loop.setdefault(subscriber.loop, []).append(subscriber)
+
+        for loop, group in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(self._deliver, group, deliver, packet)
+            except RuntimeError:
+                # The subscriber's loop has been closed
+                for subscriber in group:
+                    self.unsubscribe(subscriber)
+
+    @staticmethod
+    def _deliver(group, deliver, packet):
+        for subscriber in group:
+            deliver(subscriber, packet)
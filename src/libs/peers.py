@@ -0,0 +1,190 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from aiortc import MediaStreamTrack, RTCPeerConnection
+
+from libs.metrics import counter, gauge
+
+"""
+Lifecycle of the WebRTC peer connections: caps, reaping and teardown
+"""
+
+PEERS = gauge("bloobin_webrtc_peers", "WebRTC peer connections, by connection state", labels=("state",))
+PEERS_REMOVED = counter("bloobin_webrtc_peers_removed_total", "WebRTC peer connections torn down, by reason", labels=("reason",))
+PEERS_REJECTED = counter("bloobin_webrtc_peers_rejected_total", "Offers turned away because the peer limit was reached")
+PEER_MEMORY = gauge("bloobin_webrtc_peer_memory_bytes", "Estimated buffer memory held for all peers (queued packets and retransmission history)")
+PROCESS_RSS = gauge("bloobin_process_resident_memory_bytes", "Resident memory of the process")
+
+CONNECTION_STATES = ("new", "connecting", "connected", "disconnected", "failed", "closed")
+
+# aiortc keeps each sender's sent RTP packets (for retransmission) in this private, name-mangled
+# attribute; it isn't part of its API, so memory estimates are reported as unknown without it
+RTP_HISTORY_ATTRIBUTE = "_RTCRtpSender__rtp_history"
+
+logger = logging.getLogger(__name__)
+
+## The process's resident memory in bytes (None where /proc isn't available)
+def resident_memory() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+## Sum of estimates, None if any of them is unknown
+def _total(values) -> Optional[int]:
+    values = list(values)
+    return None if None in values else sum(values)
+
+class Peer:
+    """
+    A peer connection and the tracks created for it, which are stopped with it
+    (releasing their relay or packet subscriptions).
+    """
+    def __init__(self, id: int, pc: RTCPeerConnection):
+        self.id = id
+        self.pc = pc
+        self.tracks: List[MediaStreamTrack] = []
+        self.created_at = time.monotonic()
+        self.state_changed_at = self.created_at
+
+    @property
+    def state(self) -> str:
+        return self.pc.connectionState
+
+    def memory(self) -> Optional[int]:
+        """
+        Estimate the buffer memory held for this peer: packets queued on its tracks plus
+        the RTP packets each sender keeps for retransmission. None (unknown) if the installed
+        aiortc doesn't keep the retransmission history where it used to.
+        """
+        total = sum(getattr(track, "queued_bytes", 0) for track in self.tracks)
+        for sender in self.pc.getSenders():
+            history = getattr(sender, RTP_HISTORY_ATTRIBUTE, None)
+            if history is None:
+                return None
+            total += sum(len(packet.payload) for packet in list(history.values()))
+        return total
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "id": self.id,
+            "state": self.state,
+            "age": now - self.created_at,
+            "in_state_for": now - self.state_changed_at,
+            "memory": self.memory(),
+        }
+
+class PeerManager:
+    """
+    Tracks every peer connection from offer to teardown. New peers are refused above
+    max_peers; peers that never connect, or that stay disconnected, are closed on a
+    deadline; and a closed peer's tracks are always stopped so nothing leaks.
+    """
+    def __init__(self, max_peers: int = 8, connect_timeout: float = 20.0, disconnect_timeout: float = 10.0, reap_interval: float = 5.0):
+        """
+        :param max_peers: Most peer connections open at once
+        :param connect_timeout: Seconds a new peer has to finish negotiation and ICE
+        :param disconnect_timeout: Seconds a disconnected peer has to recover
+        :param reap_interval: Seconds between checks for stuck peers
+        """
+        self.max_peers = max_peers
+        self.connect_timeout = connect_timeout
+        self.disconnect_timeout = disconnect_timeout
+        self.reap_interval = reap_interval
+
+        self.peers: Dict[RTCPeerConnection, Peer] = {}
+        self._ids = itertools.count(1)
+        self._reaper: Optional[asyncio.Task] = None
+
+        for state in CONNECTION_STATES:
+            PEERS.set_function(lambda state=state: self.count(state), state=state)
+        PEER_MEMORY.set_function(self.memory)
+        PROCESS_RSS.set_function(resident_memory)
+
+    @property
+    def full(self) -> bool:
+        return len(self.peers) >= self.max_peers
+
+    def count(self, state: str = None) -> int:
+        """Peers open, optionally only those in a given connection state."""
+        peers = list(self.peers.values())
+        if state is None:
+            return len(peers)
+        return sum(1 for peer in peers if peer.state == state)
+
+    def memory(self) -> Optional[int]:
+        """Estimated buffer memory held for all peers, or None if it can't be estimated."""
+        return _total(peer.memory() for peer in list(self.peers.values()))
+
+    def connections(self) -> List[RTCPeerConnection]:
+        return list(self.peers)
+
+    def add(self, pc: RTCPeerConnection) -> Optional[Peer]:
+        """
+        Manage a new peer connection, or return None (counting a rejection) if the limit is reached.
+        Must be called on the loop the peer runs on.
+        """
+        if self.full:
+            PEERS_REJECTED.inc()
+            return None
+
+        peer = Peer(next(self._ids), pc)
+        self.peers[pc] = peer
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange() -> None:
+            peer.state_changed_at = time.monotonic()
+            logger.info(f"Peer {peer.id} connection state is {pc.connectionState}")
+            if pc.connectionState in ("failed", "closed"):
+                await self.remove(peer, pc.connectionState)
+
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+        return peer
+
+    async def remove(self, peer: Peer, reason: str):
+        """Close a peer and stop its tracks. Safe to call more than once."""
+        if self.peers.pop(peer.pc, None) is None:
+            return
+        PEERS_REMOVED.inc(reason=reason)
+        logger.info(f"Removing peer {peer.id} ({reason}), {len(self.peers)} left")
+
+        for track in peer.tracks:
+            track.stop()
+        try:
+            await peer.pc.close()
+        except Exception as e:
+            logger.error(f"Error closing peer {peer.id}: {e}")
+
+    async def close_all(self):
+        await asyncio.gather(*(self.remove(peer, "shutdown") for peer in list(self.peers.values())))
+        if self._reaper is not None:
+            self._reaper.cancel()
+
+    def stats(self) -> dict:
+        peers = [peer.stats() for peer in list(self.peers.values())]
+        return {
+            "max_peers": self.max_peers,
+            "peers": len(peers),
+            "states": {state: sum(1 for peer in peers if peer["state"] == state) for state in CONNECTION_STATES},
+            "memory": _total(peer["memory"] for peer in peers),
+            "resident_memory": resident_memory(),
+            "per_peer": peers,
+        }
+
+    async def _reap(self):
+        # Runs while there are peers to watch
+        while self.peers:
+            await asyncio.sleep(self.reap_interval)
+            now = time.monotonic()
+            for peer in list(self.peers.values()):
+                if peer.state in ("new", "connecting") and now - peer.created_at > self.connect_timeout:
+                    await self.remove(peer, "connect_timeout")
+                elif peer.state == "disconnected" and now - peer.state_changed_at > self.disconnect_timeout:
+                    await self.remove(peer, "disconnect_timeout")
@@ -0,0 +1,220 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Set
+
+from libs import tracing
+from libs.metrics import counter, gauge
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_ITEMS = counter("bloobin_pipeline_items_total", "Items handled by each pipeline stage", labels=("stage", "outcome"))
+PIPELINE_QUEUED = gauge("bloobin_pipeline_queued_items", "Items waiting in each pipeline stage's queue", labels=("stage",))
+
+# Queue policies, applied when an item is handed to a stage whose queue is full
+POLICY_BLOCK = "block" # Wait for room (backpressure onto the previous stage)
+POLICY_DROP_NEWEST = "drop_newest" # Drop the incoming item
+POLICY_DROP_OLDEST = "drop_oldest" # Evict the oldest queued item to make room
+POLICIES = (POLICY_BLOCK, POLICY_DROP_NEWEST, POLICY_DROP_OLDEST)
+
+class ItemContext:
+  """
+  Per-item state carried through every stage of the pipeline.
+  Stages attach their outputs (e.g. the captured image) as attributes.
+  """
+  _ids = itertools.count(1)
+
+  def __init__(self, triggered_at: float = None, **values):
+    self.id = next(ItemContext._ids)
+    self.triggered_at = triggered_at if triggered_at is not None else time.monotonic() # Monotonic trigger time
+    self.completed_at = None
+    self.error: Optional[BaseException] = None
+    self.dropped_at: Optional[str] = None # Name of the stage the item was dropped at, if any
+    self.enqueued_at = None # When the item entered its current stage's queue
+    self.trace = tracing.Trace(self.id, self.triggered_at)
+    self.__dict__.update(values)
+
+  def __repr__(self):
+    return f"<ItemContext #{self.id}>"
+
+class Stage:
+  """
+  A single pipeline stage: an async handler run by a fixed number of workers,
+  fed from a bounded queue. A shielded stage's in-flight items finish even when the
+  pipeline is stopped (e.g. so a receptacle that was opened is always closed).
+  """
+  def __init__(self, name: str, handler: Callable[[ItemContext], Awaitable[None]], workers: int = 1, queue_size: int = 1, policy: str = POLICY_BLOCK, shield: bool = False):
+    if workers < 1:
+      raise ValueError("workers must be at least one")
+    if policy not in POLICIES:
+      raise ValueError(f"Unknown queue policy: {policy}")
+
+    self.name = name
+    self.handler = handler
+    self.workers = workers
+    self.queue_size = queue_size
+    self.policy = policy
+    self.shield = shield
+    self.queue: asyncio.Queue = None
+    self.processed = 0
+    self.failed = 0
+    self.dropped = 0
+
+  def stats(self) -> dict:
+    return {
+      "queued": self.queue.qsize() if self.queue else 0,
+      "processed": self.processed,
+      "failed": self.failed,
+      "dropped": self.dropped,
+    }
+
+class Pipeline:
+  """
+  Runs items through a chain of stages connected by bounded asyncio queues,
+  so consecutive items overlap (item N+1 can be captured while item N is being classified).
+  """
+  def __init__(self, stages: List[Stage], on_complete: Callable[[ItemContext], None] = None, on_drop: Callable[[ItemContext], None] = None):
+    """
+    :param on_complete: Called for every item that leaves the last stage or fails in any stage
+    :param on_drop: Called for every item dropped by a queue policy
+    """
+    if not stages:
+      raise ValueError("A pipeline needs at least one stage")
+
+    self.stages = stages
+    self.on_complete = on_complete
+    self.on_drop = on_drop
+    self.tasks: List[asyncio.Task] = []
+    self.shielded: Set[asyncio.Task] = set() # Handlers of shielded stages still running
+
+  @property
+  def running(self) -> bool:
+    return len(self.tasks) > 0
+
+  def start(self):
+    """Create the stage queues and worker tasks on the running loop."""
+    if self.running:
+      return
+
+    for index, stage in enumerate(self.stages):
+      stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+      PIPELINE_QUEUED.set_function(stage.queue.qsize, stage=stage.name)
+      for worker in range(stage.workers):
+        self.tasks.append(asyncio.create_task(self._worker(index), name=f"pipeline-{stage.name}-{worker}"))
+
+  async def stop(self):
+    """Cancel all workers, abandoning queued items and in-flight items of unshielded stages."""
+    for task in self.tasks:
+      task.cancel()
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+    self.tasks = []
+
+    # Wait for the shielded stages' in-flight items to finish
+    await asyncio.gather(*self.shielded, return_exceptions=True)
+
+  def submit(self, context: ItemContext) -> bool:
+    """
+    Hand an item to the first stage without waiting.
+    A full first stage behaves as drop_newest unless its policy is drop_oldest.
+    Returns False if the item was dropped.
+    """
+    stage = self.stages[0]
+    context.enqueued_at = time.monotonic()
+    if stage.policy == POLICY_DROP_OLDEST:
+      return self._put_drop_oldest(stage, context)
+
+    try:
+      stage.queue.put_nowait(context)
+      return True
+    except asyncio.QueueFull:
+      self._drop(stage, context)
+      return False
+
+  async def put(self, context: ItemContext) -> bool:
+    """Hand an item to the first stage, applying its queue policy. Returns False if it was dropped."""
+    return await self._enqueue(self.stages[0], context)
+
+  def stats(self) -> dict:
+    return {stage.name: stage.stats() for stage in self.stages}
+
+  async def _enqueue(self, stage: Stage, context: ItemContext) -> bool:
+    context.enqueued_at = time.monotonic()
+    if stage.policy == POLICY_BLOCK:
+      await stage.queue.put(context)
+      return True
+
+    if stage.policy == POLICY_DROP_OLDEST:
+      return self._put_drop_oldest(stage, context)
+
+    try:
+      stage.queue.put_nowait(context)
+      return True
+    except asyncio.QueueFull:
+      self._drop(stage, context)
+      return False
+
+  def _put_drop_oldest(self, stage: Stage, context: ItemContext) -> bool:
+    while True:
+      try:
+        stage.queue.put_nowait(context)
+        return True
+      except asyncio.QueueFull:
+        oldest = stage.queue.get_nowait()
+        stage.queue.task_done()
+        self._drop(stage, oldest)
+
+  def _drop(self, stage: Stage, context: ItemContext):
+    stage.dropped += 1
+    PIPELINE_ITEMS.inc(stage=stage.name, outcome="dropped")
+    context.dropped_at = stage.name
+    logger.warning(f"Pipeline stage '{stage.name}' full, dropped item #{context.id}")
+    if self.on_drop:
+      self.on_drop(context)
+
+  async def _worker(self, index: int):
+    stage = self.stages[index]
+    next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+
+    while True:
+      context = await stage.queue.get()
+      tracing.record(f"queue.{stage.name}", context.enqueued_at, time.monotonic(), context.trace)
+      try:
+        with tracing.activate(context.trace), tracing.span(f"stage.{stage.name}"):
+          if stage.shield:
+            await self._run_shielded(stage.handler(context))
+          else:
+            await stage.handler(context)
+        stage.processed += 1
+        PIPELINE_ITEMS.inc(stage=stage.name, outcome="processed")
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        stage.failed += 1
+        PIPELINE_ITEMS.inc(stage=stage.name, outcome="failed")
+        context.error = e
+        logger.error(f"Pipeline stage '{stage.name}' failed on item #{context.id}: {e}")
+        self._finish(context)
+        continue
+      finally:
+        stage.queue.task_done()
+
+      if next_stage is not None:
+        await self._enqueue(next_stage, context)
+      else:
+        self._finish(context)
+
+  async def _run_shielded(self, handler: Awaitable[None]):
+    # Run the handler in its own task, so cancelling the worker doesn't cancel it
+    task = asyncio.create_task(handler)
+    self.shielded.add(task)
+    task.add_done_callback(self.shielded.discard)
+    await asyncio.shield(task)
+
+  def _finish(self, context: ItemContext):
+    # Called once per item that left the pipeline, successfully (error is None) or not
+    context.completed_at = time.monotonic()
+    tracing.finish(context.trace, context.completed_at)
+    logger.info(context.trace.summary())
+    if self.on_complete:
+      self.on_complete(context)
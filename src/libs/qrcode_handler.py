@@ -58,9 +58,9 @@ class QRCodeDetector:
         # Check for cancellation
         await asyncio.sleep(0)  # Yield control to allow cancellation
         
-        # Capture a ByteIO image
-        frame = self.picam_stream.capture_array()  # numpy array
-        qr_codes = self.process_frame(frame)
+        # Capture a frame on the camera executor and decode it off the event loop
+        frame = await self.picam_stream.capture_array_async()  # numpy array
+        qr_codes = await asyncio.to_thread(self.process_frame, frame)
         # print(f"QR codes: {qr_codes}")
 
         # # Save the image
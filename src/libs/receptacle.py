@@ -1,6 +1,8 @@
+import libs.hardware # Selects the pin factory before the motor is created
 from gpiozero import Motor
 from time import sleep, time
-import asyncio, random
+import asyncio, random, threading
+from libs.tracing import span
 
 # 
 # GPIO Mappings
@@ -16,6 +18,7 @@ distance_travelled = 0 # Distance travelled by the motor from the close position
 start_time = None # Start time of the motor (in seconds) (used to calculate distance travelled)
 direction = "" # Direction of the motor (forward or backward) (used to calculate distance travelled)
 currentProcess = None
+motor_lock = threading.Lock() # Serialises movements now that they run off the event loop
 
 # Initialise the motor
 motor = Motor(22, 27)
@@ -81,8 +84,12 @@ def clearPreviousMovement():
   # Update the distance travelled
   update_distance()
 
-# Open the receptacle
+# Open the receptacle (blocks while the motor moves - run it off the event loop)
 def open_receptacle():
+  with motor_lock:
+    _open_receptacle()
+
+def _open_receptacle():
   # Stop any existing motor movement
   clearPreviousMovement()
 
@@ -100,8 +107,12 @@ def open_receptacle():
   # Open the receptacle
   move_motor("open", distance_to_travel)
 
-# Close the receptacle
+# Close the receptacle (blocks while the motor moves - run it off the event loop)
 def close_receptacle():
+  with motor_lock:
+    _close_receptacle()
+
+def _close_receptacle():
   # Stop any existing motor movement
   clearPreviousMovement()
 
@@ -140,13 +151,13 @@ async def countdown_receptacle(seconds, action):
     if (i % 2 != 0):
       # Open the receptacle
       print(f"[{random_number}] {action} in {seconds - i} (Opening)")
-      open_receptacle()
+      await asyncio.to_thread(open_receptacle)
       await asyncio.sleep(1)
 
     if (i % 2 == 0):
       # Close the receptacle
       print(f"[{random_number}] {action} in {seconds - i} (Closing)")
-      close_receptacle()
+      await asyncio.to_thread(close_receptacle)
       await asyncio.sleep(1)
 
 # Toggle the receptacle
@@ -160,7 +171,8 @@ async def toggle_receptacle():
 
   # Open the receptacle
   print(f"[{random_number}] Opening receptacle")
-  open_receptacle()
+  with span("receptacle.open"):
+    await asyncio.to_thread(open_receptacle)
   await asyncio.sleep(3)
 
   # Check if this is still the current process
@@ -171,7 +183,8 @@ async def toggle_receptacle():
   # It is still the current process
   # Close the receptacle
   print(f"[{random_number}] Closing receptacle")
-  close_receptacle()
+  with span("receptacle.close"):
+    await asyncio.to_thread(close_receptacle)
 
 # Initialises the motor by travelling to the closed position
 def init_motor():
@@ -0,0 +1,487 @@
+"""
+Simulated hardware backend, selected with HARDWARE_BACKEND=sim.
+
+Provides a scripted ultrasonic sensor and stand-ins for the parts of the
+picamera2/libcamera API that libs.camera uses, so the whole app (including
+the H.264 stream) runs and can be profiled on a plain Linux box.
+"""
+import os
+import random
+import threading
+import time
+from enum import IntEnum
+from fractions import Fraction
+from types import SimpleNamespace
+
+import av
+import cv2
+import numpy as np
+from PIL import Image
+
+from libs.detection import SampledDistanceSensor
+
+# Constants
+SIM_IMAGES_DIR = os.environ.get("SIM_IMAGES_DIR", "images") # Item images shown to the camera
+SIM_FRAMERATE = float(os.environ.get("SIM_FRAMERATE", 30)) # Camera frames per second
+SIM_ITEM_INTERVAL = float(os.environ.get("SIM_ITEM_INTERVAL", 8)) # Seconds between simulated items
+SIM_ITEM_DWELL = float(os.environ.get("SIM_ITEM_DWELL", 3)) # Seconds each item stays in the chamber
+SIM_ITEM_SETTLE = float(os.environ.get("SIM_ITEM_SETTLE", 0.3)) # Seconds an arriving item is motion-blurred for
+SIM_EMPTY_DISTANCE = 0.8 # Distance (in m) read with an empty chamber
+SIM_ITEM_DISTANCE = 0.15 # Distance (in m) read with an item in the chamber
+SIM_SENSOR_NOISE = float(os.environ.get("SIM_SENSOR_NOISE", 0.01)) # Standard deviation of the sensor noise (in m)
+SIM_SENSOR_SPIKES = float(os.environ.get("SIM_SENSOR_SPIKES", 0.02)) # Probability of a spurious echo reading
+SIM_SENSOR_RESOLUTION = (4608, 2592)
+SIM_AF_SCAN_TIME = float(os.environ.get("SIM_AF_SCAN_TIME", 0.2)) # Seconds a triggered autofocus scan takes
+
+"""
+Scripted scene shared by the simulated sensor and camera
+"""
+class SimulatedScene:
+    """
+    Items arrive every `interval` seconds and stay for `dwell` seconds.
+    Both the sensor and the camera read from the same schedule, so detections line up with frames.
+    """
+    def __init__(self, interval=SIM_ITEM_INTERVAL, dwell=SIM_ITEM_DWELL, settle=SIM_ITEM_SETTLE, images_dir=SIM_IMAGES_DIR):
+        self.interval = interval
+        self.dwell = min(dwell, interval)
+        self.settle = settle
+        self.started_at = time.monotonic()
+        self.images = self._load_images(images_dir)
+
+    def _load_images(self, images_dir):
+        images = []
+        if os.path.isdir(images_dir):
+            for file in sorted(os.listdir(images_dir)):
+                if file.endswith(".jpg") or file.endswith(".jpeg") or file.endswith(".png"):
+                    image = cv2.imread(os.path.join(images_dir, file))
+                    if image is not None:
+                        images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+        if not images:
+            # No item images available; draw a textured placeholder item instead
+            image = np.full((720, 1280, 3), 90, dtype=np.uint8)
+            cv2.rectangle(image, (480, 160), (800, 560), (40, 120, 200), -1)
+            for y in range(180, 540, 24):
+                cv2.line(image, (500, y), (780, y), (230, 230, 230), 2)
+            images.append(image)
+
+        print(f"Simulated scene using {len(images)} item image(s)")
+        return images
+
+    def state(self, now=None):
+        """
+        Return (item index, seconds since it arrived) for the item in the chamber,
+        or (None, None) if the chamber is empty.
+        """
+        elapsed = (now if now is not None else time.monotonic()) - self.started_at
+        cycle, phase = divmod(elapsed, self.interval)
+        arrives_at = self.interval - self.dwell
+        if phase < arrives_at:
+            return None, None
+        return int(cycle) % len(self.images), phase - arrives_at
+
+    def distance(self, now=None):
+        item, _ = self.state(now)
+        return SIM_EMPTY_DISTANCE if item is None else SIM_ITEM_DISTANCE
+
+_scene = None
+_scene_lock = threading.Lock()
+
+## Get the scene shared by every simulated device
+def get_scene():
+  global _scene
+  with _scene_lock:
+    if _scene is None:
+      _scene = SimulatedScene()
+    return _scene
+
+"""
+Simulated ultrasonic sensor
+"""
+class SimulatedDistanceSensor(SampledDistanceSensor):
+    """
+    SampledDistanceSensor (on gpiozero mock pins) whose readings come from the scene,
+    with gaussian noise and occasional spurious echoes.
+    """
+    def __init__(self, *args, scene=None, **kwargs):
+        # Set before the base class starts its sampling thread
+        self.scene = scene or get_scene()
+        super().__init__(*args, **kwargs)
+
+    def _measure(self):
+        if random.random() < SIM_SENSOR_SPIKES:
+            distance = random.uniform(0, self.max_distance)
+        else:
+            distance = self.scene.distance() + random.gauss(0, SIM_SENSOR_NOISE)
+        return min(1.0, max(0.0, distance) / self.max_distance)
+
+"""
+libcamera stand-ins
+"""
+class AfModeEnum(IntEnum):
+    Manual = 0
+    Auto = 1
+    Continuous = 2
+
+class AfRangeEnum(IntEnum):
+    Normal = 0
+    Macro = 1
+    Full = 2
+
+class AfSpeedEnum(IntEnum):
+    Normal = 0
+    Fast = 1
+
+class AfTriggerEnum(IntEnum):
+    Start = 0
+    Cancel = 1
+
+class AfStateEnum(IntEnum):
+    Idle = 0
+    Scanning = 1
+    Focused = 2
+    Failed = 3
+
+controls = SimpleNamespace(
+    AfModeEnum=AfModeEnum,
+    AfRangeEnum=AfRangeEnum,
+    AfSpeedEnum=AfSpeedEnum,
+    AfTriggerEnum=AfTriggerEnum,
+    AfStateEnum=AfStateEnum,
+)
+
+"""
+picamera2 stand-ins
+"""
+class Preview:
+    NULL = "null"
+    DRM = "drm"
+    QT = "qt"
+    QTGL = "qtgl"
+
+class Output:
+    """Mirrors picamera2.outputs.Output."""
+    def __init__(self, pts=None):
+        self.recording = False
+
+    def start(self):
+        self.recording = True
+
+    def stop(self):
+        self.recording = False
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=None):
+        pass
+
+class H264Encoder:
+    """Mirrors picamera2.encoders.H264Encoder; the simulated camera encodes with libx264 via PyAV."""
+    def __init__(self, bitrate=None, repeat=False, iperiod=None, framerate=None):
+        self.bitrate = bitrate
+        self.repeat = repeat
+        self.iperiod = iperiod
+        self.framerate = framerate
+
+class SimulatedRequest:
+    """Mirrors picamera2's CompletedRequest for a single simulated frame."""
+    def __init__(self, arrays, metadata):
+        self._arrays = arrays
+        self._metadata = metadata
+
+    def make_array(self, name):
+        return self._arrays[name].copy()
+
+    def get_metadata(self):
+        return dict(self._metadata)
+
+    def save(self, name, file_output, format=None):
+        array = self._arrays[name]
+        Image.fromarray(np.ascontiguousarray(array[:, :, :3])).save(file_output, format=format or "jpeg")
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+class MappedArray:
+    """Mirrors picamera2.MappedArray."""
+    def __init__(self, request, stream, reshape=True, write=True):
+        self._request = request
+        self._stream = stream
+        self.array = None
+
+    def __enter__(self):
+        self.array = self._request._arrays[self._stream]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.array = None
+
+class Picamera2:
+    """
+    Renders the scene into main/lores arrays at SIM_FRAMERATE and, while recording,
+    encodes the configured stream to H.264 and hands it to the output like the real encoder.
+    """
+    def __init__(self, camera_num=0):
+        self.scene = get_scene()
+        self.sensor_resolution = SIM_SENSOR_RESOLUTION
+        self.camera_controls = {
+            "AfMode": (0, 2, 2),
+            "AfRange": (0, 2, 0),
+            "AfSpeed": (0, 1, 0),
+            "AfTrigger": (0, 1, 0),
+        }
+        self.camera_config = None
+        self.controls = {}
+        self.post_callback = None
+        self._af_scan_until = None  # When the triggered autofocus scan finishes (None before a trigger)
+
+        self._encoder = None
+        self._output = None
+        self._codec = None
+        self._thread = None
+        self._running = False
+        self._condition = threading.Condition()
+        self._latest = None
+        self._sequence = 0
+        self._frame_cache = {}
+
+    def _stream_config(self, stream, default_size, default_format):
+        stream = dict(stream or {})
+        stream.setdefault("size", default_size)
+        stream.setdefault("format", default_format)
+        stream["size"] = tuple(stream["size"])
+        return stream
+
+    def create_video_configuration(self, main={}, lores=None, display="main", encode="main", buffer_count=6, **kwargs):
+        return {
+            "use_case": "video",
+            "main": self._stream_config(main, (1280, 720), "XBGR8888"),
+            "lores": self._stream_config(lores, (640, 480), "YUV420") if lores is not None else None,
+            "display": display,
+            "encode": encode,
+            "buffer_count": buffer_count,
+        }
+
+    def create_still_configuration(self, main={}, lores=None, display=None, buffer_count=1, **kwargs):
+        return {
+            "use_case": "still",
+            "main": self._stream_config(main, self.sensor_resolution, "BGR888"),
+            "lores": self._stream_config(lores, (640, 480), "YUV420") if lores is not None else None,
+            "display": display,
+            "encode": None,
+            "buffer_count": buffer_count,
+        }
+
+    def configure(self, config):
+        if self._running:
+            raise RuntimeError("Camera must be stopped before configuring")
+        self.camera_config = config
+        self._frame_cache = {}
+
+    def stream_configuration(self, name="main"):
+        return self.camera_config[name]
+
+    def set_controls(self, controls):
+        controls = dict(controls)
+        # AfTrigger is an action rather than a setting: start or cancel an autofocus scan
+        trigger = controls.pop("AfTrigger", None)
+        if trigger == AfTriggerEnum.Start:
+            self._af_scan_until = time.monotonic() + SIM_AF_SCAN_TIME
+        elif trigger == AfTriggerEnum.Cancel:
+            self._af_scan_until = None
+        self.controls.update(controls)
+
+    def _af_state(self, now, settling):
+        af_mode = self.controls.get("AfMode", AfModeEnum.Continuous)
+        if af_mode == AfModeEnum.Continuous:
+            return AfStateEnum.Scanning if settling else AfStateEnum.Focused
+        if af_mode == AfModeEnum.Auto and self._af_scan_until is not None:
+            return AfStateEnum.Scanning if now < self._af_scan_until else AfStateEnum.Focused
+        return AfStateEnum.Idle
+
+    def start_preview(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        if self._running:
+            return
+        if self.camera_config is None:
+            self.configure(self.create_video_configuration())
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="SimulatedCamera", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=2.0)
+        self._thread = None
+
+    def close(self):
+        self.stop_recording()
+
+    def start_encoder(self, encoder, output):
+        stream = self.camera_config[self.camera_config.get("encode") or "main"]
+        width, height = stream["size"]
+        framerate = encoder.framerate or SIM_FRAMERATE
+
+        codec = av.CodecContext.create("libx264", "w")
+        codec.width = width
+        codec.height = height
+        codec.pix_fmt = "yuv420p"
+        codec.time_base = Fraction(1, int(framerate))
+        codec.bit_rate = encoder.bitrate or 10_000_000
+        codec.gop_size = encoder.iperiod or int(framerate)
+        options = {"preset": "ultrafast", "tune": "zerolatency"}
+        if encoder.repeat:
+            options["x264-params"] = "repeat-headers=1"
+        codec.options = options
+        codec.open()
+
+        self._encoder = encoder
+        self._output = output
+        self._codec = codec
+        output.start()
+
+    def stop_encoder(self):
+        if self._output is not None:
+            self._output.stop()
+        self._encoder = None
+        self._output = None
+        self._codec = None
+
+    def start_recording(self, encoder, output, **kwargs):
+        self.start_encoder(encoder, output)
+        self.start()
+
+    def stop_recording(self):
+        self.stop()
+        self.stop_encoder()
+
+    def capture_request(self, wait=None, flush=None):
+        """Wait for the next frame and return it."""
+        if not self._running:
+            raise RuntimeError("Camera is not running")
+        with self._condition:
+            sequence = self._sequence
+            if not self._condition.wait_for(lambda: self._sequence > sequence, timeout=1.0):
+                raise TimeoutError("Simulated camera produced no frame")
+            return self._latest
+
+    def capture_array(self, name="main"):
+        return self.capture_request().make_array(name)
+
+    def capture_file(self, file_output, name="main", format="jpeg"):
+        self.capture_request().save(name, file_output, format=format)
+
+    def _render(self, stream_name, item, settling):
+        """Render (and cache) the scene for a stream; the arrays are shared and read-only."""
+        key = (stream_name, item, settling)
+        array = self._frame_cache.get(key)
+        if array is not None:
+            return array
+
+        stream = self.camera_config[stream_name]
+        width, height = stream["size"]
+        if item is None:
+            rgb = np.full((height, width, 3), 60, dtype=np.uint8)  # Empty chamber
+        else:
+            rgb = cv2.resize(self.scene.images[item], (width, height), interpolation=cv2.INTER_AREA)
+            if settling:
+                # Item still falling - blur it vertically
+                kernel = np.zeros((31, 31), dtype=np.float32)
+                kernel[:, 15] = 1 / 31
+                rgb = cv2.filter2D(rgb, -1, kernel)
+
+        if stream["format"] == "YUV420":
+            array = cv2.cvtColor(rgb, cv2.COLOR_RGB2YUV_I420)
+        elif stream["format"] in ("XBGR8888", "XRGB8888"):
+            # XBGR8888 is [R, G, B, 255] in memory, XRGB8888 is [B, G, R, 255]
+            order = rgb if stream["format"] == "XBGR8888" else rgb[:, :, ::-1]
+            array = np.dstack([order, np.full((height, width), 255, dtype=np.uint8)])
+        elif stream["format"] == "RGB888":
+            array = np.ascontiguousarray(rgb[:, :, ::-1])  # [B, G, R] in memory
+        else:
+            array = np.ascontiguousarray(rgb)
+
+        array.flags.writeable = False
+        self._frame_cache[key] = array
+        return array
+
+    def _run(self):
+        interval = 1 / SIM_FRAMERATE
+        next_frame = time.monotonic()
+        frame_index = 0
+
+        while self._running:
+            now = time.monotonic()
+            item, present_for = self.scene.state(now)
+            settling = item is not None and present_for < self.scene.settle
+
+            af_state = self._af_state(now, settling)
+            # Frames are blurred while the item is falling or the lens is hunting
+            blurred = settling or af_state == AfStateEnum.Scanning
+            arrays = {"main": self._render("main", item, blurred)}
+            if self.camera_config.get("lores") is not None:
+                arrays["lores"] = self._render("lores", item, blurred)
+
+            request = SimulatedRequest(arrays, {
+                "SensorTimestamp": time.monotonic_ns(),
+                "FrameDuration": int(interval * 1_000_000),
+                "AfState": af_state,
+                "AeLocked": not settling,
+            })
+
+            with self._condition:
+                self._latest = request
+                self._sequence += 1
+                self._condition.notify_all()
+
+            if self.post_callback is not None:
+                try:
+                    self.post_callback(request)
+                except Exception as e:
+                    print(f"Error in simulated post_callback: {e}")
+
+            if self._codec is not None:
+                self._encode(arrays, frame_index, now)
+
+            frame_index += 1
+            next_frame += interval
+            time.sleep(max(0.0, next_frame - time.monotonic()))
+
+    def _encode(self, arrays, frame_index, now):
+        stream_name = self.camera_config.get("encode") or "main"
+        array = arrays[stream_name]
+        codec = self._codec
+        output = self._output
+        if codec is None or output is None:
+            return
+
+        try:
+            if self.camera_config[stream_name]["format"] == "YUV420":
+                yuv = array.copy()
+                # Sweep a bar across the luma plane so the stream isn't static
+                height = codec.height
+                x = (frame_index * 8) % codec.width
+                yuv[:height, x:x + 8] = 235
+                frame = av.VideoFrame.from_ndarray(yuv, format="yuv420p")
+            else:
+                frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(array[:, :, :3]), format="rgb24").reformat(format="yuv420p")
+            frame.pts = frame_index
+            frame.time_base = codec.time_base
+
+            for packet in codec.encode(frame):
+                # Timestamps in microseconds, like the real encoder
+                output.outputframe(bytes(packet), packet.is_keyframe, int(now * 1_000_000))
+        except Exception as e:
+            print(f"Error in simulated encoder: {e}")
+
+## Stand-in for gptApi.is_recyclable with a simulated API latency (SIM_CLASSIFIER=1)
+def simulated_is_recyclable(imageBase64, binMode, detail="auto"):
+  time.sleep(max(0.0, random.gauss(float(os.environ.get("SIM_CLASSIFIER_LATENCY", 1.5)), 0.3)))
+  canBeRecycled = random.random() < 0.7
+  return canBeRecycled, "plastic", "" if canBeRecycled else "contaminated"
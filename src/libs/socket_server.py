@@ -1,11 +1,17 @@
 import asyncio
-import json
 import logging
 import threading
-from typing import Callable, Set
+import time
+from typing import Callable, Dict, Set
+from aiohttp import WSMsgType, web
 from websockets.asyncio.server import ServerConnection, serve
 from websockets.exceptions import ConnectionClosed, ConnectionClosedOK
+from libs.event_bus import EventBus
+from libs.message_codecs import CODECS, JSON, SUBPROTOCOLS, MessageCodec, find_codec, negotiate
+from libs.metrics import counter, gauge
 
+WEBSOCKET_CLIENTS = gauge("bloobin_websocket_clients", "Connected WebSocket clients")
+WEBSOCKET_EVICTIONS = counter("bloobin_websocket_evictions_total", "WebSocket clients disconnected for falling behind", labels=("reason",))
 
 logger = logging.getLogger(__name__)
 
@@ -14,57 +20,189 @@ logging.basicConfig(
   format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+class AiohttpConnection:
+  """Gives an aiohttp WebSocketResponse the send/close interface of a websockets connection, so both transports share the protocol handling."""
+
+  def __init__(self, websocket: web.WebSocketResponse, remote_address: str = None):
+    self.websocket = websocket
+    self.remote_address = remote_address
+    self.subprotocol = websocket.ws_protocol
+
+  async def send(self, message):
+    if self.websocket.closed:
+      raise ConnectionResetError("WebSocket is closed")
+    if isinstance(message, str):
+      await self.websocket.send_str(message)
+    else:
+      await self.websocket.send_bytes(message)
+
+  async def close(self, code: int = 1000, reason: str = ""):
+    await self.websocket.close(code=code, message=reason.encode())
+
+class ClientWriter:
+  """
+  Sends one client's messages from a bounded queue on its own task, so a slow client only
+  holds up itself. Messages are queued already encoded (in the client's codec); a client whose
+  queue fills up, or whose oldest message has waited longer than max_lag, is evicted.
+  """
+
+  def __init__(self, websocket, on_evict: Callable[[object, str], None], max_queue: int = 64, max_lag: float = 5.0, codec: MessageCodec = JSON):
+    self.websocket = websocket
+    self.on_evict = on_evict
+    self.codec = codec
+    self.batching = False  # Takes several events in one {"type": "batch"} frame (opted into with hello)
+    self.max_lag = max_lag
+    self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)  # (queued_at, payload)
+    self.task = asyncio.create_task(self._run())
+
+  def enqueue(self, payload) -> bool:
+    """Queue an encoded message. Returns False if the client is too far behind to take it."""
+    try:
+      self.queue.put_nowait((time.monotonic(), payload))
+      return True
+    except asyncio.QueueFull:
+      return False
+
+  def stop(self):
+    if self.task is not asyncio.current_task():
+      self.task.cancel()
+
+  async def _run(self):
+    while True:
+      queued_at, payload = await self.queue.get()
+      if time.monotonic() - queued_at > self.max_lag:
+        self.on_evict(self.websocket, "lag")
+        return
+      try:
+        await self.websocket.send(payload)
+      except (ConnectionClosed, ConnectionClosedOK, ConnectionResetError):
+        self.on_evict(self.websocket, None)
+        return
+      except Exception as e:
+        logger.error(f"Error sending message: {e}")
+        self.on_evict(self.websocket, None)
+        return
+
 class WebSocketServer:
   
-  def __init__(self, host: str = "0.0.0.0", port: int = 8765, start_qr_scanning: Callable[[], None] = None, stop_qr_scanning: Callable[[], None] = None, start_processing_recycle: Callable[[], None] = None, stop_processing_recycle: Callable[[], None] = None):
+  def __init__(self, host: str = "0.0.0.0", port: int = 8765, start_qr_scanning: Callable[[], None] = None, stop_qr_scanning: Callable[[], None] = None, start_processing_recycle: Callable[[], None] = None, stop_processing_recycle: Callable[[], None] = None, send_queue_size: int = 64, max_send_lag: float = 5.0, event_bus: EventBus = None):
+    """
+    :param send_queue_size: Messages a client can fall behind by before it is evicted
+    :param max_send_lag: Seconds a message can wait to be sent before its client is evicted
+    :param event_bus: An EventBus whose events are broadcast to every client (delivered on the server's loop)
+    """
     self.host = host
     self.port = port
+    self.send_queue_size = send_queue_size
+    self.max_send_lag = max_send_lag
     self.clients: Set[ServerConnection] = set()
+    self.writers: Dict[ServerConnection, ClientWriter] = {}
     self.running = False
     self.start_qr_scanning = start_qr_scanning
     self.stop_qr_scanning = stop_qr_scanning
     self.start_processing_recycle = start_processing_recycle
     self.stop_processing_recycle = stop_processing_recycle
     self.server_thread = None
+    self.loop = None  # The loop the server and its connections run on
+    self.event_bus = event_bus
+    if event_bus is not None:
+      event_bus.subscribe(self.broadcast_events)
+    WEBSOCKET_CLIENTS.set_function(lambda: len(self.clients))
 
   async def register_client(self, websocket: ServerConnection):
     """Register a new client connection."""
     self.clients.add(websocket)
+    # Clients that negotiated a subprotocol get its codec; the rest start on JSON (and can say hello to switch)
+    codec = find_codec(getattr(websocket, "subprotocol", None)) or JSON
+    self.writers[websocket] = ClientWriter(websocket, self._evict, max_queue=self.send_queue_size, max_lag=self.max_send_lag, codec=codec)
     logger.info(f"Client connected. Total clients: {len(self.clients)}")
   
   async def unregister_client(self, websocket: ServerConnection):
     """Unregister a client connection."""
+    self._remove_client(websocket)
+
+  def _remove_client(self, websocket: ServerConnection):
+    writer = self.writers.pop(websocket, None)
+    if writer is not None:
+      writer.stop()
     if websocket in self.clients:
       self.clients.discard(websocket)
       logger.info(f"Client disconnected. Total clients: {len(self.clients)}")
-  
-  async def send_message(self, websocket: ServerConnection, message: dict):
-    """Send a message to a specific client."""
+
+  def _evict(self, websocket: ServerConnection, reason: str = None):
+    """Drop a client that can't keep up (or whose connection failed); reason is None for the latter."""
+    if websocket not in self.clients:
+      return
+    if reason is not None:
+      WEBSOCKET_EVICTIONS.inc(reason=reason)
+      logger.warning(f"Evicting WebSocket client {getattr(websocket, 'remote_address', '')}: too far behind ({reason})")
+    self._remove_client(websocket)
+    # A client that fell behind broke the policy; one whose send failed hit an error on our side
+    code, message = (1008, "Too slow") if reason is not None else (1011, "Send failed")
+    asyncio.create_task(self._close_client(websocket, code, message))
+
+  async def _close_client(self, websocket: ServerConnection, code: int, reason: str):
     try:
-      await websocket.send(json.dumps(message))
-    except (ConnectionClosed, ConnectionClosedOK):
-      await self.unregister_client(websocket)
+      await websocket.close(code, reason)
     except Exception as e:
-      logger.error(f"Error sending message: {e}")
-      await self.unregister_client(websocket)
+      logger.error(f"Error closing client connection: {e}")
+
+  def _codec(self, websocket: ServerConnection) -> MessageCodec:
+    writer = self.writers.get(websocket)
+    return writer.codec if writer is not None else JSON
+
+  def _enqueue(self, websocket: ServerConnection, payload):
+    writer = self.writers.get(websocket)
+    if writer is not None and not writer.enqueue(payload):
+      self._evict(websocket, "queue")
+  
+  async def send_message(self, websocket: ServerConnection, message: dict):
+    """Send a message to a specific client (queued behind anything already being sent to it)."""
+    self._enqueue(websocket, self._codec(websocket).encode(message))
   
   async def broadcast_message(self, message: dict, exclude: ServerConnection = None):
-    """Broadcast a message to all connected clients."""
-    disconnected_clients = set()
-    
-    for client in self.clients:
+    """Broadcast a message to all connected clients. Safe to await from any event loop."""
+    # Connections can only be written from the loop that owns them
+    if self.loop is not None and self.loop is not asyncio.get_running_loop():
+      future = asyncio.run_coroutine_threadsafe(self.broadcast_message(message, exclude), self.loop)
+      await asyncio.wrap_future(future)
+      return
+    self._broadcast(message, exclude)
+
+  def broadcast_events(self, events: list):
+    """
+    Broadcast a batch of events from the event bus (called on the server's loop). A single event
+    is sent as is; several go out in one frame as {"type": "batch", "events": [...]} to clients
+    that opted in with hello, and one by one to the rest.
+    """
+    if len(events) == 1:
+      self._broadcast(events[0])
+      return
+
+    # Encode once per codec and framing in use
+    payloads = {}
+    for client in list(self.clients):
+      writer = self.writers.get(client)
+      if writer is None:
+        continue
+      key = (writer.codec.name, writer.batching)
+      if key not in payloads:
+        if writer.batching:
+          payloads[key] = [writer.codec.encode({'type': 'batch', 'events': events})]
+        else:
+          payloads[key] = [writer.codec.encode(event) for event in events]
+      for payload in payloads[key]:
+        self._enqueue(client, payload)
+
+  def _broadcast(self, message: dict, exclude: ServerConnection = None):
+    # Encode once per codec in use, then hand the payload to each client's writer without waiting on any of them
+    payloads = {}
+    for client in list(self.clients):
       if client != exclude:
-        try:
-          await client.send(json.dumps(message))
-        except (ConnectionClosed, ConnectionClosedOK):
-          disconnected_clients.add(client)
-        except Exception as e:
-          logger.error(f"Error broadcasting to client: {e}")
-          disconnected_clients.add(client)
-    
-    # Clean up disconnected clients
-    for client in disconnected_clients:
-      await self.unregister_client(client)
+        codec = self._codec(client)
+        if codec.name not in payloads:
+          payloads[codec.name] = codec.encode(message)
+        self._enqueue(client, payloads[codec.name])
   
   async def handle_client(self, websocket: ServerConnection):
     """Handle individual client connections."""
@@ -72,28 +210,54 @@ class WebSocketServer:
     
     try:
       async for message in websocket:
-        try:
-          data = json.loads(message)
-          await self.process_message(websocket, data)
-          
-        except json.JSONDecodeError:
-          await self.send_message(websocket, {
-            'type': 'error',
-            'message': 'Invalid JSON format'
-          })
-        except Exception as e:
-          logger.error(f"Error processing message: {e}")
-          await self.send_message(websocket, {
-            'type': 'error',
-            'message': 'Internal server error'
-          })
-          
+        await self.handle_message(websocket, message)
     except (ConnectionClosed, ConnectionClosedOK):
       pass
     except Exception as e:
       logger.error(f"Error in client handler: {e}")
     finally:
       await self.unregister_client(websocket)
+
+  async def handle_aiohttp(self, request: web.Request) -> web.WebSocketResponse:
+    """Handle a client connecting through an aiohttp route (e.g. /ws on the WebRTC app)."""
+    if self.loop is None:
+      self._set_loop(asyncio.get_running_loop())
+
+    websocket = web.WebSocketResponse(heartbeat=20, protocols=SUBPROTOCOLS)
+    await websocket.prepare(request)
+    connection = AiohttpConnection(websocket, request.remote)
+    await self.register_client(connection)
+
+    try:
+      async for message in websocket:
+        if message.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+          await self.handle_message(connection, message.data)
+        elif message.type == WSMsgType.ERROR:
+          logger.error(f"WebSocket connection error: {websocket.exception()}")
+    except Exception as e:
+      logger.error(f"Error in client handler: {e}")
+    finally:
+      await self.unregister_client(connection)
+    return websocket
+
+  async def handle_message(self, websocket, message):
+    """Decode and process a single message from a client (text is always JSON, binary is in the client's codec)."""
+    codec = self._codec(websocket) if isinstance(message, (bytes, bytearray)) else JSON
+    try:
+      data = codec.decode(message)
+      await self.process_message(websocket, data)
+
+    except ValueError:
+      await self.send_message(websocket, {
+        'type': 'error',
+        'message': f'Invalid {codec.name.upper()} format'
+      })
+    except Exception as e:
+      logger.error(f"Error processing message: {e}")
+      await self.send_message(websocket, {
+        'type': 'error',
+        'message': 'Internal server error'
+      })
   
   async def process_message(self, websocket: ServerConnection, data: dict):
     """Process incoming messages based on their type."""
@@ -106,6 +270,28 @@ class WebSocketServer:
         'type': 'pong'
       })
 
+    elif message_type == 'hello':
+      # Switch the client's codec (and opt in or out of batched events); the reply is the last message in the old codec
+      codec = find_codec(data.get('codec', 'json'))
+      if codec is None:
+        await self.send_message(websocket, {
+          'type': 'error',
+          'message': f"Unsupported codec: {data.get('codec')}",
+          'codecs': list(CODECS)
+        })
+      else:
+        writer = self.writers.get(websocket)
+        if writer is not None and 'batch' in data:
+          writer.batching = bool(data['batch'])
+        await self.send_message(websocket, {
+          'type': 'hello',
+          'codec': codec.name,
+          'codecs': list(CODECS),
+          'batch': writer is not None and writer.batching
+        })
+        if writer is not None:
+          writer.codec = codec
+
     elif message_type == 'start_qr_scanning':
       logger.info("Received start_qr_scanning request")
       if self.start_qr_scanning:
@@ -197,11 +383,26 @@ class WebSocketServer:
       # Blocking mode (default behavior)
       await self._run_server_in_thread()
 
-  async def _run_server_in_thread(self):
-    """Internal method to run the server (used by both threaded and non-threaded modes)."""
-    self.server = await serve(self.handle_client, self.host, self.port)
+  async def listen(self):
+    """Start the server on the running event loop, returning once it is listening."""
+    self._set_loop(asyncio.get_running_loop())
+    self.server = await serve(self.handle_client, self.host, self.port, select_subprotocol=self._select_subprotocol)
     self.running = True
     logger.info(f"WebSocket server started on ws://{self.host}:{self.port}")
+
+  def _set_loop(self, loop: asyncio.AbstractEventLoop):
+    self.loop = loop
+    if self.event_bus is not None:
+      self.event_bus.attach(loop)
+
+  def _select_subprotocol(self, connection: ServerConnection, offered):
+    # Agree on a codec if the client offers one we have, otherwise carry on without a subprotocol (JSON)
+    codec = negotiate(offered)
+    return codec.subprotocol if codec.subprotocol in offered else None
+
+  async def _run_server_in_thread(self):
+    """Internal method to run the server (used by both threaded and non-threaded modes)."""
+    await self.listen()
     await self.server.serve_forever()
   
   async def stop_server(self):
@@ -214,6 +415,8 @@ class WebSocketServer:
       await self.server.wait_closed()
     
     # Close all client connections
+    for writer in list(self.writers.values()):
+      writer.stop()
     for client in list(self.clients):
       try:
         await client.close(1000, "Server shutting down")
@@ -0,0 +1,85 @@
+"""
+Per-item latency tracing. Spans are timed with the monotonic clock, feed the
+span duration histogram served from /metrics, and are attached to the item's
+Trace when one is active in the current context.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from libs.metrics import histogram
+
+# Constants
+RECENT_TRACES = 50 # Number of completed traces kept for inspection
+
+SPAN_SECONDS = histogram("bloobin_span_duration_seconds", "Duration of traced operations", labels=("span",))
+
+class Span:
+    def __init__(self, name: str, start: float, end: float):
+        self.name = name
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+class Trace:
+    """
+    The spans recorded for a single item, relative to its trigger time.
+    Spans can be added from any thread.
+    """
+    def __init__(self, item_id: int, started_at: float = None):
+        self.item_id = item_id
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float):
+        with self._lock:
+            self.spans.append(Span(name, start, end))
+
+    def summary(self) -> str:
+        """One-line summary of every span, as offset from the trigger + duration."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        parts = [f"{span.name}=+{(span.start - self.started_at) * 1000:.0f}ms/{span.duration * 1000:.0f}ms" for span in spans]
+        return f"Item #{self.item_id}: " + " ".join(parts)
+
+# The trace of the item currently being worked on (copied into to_thread workers automatically)
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+recent_traces = deque(maxlen=RECENT_TRACES)
+
+def record(name: str, start: float, end: float, trace: Trace = None):
+    """Record a span that has already finished."""
+    SPAN_SECONDS.observe(end - start, span=name)
+    trace = trace if trace is not None else current_trace.get()
+    if trace is not None:
+        trace.add(name, start, end)
+
+@contextmanager
+def span(name: str, trace: Trace = None):
+    """Time the enclosed block as a span."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, start, time.monotonic(), trace)
+
+@contextmanager
+def activate(trace: Optional[Trace]):
+    """Make the trace current for the enclosed block."""
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+def finish(trace: Trace, end: float = None):
+    """Record the item's total latency and keep the trace for inspection."""
+    record("item.total", trace.started_at, end if end is not None else time.monotonic(), trace)
+    recent_traces.append(trace)
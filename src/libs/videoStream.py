@@ -18,14 +18,22 @@ from aiortc import (
     RTCSessionDescription,
 )
 from aiortc.contrib.media import MediaPlayer, MediaRelay
+from libs.metrics import REGISTRY
+from libs.adaptation import AdaptationController, build_ladder
+from libs.hls import HlsSegmenter
+from libs.peers import PeerManager
 # from libs.camera import PiCameraStream
 
 ROOT = os.path.dirname(__file__)
 args = None
-pcs = set()
+peers = None
 relay = None
 webcam = None
 track = None
+hls = None
+
+# Seconds between reading viewers' receiver reports to adapt the stream
+ADAPT_INTERVAL = 2.0
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -81,6 +89,10 @@ def create_local_tracks() -> tuple[Optional[MediaStreamTrack], Optional[MediaStr
     
     # Only try to subscribe if we have a track
     if track is not None:
+        # Streams that can replay their latest GOP give each viewer its own track,
+        # so a viewer joining mid-GOP starts on a keyframe
+        if hasattr(track, "subscribe"):
+            return None, track.subscribe()
         return None, relay.subscribe(track)
     else:
         logger.warning("No video track available - server will run without video streaming")
@@ -95,6 +107,19 @@ def force_codec(pc: RTCPeerConnection, sender: RTCRtpSender, forced_codec: str)
         [codec for codec in codecs if codec.mimeType == forced_codec]
     )
 
+"""
+Get the manager of the WebRTC peer connections, configured from the CLI args
+"""
+def get_peers() -> PeerManager:
+    global peers
+    if peers is None:
+        peers = PeerManager(
+            max_peers=getattr(args, "max_peers", 8),
+            connect_timeout=getattr(args, "peer_connect_timeout", 20.0),
+            disconnect_timeout=getattr(args, "peer_disconnect_timeout", 10.0),
+        )
+    return peers
+
 """
 Serve the WebRTC player
 """
@@ -106,22 +131,29 @@ async def index(request: web.Request) -> web.Response:
 Handle the WebRTC offer
 """
 async def offer(request: web.Request) -> web.Response:
+    manager = get_peers()
+    peer = None
     try:
         params = await request.json()
         offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
-        pc = RTCPeerConnection()
-        pcs.add(pc)
-
-        @pc.on("connectionstatechange")
-        async def on_connectionstatechange() -> None:
-            logger.info("Connection state is %s" % pc.connectionState)
-            if pc.connectionState == "failed":
-                await pc.close()
-                pcs.discard(pc)
+        # The manager closes the connection and stops its tracks however it ends
+        peer = manager.add(RTCPeerConnection())
+        if peer is None:
+            logger.warning(f"Refusing offer: {manager.max_peers} peers already connected")
+            return web.Response(
+                content_type="application/json",
+                text=json.dumps({"error": "Too many viewers, try again later"}),
+                status=503
+            )
+        pc = peer.pc
 
         # open media source
         audio, video = create_local_tracks()
+        peer.tracks.extend(t for t in (audio, video) if t is not None)
+
+        # The viewer's track starts with the cached GOP, so it decodes straight away without a fresh
+        # keyframe (picamera2's H264Encoder can't force one; the GOP is bounded by the stream's iperiod)
 
         # Only add tracks if they exist
         if audio:
@@ -160,6 +192,8 @@ async def offer(request: web.Request) -> web.Response:
         )
     except Exception as e:
         logger.error(f"Error in offer handler: {e}")
+        if peer is not None:
+            await manager.remove(peer, "error")
         # Return a proper error response instead of crashing
         return web.Response(
             content_type="application/json",
@@ -167,15 +201,126 @@ async def offer(request: web.Request) -> web.Response:
             status=500
         )
 
+"""
+Serve metrics in the Prometheus text exposition format
+"""
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+"""
+Get the HLS segmenter shared by every HTTP viewer, if the stream has encoded packets to remux
+"""
+def get_hls() -> Optional[HlsSegmenter]:
+    global hls
+    if hls is None and track is not None and hasattr(track, "packets"):
+        hls = HlsSegmenter(track)
+    return hls
+
+"""
+Serve the live HLS playlist
+"""
+async def hls_playlist(request: web.Request) -> web.Response:
+    segmenter = get_hls()
+    if segmenter is None:
+        return web.Response(status=404, text="No HLS stream available")
+
+    playlist = await segmenter.playlist()
+    if playlist is None:
+        return web.Response(status=503, text="HLS stream is starting")
+    return web.Response(
+        text=playlist,
+        content_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+"""
+Serve an HLS segment
+"""
+async def hls_segment(request: web.Request) -> web.Response:
+    segmenter = get_hls()
+    try:
+        sequence = int(request.match_info["sequence"])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+    data = segmenter.segment(sequence) if segmenter is not None else None
+    if data is None:
+        raise web.HTTPNotFound()
+    return web.Response(body=data, content_type="video/mp2t", headers={"Cache-Control": "max-age=60"})
+
+"""
+Serve the video stream's health as JSON
+"""
+async def stats(request: web.Request) -> web.Response:
+    if track is None or not hasattr(track, "stats"):
+        return web.json_response({"error": "No stream statistics available"}, status=404)
+    return web.json_response(track.stats())
+
+"""
+Serve the WebRTC peer connections' states and memory as JSON
+"""
+async def peer_stats(request: web.Request) -> web.Response:
+    return web.json_response(get_peers().stats())
+
+"""
+Collect the (fraction lost, round-trip time) each connected viewer reports for its video
+"""
+async def collect_receiver_reports() -> list:
+    reports = []
+    for pc in get_peers().connections():
+        if pc.connectionState != "connected":
+            continue
+        try:
+            report = await pc.getStats()
+        except Exception as e:
+            logger.debug(f"Failed to read peer stats: {e}")
+            continue
+        for stat in report.values():
+            if stat.type == "remote-inbound-rtp" and stat.kind == "video":
+                # RTCP carries the fraction lost as an 8-bit fixed point number
+                reports.append((stat.fractionLost / 256, stat.roundTripTime))
+    return reports
+
+"""
+Step the stream's bitrate and resolution with the viewers' receiver reports
+"""
+async def adapt_stream(stream) -> None:
+    controller = AdaptationController(build_ladder(stream.size, stream.bitrate))
+    while True:
+        await asyncio.sleep(ADAPT_INTERVAL)
+        change = controller.update(await collect_receiver_reports())
+        if change is None:
+            continue
+
+        size, bitrate = change
+        logger.info(f"Adapting stream to {size[0]}x{size[1]} @ {bitrate / 1e6:.1f} Mbps")
+        try:
+            await asyncio.to_thread(stream.reconfigure, size=size, bitrate=bitrate)
+        except Exception as e:
+            logger.error(f"Failed to adapt stream: {e}")
+
+"""
+Start adapting the stream once the server is running, if the stream supports it
+"""
+async def on_startup(app: web.Application) -> None:
+    if track is not None and hasattr(track, "reconfigure") and not getattr(args, "no_adaptation", False):
+        app["adaptation"] = asyncio.create_task(adapt_stream(track))
+
 """
 WebRTC shutdown handler
 """
 async def on_shutdown(app: web.Application) -> None:
     logger.info("Shutting down WebRTC server...")
-    # Close peer connections.
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
-    pcs.clear()
+    if "adaptation" in app:
+        app["adaptation"].cancel()
+    if hls is not None:
+        hls.stop()
+    # Close peer connections, stopping their tracks.
+    if peers is not None:
+        await peers.close_all()
 
     # If a shared webcam was opened, stop it.
     if webcam is not None:
@@ -221,6 +366,26 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--video-codec", help="Force a specific video codec (e.g. video/H264)"
     )
+    parser.add_argument(
+        "--no-adaptation",
+        help="Keep the stream's bitrate and resolution fixed instead of adapting them to viewers' receiver reports",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-peers", type=int, default=8, help="Most viewers connected at once (default: 8)"
+    )
+    parser.add_argument(
+        "--peer-connect-timeout",
+        type=float,
+        default=20.0,
+        help="Seconds a viewer has to finish connecting before it is dropped (default: 20)",
+    )
+    parser.add_argument(
+        "--peer-disconnect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds a disconnected viewer has to reconnect before it is dropped (default: 10)",
+    )
 
     return parser.parse_args()
 
@@ -236,14 +401,10 @@ async def _run_app_in_thread(app, host, port, ssl_context):
     await asyncio.Event().wait()  # keep running
 
 """
-Start the WebRTC server.
-
-:param serve_player: Whether to serve the index.html page
-:param stream_args: Optional dict of overrides for CLI args (e.g. resolution, video_codec)
-:param threaded: If True, run in a separate thread
-:param stream: The stream to use for the WebRTC server
+Configure the server from the CLI args and stream_args, and create the aiohttp app.
+Returns the app and its SSL context (None for plain HTTP).
 """
-def start_stream(serve_player=False, stream_args: Optional[Dict[str, Any]] = None, threaded: bool = False, stream: MediaStreamTrack | None = None):
+def create_app(serve_player=False, stream_args: Optional[Dict[str, Any]] = None, stream: MediaStreamTrack | None = None, websocket_server=None):
     global args, track
 
     # Parse CLI args if not already set
@@ -274,8 +435,21 @@ def start_stream(serve_player=False, stream_args: Optional[Dict[str, Any]] = Non
 
     # Create the aiohttp app
     app = web.Application()
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     app.router.add_post("/offer", offer)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/peers", peer_stats)
+    if websocket_server is not None:
+        # The kiosk's command/event protocol, on the same port as the stream
+        app.router.add_get("/ws", websocket_server.handle_aiohttp)
+
+        async def close_websockets(app: web.Application) -> None:
+            await websocket_server.stop_server()
+        app.on_shutdown.append(close_websockets)
+    app.router.add_get("/hls/stream.m3u8", hls_playlist)
+    app.router.add_get("/hls/segment_{sequence}.ts", hls_segment)
     if serve_player:
         app.router.add_get("/", index)
 
@@ -293,6 +467,38 @@ def start_stream(serve_player=False, stream_args: Optional[Dict[str, Any]] = Non
     if stream is not None:
         track = stream
 
+    return app, ssl_context
+
+"""
+Start the WebRTC server on the running event loop, returning once it is listening.
+The caller owns the loop; clean up with `await runner.cleanup()`.
+
+:param serve_player: Whether to serve the index.html page
+:param stream_args: Optional dict of overrides for CLI args (e.g. resolution, video_codec)
+:param stream: The stream to use for the WebRTC server
+:param websocket_server: A WebSocketServer to serve on the /ws route
+"""
+async def serve_stream(serve_player=False, stream_args: Optional[Dict[str, Any]] = None, stream: MediaStreamTrack | None = None, websocket_server=None) -> web.AppRunner:
+    app, ssl_context = create_app(serve_player, stream_args, stream, websocket_server)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port, ssl_context=ssl_context)
+    await site.start()
+    logger.info(f"WebRTC server started on {args.host}:{args.port}")
+    return runner
+
+"""
+Start the WebRTC server.
+
+:param serve_player: Whether to serve the index.html page
+:param stream_args: Optional dict of overrides for CLI args (e.g. resolution, video_codec)
+:param threaded: If True, run in a separate thread
+:param stream: The stream to use for the WebRTC server
+:param websocket_server: A WebSocketServer to serve on the /ws route
+"""
+def start_stream(serve_player=False, stream_args: Optional[Dict[str, Any]] = None, threaded: bool = False, stream: MediaStreamTrack | None = None, websocket_server=None):
+    app, ssl_context = create_app(serve_player, stream_args, stream, websocket_server)
+
     if threaded:
         # Run server in a separate thread
         def thread_target():
@@ -1,12 +1,18 @@
 # Import dependencies
-from gpiozero import DistanceSensor
-from libs.gptApi import is_recyclable
+from libs.hardware import SIMULATED, create_distance_sensor
+from libs.detection import SensorSampler, ObjectDetector
 from libs.receptacle import toggle_receptacle
 from libs.camera import captureImage, init_camera, PiCameraStream
-from libs.videoStream import start_stream
+from libs.videoStream import start_stream, serve_stream
 from libs.qrcode_handler import QRCodeDetector
 from libs.socket_server import WebSocketServer
-from time import sleep
+from libs.event_bus import EventBus
+from libs.pipeline import Pipeline, Stage, ItemContext
+from libs.tracing import span, record
+from libs.imaging import CaptureProfile
+from libs.dvr import SegmentRecorder
+from libs.metrics import counter, histogram
+from time import sleep, monotonic, time
 import os, base64, asyncio, math, random
 from dotenv import load_dotenv
 
@@ -23,16 +29,67 @@ THRESHOLD_DISTANCE = 40; # in cm
 load_dotenv(verbose=True, override=True)
 BIN_MODE = os.environ.get("BIN_MODE").upper()
 
+# Use a simulated classifier instead of the GPT API (for load tests on the simulated backend)
+if os.environ.get("SIM_CLASSIFIER") == "1":
+  from libs.simulation import simulated_is_recyclable as is_recyclable
+else:
+  from libs.gptApi import is_recyclable
+
+# Load sensor tuning
+SENSOR_SAMPLE_RATE = float(os.environ.get("SENSOR_SAMPLE_RATE", 25)) # Ultrasonic sensor readings per second (in Hz)
+SENSOR_QUEUE_LEN = int(os.environ.get("SENSOR_QUEUE_LEN", 3)) # Number of readings the sensor's median is taken over
+SENSOR_EXIT_DISTANCE = float(os.environ.get("SENSOR_EXIT_DISTANCE", THRESHOLD_DISTANCE + 8)) # Distance an item must retreat past before re-arming (in cm)
+SENSOR_APPROACH_DISTANCE = float(os.environ.get("SENSOR_APPROACH_DISTANCE", SENSOR_EXIT_DISTANCE)) # Distance at which an approaching item starts the camera focusing (in cm)
+SENSOR_MEDIAN_WINDOW = int(os.environ.get("SENSOR_MEDIAN_WINDOW", 5)) # Raw readings the median filter spans
+SENSOR_EMA_ALPHA = float(os.environ.get("SENSOR_EMA_ALPHA", 0.5)) # Weight of the newest median in the moving average
+SENSOR_DEBOUNCE = int(os.environ.get("SENSOR_DEBOUNCE", 2)) # Consecutive filtered readings needed to change state
+
+# Load pipeline tuning
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 2)) # Items each stage can have waiting
+PIPELINE_POLICY = os.environ.get("PIPELINE_POLICY", "drop_newest") # What to do with new items when capture is backed up (drop_newest, drop_oldest)
+CLASSIFY_WORKERS = int(os.environ.get("CLASSIFY_WORKERS", 2)) # Concurrent GPT API requests
+
+# Load camera tuning
+CAMERA_ZSL_FRAMES = int(os.environ.get("CAMERA_ZSL_FRAMES", 0)) # Recent frames kept for zero-shutter-lag capture (0 disables; measure with benchmarks.zsl_copy first)
+CAMERA_BURST_FRAMES = int(os.environ.get("CAMERA_BURST_FRAMES", 3)) # Frames scored for sharpness per capture (1 disables)
+CAMERA_IDLE_RESOLUTION = os.environ.get("CAMERA_IDLE_RESOLUTION", "2304x1296") # Main stream resolution between captures, as WIDTHxHEIGHT ("full" never switches)
+
+# Load the rolling recording of the stream, kept to cut clips around each item for audits
+DVR_DIR = os.environ.get("DVR_DIR", "") # Directory for the recording's segment files (empty disables recording)
+DVR_MAX_MB = float(os.environ.get("DVR_MAX_MB", 256)) # Most disk space the recording may use (in MiB)
+DVR_SEGMENT_SECONDS = float(os.environ.get("DVR_SEGMENT_SECONDS", 10)) # Length of each segment file
+DVR_CLIP_BEFORE = float(os.environ.get("DVR_CLIP_BEFORE", 5)) # Seconds of video saved before each item's trigger
+DVR_CLIP_AFTER = float(os.environ.get("DVR_CLIP_AFTER", 5)) # Seconds of video saved after each item's trigger
+
+# Load the classification capture profile
+CAPTURE_RESOLUTION = os.environ.get("CAPTURE_RESOLUTION", "1536x864") # Largest image sent to the model, as WIDTHxHEIGHT ("full" keeps the capture resolution)
+CAPTURE_ROI = os.environ.get("CAPTURE_ROI", "0,0,1,1") # Region of interest as x,y,width,height fractions of the frame
+CAPTURE_JPEG_QUALITY = int(os.environ.get("CAPTURE_JPEG_QUALITY", 85)) # JPEG quality of the uploaded image
+CAPTURE_CHROMA_SUBSAMPLING = os.environ.get("CAPTURE_CHROMA_SUBSAMPLING", "420") # JPEG chroma subsampling (444, 422, 420)
+CAPTURE_DETAIL = os.environ.get("CAPTURE_DETAIL", "auto").lower() # Image detail level requested from the model (low, high, auto)
+
+# Load the runtime mode
+RUNTIME_MODE = os.environ.get("RUNTIME_MODE", "single").lower() # "single" runs the WebRTC app, WebSocket server and pipeline on one event loop, "threaded" gives each server its own loop thread
+USE_UVLOOP = os.environ.get("USE_UVLOOP", "auto").lower() # Run the event loop on uvloop ("auto" uses it if installed, "0" never does)
+WEBSOCKET_PORT = int(os.environ.get("WEBSOCKET_PORT", 8765)) # Port of the standalone WebSocket server for older kiosks (0 serves the protocol only on the WebRTC app's /ws route)
+
+# Metrics
+UPLOAD_BYTES = histogram("bloobin_upload_bytes", "Bytes of image data uploaded per item", buckets=(16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6))
+UPLOAD_BYTES_TOTAL = counter("bloobin_upload_bytes_total", "Bytes of image data uploaded in total")
+
 # Set log levels
 os.environ["LIBCAMERA_LOG_LEVELS"] = "3" # Configure libcamera to only log errors
 
 # Global variables
 qr_scanning_task = None  # Track the QR scanning task
 recycling_processing_task = None  # Track the recycling processing task
-isBusy = False  # Track if currently processing an object
+pipeline = None  # Detection pipeline, running while recycling processing is active
 sensor = None  # Ultrasonic sensor
+detector = None  # Event-driven object detector wrapping the sensor
 picam_stream = None
 websocket_server = None
+event_bus = EventBus()  # Events for the clients, publishable from any thread
+clip_tasks = set()  # Clips waiting for the end of their window
 qr_detector = None  # QR code detector
 
 # Functions
@@ -40,90 +97,156 @@ qr_detector = None  # QR code detector
 def base64_encode(image):
   return base64.b64encode(image).decode("utf-8")
 
+## Create the capture profile from the environment
+def create_capture_profile():
+  resolution = None
+  if CAPTURE_RESOLUTION.lower() != "full":
+    resolution = tuple(map(int, CAPTURE_RESOLUTION.lower().split("x")))
+
+  roi = tuple(map(float, CAPTURE_ROI.split(",")))
+  if roi == (0, 0, 1, 1):
+    roi = None
+
+  return CaptureProfile(resolution=resolution, roi=roi, quality=CAPTURE_JPEG_QUALITY, detail=CAPTURE_DETAIL, subsampling=CAPTURE_CHROMA_SUBSAMPLING)
+
+## Parse the camera's idle main stream resolution
+def camera_idle_size():
+  if CAMERA_IDLE_RESOLUTION.lower() == "full":
+    return None
+  return tuple(map(int, CAMERA_IDLE_RESOLUTION.lower().split("x")))
+
+## Start focusing the camera on an approaching item (called from the sensor's sampling thread)
+def prefocusCamera(timestamp):
+  if picam_stream is not None:
+    picam_stream.prefocus()
+
 ## Initialise sensors
 def init_sensors():
-  global sensor, camera
+  global sensor, detector, camera
 
   # Initialise sensors
   print("Initialising sensors...")
 
-  # Create a new ultrasonic sensor
-  sensor = DistanceSensor(trigger=23, echo=24, threshold_distance=THRESHOLD_DISTANCE / 100)
+  # Create a new ultrasonic sensor, filtering its readings with enter/exit hysteresis
+  sampler = SensorSampler(
+    enter_distance=THRESHOLD_DISTANCE / 100,
+    exit_distance=SENSOR_EXIT_DISTANCE / 100,
+    median_window=SENSOR_MEDIAN_WINDOW,
+    ema_alpha=SENSOR_EMA_ALPHA,
+    debounce=SENSOR_DEBOUNCE,
+    approach_distance=SENSOR_APPROACH_DISTANCE / 100,
+  )
+  sensor = create_distance_sensor(trigger=23, echo=24, threshold_distance=THRESHOLD_DISTANCE / 100, queue_len=SENSOR_QUEUE_LEN, sample_rate=SENSOR_SAMPLE_RATE, sampler=sampler)
+  detector = ObjectDetector(sensor, on_approach=prefocusCamera)
 
   # Initialise the camera
   # camera = init_camera()
   
   # Sleep for 2 seconds to allow the camera to warm up
   sleep(2)
-  print("Sensors initialised")
+  print("Sensors initialised" + (" (simulated)" if SIMULATED else ""))
   print(f"RizzCycle ready to gobble up {BIN_MODE} trash")
 
-## Process the detected object
-async def processObject():
-  global isBusy
+## Pipeline stages
+# Capture an image of the detected object
+async def captureStage(item: ItemContext):
+  # Run on the camera executor so the capture doesn't block the event loop
+  if CAMERA_BURST_FRAMES > 1:
+    item.image = await picam_stream.capture_burst_async(CAMERA_BURST_FRAMES, item.triggered_at)
+  else:
+    item.image = await picam_stream.capture_image_async(item.triggered_at)
+  if item.image is None:
+    raise RuntimeError("Image capture failed")
 
-  try:
-    # Capture and send the image
-    # image = captureImage(camera)
-    image = picam_stream.capture_image()
-
-    # Encode the image to base64
-    imageBase64 = base64_encode(image.getvalue())
-
-    # Send message to the client that the item is being processed
-    await websocket_server.broadcast_message({
-      "type": "processing_recycle",
-      "data": {
-        "receptacleMaterial": BIN_MODE
-      }
-    })
-
-    print("Sending image to GPT API...")
-    canBeRecycled, identifiedMaterial, reasonForRejection = is_recyclable(imageBase64, BIN_MODE)
-
-    print(f"Can be recycled: {canBeRecycled}")
-
-    await websocket_server.broadcast_message({
-      "type": "can_recycle",
-      "data": {
-        "canBeRecycled": canBeRecycled,
-        "identifiedMaterial": identifiedMaterial,
-        "reasonForRejection": reasonForRejection,
-        "receptacleMaterial": BIN_MODE,
-        "itemWeight": math.floor(random.random() * 16) # Random weight between 0 and 16 (Because we don't have the weight sensor hooked up yet)
-      }
-    })
-
-    # Act based on recyclability
-    if canBeRecycled == True:
-      asyncio.create_task(toggle_receptacle())
+  # Send message to the client that the item is being processed
+  event_bus.publish("processing_recycle", {
+    "receptacleMaterial": BIN_MODE
+  })
 
-  finally:
-    isBusy = False # Allow detection to process new objects
+# Encode the image to base64
+async def preprocessStage(item: ItemContext):
+  with span("preprocess.base64"):
+    item.imageBase64 = base64_encode(item.image.getvalue())
+
+  # Report how much we're about to upload
+  item.uploadBytes = len(item.imageBase64)
+  UPLOAD_BYTES.observe(item.uploadBytes)
+  UPLOAD_BYTES_TOTAL.inc(item.uploadBytes)
+  print(f"Item #{item.id} image is {item.uploadBytes / 1024:.0f} KiB to upload")
+
+# Ask the GPT API whether the item can be recycled
+async def classifyStage(item: ItemContext):
+  print(f"Sending image of item #{item.id} to GPT API...")
+  item.canBeRecycled, item.identifiedMaterial, item.reasonForRejection = await asyncio.to_thread(is_recyclable, item.imageBase64, BIN_MODE, picam_stream.capture_profile.detail)
+  print(f"Can be recycled: {item.canBeRecycled}")
+
+# Tell the clients the verdict
+async def notifyStage(item: ItemContext):
+  event_bus.publish("can_recycle", {
+    "canBeRecycled": item.canBeRecycled,
+    "identifiedMaterial": item.identifiedMaterial,
+    "reasonForRejection": item.reasonForRejection,
+    "receptacleMaterial": BIN_MODE,
+    "itemWeight": math.floor(random.random() * 16) # Random weight between 0 and 16 (Because we don't have the weight sensor hooked up yet)
+  })
+
+  # Keep the video of the verdict for audits
+  if picam_stream.recorder is not None:
+    task = asyncio.create_task(saveClip(item))
+    clip_tasks.add(task)
+    task.add_done_callback(clip_tasks.discard)
+
+# Save the recording around an item's trigger next to its image, once the window has passed
+async def saveClip(item: ItemContext):
+  await asyncio.sleep(max(0.0, item.triggered_at + DVR_CLIP_AFTER - monotonic()))
+  path = f"results/{BIN_MODE}_{item.canBeRecycled}_item{item.id}_{int(time())}.h264"
+  clip = await asyncio.to_thread(picam_stream.recorder.clip, item.triggered_at, DVR_CLIP_BEFORE, DVR_CLIP_AFTER, path)
+  print(f"Saved clip of item #{item.id} to {clip}" if clip else f"No recording of item #{item.id} to clip")
+
+# Act based on recyclability
+async def actuateStage(item: ItemContext):
+  if item.canBeRecycled == True:
+    await toggle_receptacle()
+
+## Create the detection pipeline (capture -> preprocess -> classify -> notify -> actuate)
+def create_pipeline():
+  return Pipeline([
+    Stage("capture", captureStage, queue_size=PIPELINE_QUEUE_SIZE, policy=PIPELINE_POLICY),
+    Stage("preprocess", preprocessStage, queue_size=PIPELINE_QUEUE_SIZE),
+    Stage("classify", classifyStage, workers=CLASSIFY_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+    Stage("notify", notifyStage, queue_size=PIPELINE_QUEUE_SIZE),
+    Stage("actuate", actuateStage, queue_size=PIPELINE_QUEUE_SIZE, shield=True), # Stopping mustn't leave the receptacle open
+  ])
 
 ## Checks for object in front of the sensor
 async def checkObject():
-  global isBusy
-  isBusy = False
+  global pipeline
 
   print("Checking for objects in front of the sensor...")
 
-  while True:
-    if sensor.distance < THRESHOLD_DISTANCE / 100:
+  # Items overlap in the pipeline - one can be captured while another awaits the API
+  pipeline = create_pipeline()
+  pipeline.start()
+
+  # The sampler wakes us up once per item entering the threshold distance
+  detector.start(asyncio.get_running_loop())
+
+  try:
+    while True:
+      triggered_at = await detector.wait_for_item()
       print("Object detected within threshold distance")
 
-      if not isBusy:
-          isBusy = True # Prevent multiple simultaneous processing
-          asyncio.create_task(processObject())
-    
-    await asyncio.sleep(1)
+      item = ItemContext(triggered_at)
+      record("sensor.dispatch", triggered_at, monotonic(), item.trace) # Sensor reading to detection loop
+
+      if not pipeline.submit(item):
+        print("Pipeline is full, ignoring object")
+  finally:
+    detector.stop()
+    await pipeline.stop()
 
 async def handle_qr_codes(qr_codes: list[str]):
-  global websocket_server
-  await websocket_server.broadcast_message({
-    "type": "qr_codes",
-    "data": qr_codes
-  })
+  event_bus.publish("qr_codes", qr_codes)
 
 async def start_qr_scanning():
   global qr_detector, qr_scanning_task
@@ -185,6 +308,34 @@ async def stop_processing_recycle():
   else:
     print("No recycling processing task to stop")
 
+## Start the WebRTC and WebSocket servers, sharing the running loop or each on its own thread
+## Returns the WebRTC app's runner when it shares the loop (None when it has its own thread)
+async def start_servers():
+  stream_args = {"play_without_decoding": True, "video_codec": "video/H264"}
+  if RUNTIME_MODE == "threaded":
+    start_stream(stream_args=stream_args, threaded=True, stream=picam_stream)
+    await websocket_server.start_server(threaded=True)
+    runner = None
+  else:
+    # The WebSocket protocol is also served on /ws, next to the stream (events are delivered on this loop whichever way clients connect)
+    event_bus.attach(asyncio.get_running_loop())
+    runner = await serve_stream(stream_args=stream_args, stream=picam_stream, websocket_server=websocket_server)
+    if WEBSOCKET_PORT:
+      await websocket_server.listen()
+  print(f"Servers running in {RUNTIME_MODE} mode on {type(asyncio.get_running_loop()).__module__.split('.')[0]}")
+  return runner
+
+## Run a coroutine to completion on a new event loop, on uvloop if enabled and installed
+def run(coroutine):
+  if USE_UVLOOP != "0":
+    try:
+      import uvloop
+      asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+      if USE_UVLOOP != "auto":
+        print("uvloop isn't installed, running on the default event loop")
+  asyncio.run(coroutine)
+
 ## Main
 async def main():
   global qr_detector, websocket_server, picam_stream
@@ -193,21 +344,25 @@ async def main():
   init_sensors()
 
   # Initialise the camera
-  picam_stream = PiCameraStream()
-
-  # Start the WebRTC server
-  start_stream(stream_args={"play_without_decoding": True, "video_codec": "video/H264"}, threaded=True, stream=picam_stream)
+  recorder = SegmentRecorder(DVR_DIR, segment_seconds=DVR_SEGMENT_SECONDS, max_bytes=int(DVR_MAX_MB * 1024 * 1024)) if DVR_DIR else None
+  picam_stream = PiCameraStream(idle_size=camera_idle_size(), zsl_frames=CAMERA_ZSL_FRAMES, capture_profile=create_capture_profile(), recorder=recorder)
+  print(f"Classifying with {picam_stream.capture_profile}")
 
   # Initialise the QR code detector
   qr_detector = QRCodeDetector(picam_stream)
 
-  # Start the WebSocket server
-  websocket_server = WebSocketServer(start_qr_scanning=start_qr_scanning, stop_qr_scanning=stop_qr_scanning, start_processing_recycle=start_processing_recycle, stop_processing_recycle=stop_processing_recycle)
-  await websocket_server.start_server(threaded=True)
+  # Start the WebRTC and WebSocket servers
+  websocket_server = WebSocketServer(port=WEBSOCKET_PORT, start_qr_scanning=start_qr_scanning, stop_qr_scanning=stop_qr_scanning, start_processing_recycle=start_processing_recycle, stop_processing_recycle=stop_processing_recycle, event_bus=event_bus)
+  runner = await start_servers()
   # asyncio.create_task(websocket_server.keep_alive())
 
   # Keep the main function running - recycling processing will be started via WebSocket commands
-  while True:
-    await asyncio.sleep(1)
+  try:
+    while True:
+      await asyncio.sleep(1)
+  finally:
+    # Runs the app's shutdown: closes the peers, HLS and the WebSocket clients
+    if runner is not None:
+      await runner.cleanup()
 
-asyncio.run(main())
\ No newline at end of file
+run(main())
\ No newline at end of file
@@ -0,0 +1,77 @@
+import unittest
+from libs.adaptation import AdaptationController, build_ladder
+
+# Run from src: python -m unittest discover tests
+
+CLEAN = [(0.0, 0.05)]
+LOSSY = [(0.2, 0.05)]
+
+class BuildLadderTest(unittest.TestCase):
+  def test_rungs_lowest_first(self):
+    ladder = build_ladder((1280, 720), 2_000_000)
+    self.assertEqual(ladder[-1], ((1280, 720), 2_000_000))
+    self.assertEqual([rung[0] for rung in ladder], sorted(rung[0] for rung in ladder))
+    for (width, height), bitrate in ladder[:-1]:
+      self.assertEqual(width % 32, 0)
+      self.assertEqual(height % 16, 0)
+      self.assertGreaterEqual(bitrate, 250_000)
+
+  def test_top_rung_is_configured_size(self):
+    # 1080 isn't a multiple of 16; the top rung must still be the stream as configured
+    ladder = build_ladder((1920, 1080), 2_000_000)
+    self.assertEqual(ladder[-1][0], (1920, 1080))
+    self.assertEqual(ladder[-1][1], 2_000_000)
+    for (width, height), _ in ladder[:-1]:
+      self.assertEqual(height % 16, 0)
+
+class AdaptationControllerTest(unittest.TestCase):
+  def setUp(self):
+    self.ladder = [((320, 176), 300_000), ((640, 352), 800_000), ((1280, 720), 2_000_000)]
+    self.controller = AdaptationController(self.ladder, up_after=3, settle=1)
+
+  def test_starts_on_top_rung(self):
+    self.assertEqual(self.controller.current, self.ladder[-1])
+
+  def test_steps_down_on_loss(self):
+    self.assertEqual(self.controller.update(LOSSY), self.ladder[1])
+    self.assertEqual(self.controller.rung, 1)
+
+  def test_steps_down_on_rtt(self):
+    self.assertEqual(self.controller.update([(0.0, 1.0)]), self.ladder[1])
+
+  def test_follows_worst_viewer(self):
+    self.assertEqual(self.controller.update(CLEAN + LOSSY), self.ladder[1])
+
+  def test_settles_after_a_change(self):
+    self.controller.update(LOSSY)
+    # The next report still describes the old rung
+    self.assertIsNone(self.controller.update(LOSSY))
+    self.assertEqual(self.controller.update(LOSSY), self.ladder[0])
+
+  def test_stays_on_bottom_rung(self):
+    self.controller.rung = 0
+    self.assertIsNone(self.controller.update(LOSSY))
+    self.assertEqual(self.controller.rung, 0)
+
+  def test_steps_up_after_clean_intervals(self):
+    self.controller.update(LOSSY)
+    self.controller.update(CLEAN)  # Settling
+    self.assertIsNone(self.controller.update(CLEAN))
+    self.assertIsNone(self.controller.update(CLEAN))
+    self.assertEqual(self.controller.update(CLEAN), self.ladder[2])
+
+  def test_moderate_loss_resets_clean_run(self):
+    self.controller.update(LOSSY)
+    self.controller.update(CLEAN)
+    self.controller.update(CLEAN)
+    self.controller.update(CLEAN)
+    self.controller.update([(0.05, 0.05)])  # Between up_loss and down_loss
+    self.assertIsNone(self.controller.update(CLEAN))
+    self.assertEqual(self.controller.rung, 1)
+
+  def test_ignores_empty_reports(self):
+    self.assertIsNone(self.controller.update([(None, None)]))
+    self.assertEqual(self.controller.rung, 2)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,201 @@
+import os
+os.environ.setdefault("HARDWARE_BACKEND", "sim") # Import the camera against the simulated backend
+
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from libs.camera import FrameRingBuffer, PiCameraStream, COALESCED_REQUESTS, AF_STATE_FOCUSED, AF_STATE_SCANNING
+from libs.simulation import SimulatedRequest
+
+# Run from src: python -m unittest discover tests
+
+class FakeCamera:
+  """Hands out requests for the given main-stream frames, counting releases."""
+  def __init__(self, frames):
+    self.frames = list(frames)
+    self.released = 0
+
+  def capture_request(self):
+    request = SimulatedRequest({"main": self.frames.pop(0)}, {})
+    def release():
+      self.released += 1
+    request.release = release
+    return request
+
+## A PiCameraStream with only what the capture paths use: no camera thread, encoder or mode switches.
+## Frames are "encoded" by copying them, so tests can see which one was chosen
+def make_stream(**attributes):
+  stream = PiCameraStream.__new__(PiCameraStream)
+  stream._stopped = False
+  stream._lock = threading.Lock()
+  stream._zsl = None
+  stream._zsl_max_age = 0.5
+  stream.capture_profile = None
+  stream._autofocus = False
+  stream.idle_size = stream.still_size = (16, 16)
+  stream._encode_frame = lambda frame: frame.copy()
+  stream.__dict__.update(attributes)
+  return stream
+
+## A 16x16 frame tagged with a value in its first pixel, sharp (a checkerboard) or flat
+def make_scored_frame(value, sharp):
+  y, x = np.indices((16, 16))
+  grey = ((x // 2 + y // 2) % 2 * 255 if sharp else np.full((16, 16), 128)).astype(np.uint8)
+  frame = np.dstack([grey, grey, grey, np.full((16, 16), 255, dtype=np.uint8)])
+  frame[0, 0, 3] = value
+  return frame
+
+## A tiny frame filled with a value, so tests can tell which one they got back
+def make_frame(value):
+  return np.full((4, 4, 4), value, dtype=np.uint8)
+
+class FrameRingBufferTest(unittest.TestCase):
+  def setUp(self):
+    self.ring = FrameRingBuffer(4)
+
+  def fill(self, timestamps, states=None):
+    for index, timestamp in enumerate(timestamps):
+      state = states[index] if states else None
+      self.ring.write(make_frame(index), timestamp, {"AfState": state} if state is not None else None)
+
+  def test_best_is_closest_to_trigger(self):
+    self.fill([10.0, 10.2, 10.4, 10.6])
+    with self.ring.best(0.5, at=10.25) as (frame, timestamp, _):
+      self.assertEqual(frame[0, 0, 0], 1)
+      self.assertEqual(timestamp, 10.2)
+
+  def test_best_prefers_focused_frames(self):
+    self.fill([10.0, 10.2, 10.4, 10.6], [AF_STATE_FOCUSED, AF_STATE_SCANNING, AF_STATE_SCANNING, AF_STATE_FOCUSED])
+    with self.ring.best(0.5, at=10.25) as (frame, _, _):
+      self.assertEqual(frame[0, 0, 0], 0)
+
+  def test_best_none_outside_window(self):
+    self.fill([10.0, 10.2])
+    with self.ring.best(0.5, at=20.0) as buffered:
+      self.assertIsNone(buffered)
+
+  def test_recent_oldest_first_within_window(self):
+    self.fill([10.0, 10.2, 10.4, 10.6])
+    with self.ring.recent(0.25, at=10.3) as frames:
+      self.assertEqual([timestamp for _, timestamp, _ in frames], [10.2, 10.4])
+
+  def test_wraps_around(self):
+    self.fill([10.0, 10.1, 10.2, 10.3, 10.4, 10.5])
+    with self.ring.recent(1.0, at=10.5) as frames:
+      self.assertEqual([timestamp for _, timestamp, _ in frames], [10.2, 10.3, 10.4, 10.5])
+
+  def test_checked_out_frame_is_not_overwritten(self):
+    self.fill([10.0, 10.1, 10.2, 10.3])
+    with self.ring.best(0.05, at=10.0) as (frame, _, _):
+      for index in range(8):
+        self.ring.write(make_frame(100 + index), 11.0 + index)
+      self.assertEqual(frame[0, 0, 0], 0)
+    self.assertEqual(self.ring._checked_out, {})
+
+  def test_clear(self):
+    self.fill([10.0, 10.1])
+    self.ring.clear()
+    with self.ring.recent(1.0, at=10.0) as frames:
+      self.assertEqual(frames, [])
+
+  def test_reallocates_on_new_shape(self):
+    self.fill([10.0])
+    self.ring.write(np.zeros((8, 8, 4), dtype=np.uint8), 10.1)
+    with self.ring.recent(1.0, at=10.1) as frames:
+      self.assertEqual([frame.shape for frame, _, _ in frames], [(8, 8, 4)])
+
+  def test_needs_two_slots(self):
+    with self.assertRaises(ValueError):
+      FrameRingBuffer(1)
+
+class BurstCaptureTest(unittest.TestCase):
+  def test_picks_sharpest_request_and_releases_all(self):
+    camera = FakeCamera([make_scored_frame(0, False), make_scored_frame(1, True), make_scored_frame(2, False)])
+    stream = make_stream(picam2=camera)
+    best = stream._capture_burst_direct(3)
+    self.assertEqual(best[0, 0, 3], 1)
+    self.assertEqual(camera.released, 3)
+
+  def test_releases_request_when_scoring_fails(self):
+    camera = FakeCamera([make_scored_frame(0, True), make_scored_frame(1, True)])
+    stream = make_stream(picam2=camera)
+    scores = iter([1.0])
+    def score(frame):
+      return next(scores) # Raises StopIteration on the second frame
+    stream._score_frame = score
+    self.assertIsNone(stream._capture_burst_direct(2))
+    self.assertEqual(camera.released, 2)
+
+  def test_zsl_scores_count_frames_closest_to_trigger(self):
+    ring = FrameRingBuffer(4)
+    # The sharpest buffered frame is the furthest from the trigger
+    for value, (timestamp, sharp) in enumerate([(10.0, True), (10.2, False), (10.3, False), (10.4, False)]):
+      ring.write(make_scored_frame(value, sharp), timestamp)
+    stream = make_stream(_zsl=ring, picam2=FakeCamera([]))
+
+    self.assertEqual(stream._capture_burst_direct(2, 10.3)[0, 0, 3], 2)
+    self.assertEqual(stream._capture_burst_direct(4, 10.3)[0, 0, 3], 0)
+
+class RunAsyncTest(unittest.IsolatedAsyncioTestCase):
+  def setUp(self):
+    self.stream = make_stream(_executor=ThreadPoolExecutor(max_workers=1), _inflight={}, _inflight_lock=threading.Lock())
+    self.release = threading.Event()
+    self.calls = []
+
+  def tearDown(self):
+    self.release.set()
+    self.stream._executor.shutdown(wait=True)
+
+  ## A camera operation that blocks until the test releases it
+  def capture(self, value):
+    self.calls.append(value)
+    self.release.wait(1.0)
+    return make_frame(value)
+
+  async def test_identical_calls_share_one_operation(self):
+    before = COALESCED_REQUESTS.get(operation="capture")
+    calls = [self.stream._run_async("capture", self.capture, 1, timeout=1.0, share=np.copy) for _ in range(3)]
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    await asyncio.sleep(0.05)
+    self.release.set()
+    results = await asyncio.gather(*tasks)
+
+    self.assertEqual(self.calls, [1])
+    self.assertEqual(COALESCED_REQUESTS.get(operation="capture"), before + 2)
+    for result in results:
+      self.assertEqual(result[0, 0, 0], 1)
+    # Followers get their own copy of the leader's result
+    self.assertEqual(len({id(result) for result in results}), 3)
+    self.assertEqual(self.stream._inflight, {})
+
+  async def test_different_args_are_not_joined(self):
+    tasks = [asyncio.ensure_future(self.stream._run_async("capture", self.capture, value, timeout=1.0)) for value in (1, 2)]
+    await asyncio.sleep(0.05)
+    self.release.set()
+    results = await asyncio.gather(*tasks)
+    self.assertEqual(self.calls, [1, 2])
+    self.assertEqual([result[0, 0, 0] for result in results], [1, 2])
+
+  async def test_later_call_starts_a_new_operation(self):
+    self.release.set()
+    await self.stream._run_async("capture", self.capture, 1, timeout=1.0)
+    await self.stream._run_async("capture", self.capture, 1, timeout=1.0)
+    self.assertEqual(self.calls, [1, 1])
+
+  async def test_timeout_returns_none(self):
+    self.assertIsNone(await self.stream._run_async("capture", self.capture, 1, timeout=0.05))
+
+  async def test_errors_return_none(self):
+    def fail():
+      raise RuntimeError("camera gone")
+    self.assertIsNone(await self.stream._run_async("capture", fail, timeout=1.0))
+
+  async def test_stopped_stream_returns_none(self):
+    self.stream._stopped = True
+    self.assertIsNone(await self.stream._run_async("capture", self.capture, 1, timeout=1.0))
+    self.assertEqual(self.calls, [])
+
+if __name__ == "__main__":
+  unittest.main()
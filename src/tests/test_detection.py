@@ -0,0 +1,57 @@
+import unittest
+from libs.detection import SensorSampler
+
+# Run from src: python -m unittest discover tests
+
+class SensorSamplerTest(unittest.TestCase):
+  def setUp(self):
+    self.events = []
+    # A window of one and alpha of one pass readings straight through the filter
+    self.sampler = SensorSampler(enter_distance=0.2, exit_distance=0.3, median_window=1, ema_alpha=1, debounce=2, on_event=lambda event, timestamp: self.events.append(event))
+
+  def push(self, *distances):
+    for distance in distances:
+      self.sampler.push(distance)
+
+  def test_arrives_after_debounce(self):
+    self.push(0.1)
+    self.assertEqual(self.events, ["approaching"])
+    self.assertFalse(self.sampler.occupied)
+
+    self.push(0.1)
+    self.assertEqual(self.events, ["approaching", "arrived"])
+    self.assertTrue(self.sampler.occupied)
+
+  def test_single_reading_is_debounced(self):
+    self.push(0.1, 0.5, 0.1, 0.5)
+    self.assertNotIn("arrived", self.events)
+    self.assertFalse(self.sampler.occupied)
+
+  def test_hysteresis_between_thresholds(self):
+    self.push(0.1, 0.1)
+    # Between enter and exit: still occupied
+    self.push(0.25, 0.25, 0.25)
+    self.assertTrue(self.sampler.occupied)
+
+    self.push(0.4)
+    self.assertTrue(self.sampler.occupied)
+    self.push(0.4)
+    self.assertFalse(self.sampler.occupied)
+    self.assertEqual(self.events, ["approaching", "arrived", "departed"])
+
+  def test_one_arrival_per_item(self):
+    self.push(0.1, 0.1, 0.1, 0.15, 0.1, 0.4, 0.4, 0.4, 0.1, 0.1)
+    self.assertEqual(self.events, ["approaching", "arrived", "departed", "approaching", "arrived"])
+
+  def test_median_rejects_spikes(self):
+    sampler = SensorSampler(enter_distance=0.2, exit_distance=0.3, median_window=3, ema_alpha=1, debounce=1)
+    for distance in (0.5, 0.5, 0.05, 0.5):
+      sampler.push(distance)
+    self.assertFalse(sampler.occupied)
+
+  def test_rejects_inverted_thresholds(self):
+    with self.assertRaises(ValueError):
+      SensorSampler(enter_distance=0.3, exit_distance=0.2)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+from libs.dvr import Segment, SegmentRecorder
+
+# Run from src: python -m unittest discover tests
+
+## A segment of ten 100-byte packets, 0.1s apart from t=0, with keyframes at packets 0 and 5
+def make_segment():
+  segment = Segment("segment.h264", 0.0)
+  for index in range(10):
+    segment.add(bytes(100), index % 5 == 0, index * 0.1)
+  segment.flushed = segment.size
+  return segment
+
+class ClipRangeTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.recorder = SegmentRecorder(self.directory)
+
+  def tearDown(self):
+    self.recorder.close()
+    shutil.rmtree(self.directory)
+
+  def test_backs_up_to_keyframe(self):
+    # Window starts at packet 7: back up to the keyframe at packet 5
+    self.assertEqual(self.recorder._clip_range(make_segment(), 0.72, 0.85), (500, 900))
+
+  def test_starts_on_keyframe(self):
+    self.assertEqual(self.recorder._clip_range(make_segment(), 0.5, 0.65), (500, 700))
+
+  def test_window_before_segment(self):
+    self.assertEqual(self.recorder._clip_range(make_segment(), -1.0, 0.25), (0, 300))
+
+  def test_window_past_segment(self):
+    self.assertEqual(self.recorder._clip_range(make_segment(), 0.3, 5.0), (0, 1000))
+
+  def test_stops_at_flushed_bytes(self):
+    segment = make_segment()
+    segment.flushed = 650
+    self.assertEqual(self.recorder._clip_range(segment, 0.5, 5.0), (500, 650))
+
+class SegmentRecorderTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.recorder.close()
+    shutil.rmtree(self.directory)
+
+  def record(self, packets, keyframe_every=5, size=100, interval=0.1, start=0.0):
+    for index in range(packets):
+      self.recorder.write(bytes([index % 256]) * size, index % keyframe_every == 0, start + index * interval)
+    self.assertTrue(self.recorder.flush())
+
+  def test_startup_removes_only_old_segments(self):
+    for name in ("segment_000001.h264", "clip_123.h264", "notes.h264"):
+      with open(os.path.join(self.directory, name), "wb") as file:
+        file.write(b"x")
+    self.recorder = SegmentRecorder(self.directory)
+    self.assertEqual(sorted(os.listdir(self.directory)), ["clip_123.h264", "notes.h264"])
+
+  def test_segments_start_on_keyframes(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=1.0)
+    self.record(30)
+
+    stats = self.recorder.stats()
+    self.assertEqual(stats["segments"], 3)
+    self.assertEqual(stats["bytes"], 3000)
+    for segment in self.recorder._segments:
+      self.assertEqual(segment.keyframes[0], 0)
+
+  def test_rotates_to_max_bytes(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=1.0, max_bytes=2500)
+    self.record(60)
+
+    stats = self.recorder.stats()
+    self.assertLessEqual(stats["bytes"], 2500)
+    self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith(".h264")]), stats["segments"])
+    self.assertAlmostEqual(self.recorder._segments[-1].ended_at, 5.9)
+
+  def test_long_segment_is_cut_at_half_max_bytes(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=100.0, max_bytes=2000)
+    self.record(60)
+
+    stats = self.recorder.stats()
+    self.assertGreater(stats["segments"], 1)
+    self.assertLessEqual(stats["bytes"], 2000)
+
+  def test_rotates_to_max_segments(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=0.5, max_segments=3)
+    self.record(60)
+    self.assertEqual(self.recorder.stats()["segments"], 3)
+
+  def test_gap_restarts_on_keyframe(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=100.0)
+    self.record(3)
+    # A dropped packet marks the next one queued; its GOP is skipped
+    self.recorder._gap = True
+    self.recorder.write(bytes(100), False, 0.3)
+    self.recorder.write(bytes(100), False, 0.4)
+    self.recorder.write(bytes(100), True, 0.5)
+    self.assertTrue(self.recorder.flush())
+
+    segments = list(self.recorder._segments)
+    self.assertEqual(len(segments), 2)
+    self.assertEqual(segments[0].timestamps, [0.0, 0.1, 0.2])
+    self.assertEqual(segments[1].timestamps, [0.5])
+
+  def test_clip_is_cut_from_keyframe(self):
+    self.recorder = SegmentRecorder(self.directory, segment_seconds=1.0)
+    self.record(30)
+
+    path = self.recorder.clip(1.75, before=0.1, after=0.2)
+    with open(path, "rb") as clip:
+      data = clip.read()
+    # Packets 15 (the keyframe before the window) to 19
+    self.assertEqual(data, b"".join(bytes([index]) * 100 for index in range(15, 20)))
+
+  def test_clip_outside_recording(self):
+    self.recorder = SegmentRecorder(self.directory)
+    self.record(10)
+    self.assertIsNone(self.recorder.clip(100.0, before=1.0, after=1.0))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import unittest
+from libs.event_bus import EventBus
+
+# Run from src: python -m unittest discover tests
+
+async def settle():
+  for _ in range(5):
+    await asyncio.sleep(0)
+
+class EventBusTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.batches = []
+    self.bus = EventBus(asyncio.get_running_loop())
+    self.bus.subscribe(self.batches.append)
+
+  async def test_event_shape(self):
+    self.bus.publish("status")
+    self.bus.publish("result", {"label": "plastic"})
+    await settle()
+    self.assertEqual(self.batches, [[{"type": "status"}, {"type": "result", "data": {"label": "plastic"}}]])
+
+  async def test_batches_events_published_before_delivery(self):
+    for index in range(5):
+      self.bus.publish("tick", index)
+    await settle()
+    self.bus.publish("tick", 5)
+    await settle()
+    self.assertEqual([[event["data"] for event in batch] for batch in self.batches], [[0, 1, 2, 3, 4], [5]])
+
+  async def test_publish_from_threads(self):
+    def publish(thread):
+      for index in range(100):
+        self.bus.publish("tick", (thread, index))
+
+    threads = [threading.Thread(target=publish, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    await settle()
+
+    events = [event["data"] for batch in self.batches for event in batch]
+    self.assertEqual(len(events), 400)
+    self.assertLess(len(self.batches), 400)
+    # Each thread's events arrive in the order it published them
+    for thread in range(4):
+      self.assertEqual([index for source, index in events if source == thread], list(range(100)))
+
+  async def test_delivers_events_published_before_attach(self):
+    bus = EventBus()
+    batches = []
+    bus.subscribe(batches.append)
+    bus.publish("early")
+    await settle()
+    self.assertEqual(batches, [])
+
+    bus.attach(asyncio.get_running_loop())
+    await settle()
+    self.assertEqual(batches, [[{"type": "early"}]])
+
+  async def test_unsubscribe(self):
+    batches = []
+    unsubscribe = self.bus.subscribe(batches.append)
+    unsubscribe()
+    self.bus.publish("status")
+    await settle()
+    self.assertEqual(batches, [])
+    self.assertEqual(len(self.batches), 1)
+
+  async def test_failing_subscriber_does_not_stop_others(self):
+    bus = EventBus(asyncio.get_running_loop())
+    batches = []
+    bus.subscribe(lambda events: 1 / 0)
+    bus.subscribe(batches.append)
+    bus.publish("status")
+    await settle()
+    self.assertEqual(batches, [[{"type": "status"}]])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+from libs.imaging import CaptureProfile, sharpness
+
+# Run from src: python -m unittest discover tests
+
+## An XBGR8888 frame ([R, G, B, 255]) of a grey level per pixel
+def make_frame(grey):
+  grey = np.asarray(grey, dtype=np.uint8)
+  return np.dstack([grey, grey, grey, np.full(grey.shape, 255, dtype=np.uint8)])
+
+## A checkerboard of squares `cell` pixels wide
+def checkerboard(size=64, cell=4):
+  y, x = np.indices((size, size))
+  return ((x // cell + y // cell) % 2) * 255
+
+## Blur by averaging each pixel with its neighbours, `passes` times
+def blur(grey, passes):
+  grey = grey.astype(np.float32)
+  for _ in range(passes):
+    grey = (grey + np.roll(grey, 1, 0) + np.roll(grey, -1, 0) + np.roll(grey, 1, 1) + np.roll(grey, -1, 1)) / 5
+  return grey
+
+class SharpnessTest(unittest.TestCase):
+  def test_flat_frame_scores_zero(self):
+    self.assertEqual(sharpness(make_frame(np.full((32, 32), 128))), 0.0)
+
+  def test_blur_lowers_score(self):
+    board = checkerboard()
+    scores = [sharpness(make_frame(blur(board, passes))) for passes in (0, 1, 3, 6)]
+    self.assertEqual(scores, sorted(scores, reverse=True))
+    self.assertGreater(scores[0], scores[-1] * 2)
+
+  def test_greyscale_frames(self):
+    board = checkerboard()
+    self.assertAlmostEqual(sharpness(board.astype(np.uint8)), sharpness(make_frame(board)), places=0)
+
+class CaptureProfileTest(unittest.TestCase):
+  def setUp(self):
+    # 640x480, each pixel's red channel holding its column / 4
+    y, x = np.indices((480, 640))
+    self.frame = make_frame(x // 4)
+
+  def test_whole_frame_by_default(self):
+    self.assertIs(CaptureProfile().apply(self.frame), self.frame)
+
+  def test_crop_to_roi(self):
+    cropped = CaptureProfile(roi=(0.25, 0.5, 0.5, 0.25)).crop(self.frame)
+    self.assertEqual(cropped.shape, (120, 320, 4))
+    self.assertEqual(cropped[0, 0, 0], 160 // 4)
+    # A view of the frame, not a copy
+    self.assertTrue(np.shares_memory(cropped, self.frame))
+
+  def test_roi_clamped_to_frame(self):
+    self.assertEqual(CaptureProfile(roi=(0.75, 0.75, 0.5, 0.5)).crop(self.frame).shape, (120, 160, 4))
+
+  def test_resize_keeps_aspect_ratio(self):
+    self.assertEqual(CaptureProfile(resolution=(320, 320)).apply(self.frame).shape, (240, 320, 4))
+
+  def test_never_upscales(self):
+    self.assertIs(CaptureProfile(resolution=(1280, 960)).apply(self.frame), self.frame)
+
+  def test_crops_before_resizing(self):
+    profile = CaptureProfile(resolution=(160, 160), roi=(0.5, 0.0, 0.5, 1.0))
+    self.assertEqual(profile.apply(self.frame).shape, (160, 106, 4))
+
+  def test_encodes_jpeg(self):
+    profile = CaptureProfile(resolution=(320, 240), quality=80)
+    data = profile.encode(profile.apply(self.frame)).getvalue()
+    self.assertEqual(data[:2], b"\xff\xd8")
+
+  def test_encodes_cropped_view(self):
+    profile = CaptureProfile(roi=(0.25, 0.25, 0.5, 0.5))
+    self.assertEqual(profile.encode(profile.apply(self.frame)).getvalue()[:2], b"\xff\xd8")
+
+  def test_rejects_unknown_detail(self):
+    with self.assertRaises(ValueError):
+      CaptureProfile(detail="ultra")
+
+  def test_rejects_unknown_subsampling(self):
+    with self.assertRaises(ValueError):
+      CaptureProfile(subsampling="400")
+
+if __name__ == "__main__":
+  unittest.main()
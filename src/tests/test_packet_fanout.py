@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+from fractions import Fraction
+import av
+from libs.packet_fanout import PacketFanout, split_nal_units, nal_type, NAL_SPS, NAL_PPS, PTS_CLOCK
+
+# Run from src: python -m unittest discover tests
+
+SPS = b"\x67\x64\x00\x1f\xac"
+PPS = b"\x68\xee\x3c\x80"
+IDR = b"\x65\x88\x84\x00\x10"
+SLICE = b"\x41\x9a\x02\x00"
+
+## A packet holding the given NAL units, each behind a 4-byte start code
+def make_packet(*units, keyframe=False):
+  packet = av.Packet(b"".join(b"\x00\x00\x00\x01" + unit for unit in units))
+  packet.is_keyframe = keyframe
+  packet.time_base = Fraction(1, PTS_CLOCK)
+  return packet
+
+class SplitNalUnitsTest(unittest.TestCase):
+  def test_four_byte_start_codes(self):
+    self.assertEqual(split_nal_units(b"\x00\x00\x00\x01" + SPS + b"\x00\x00\x00\x01" + PPS), [SPS, PPS])
+
+  def test_three_byte_start_codes(self):
+    self.assertEqual(split_nal_units(b"\x00\x00\x01" + SPS + b"\x00\x00\x01" + IDR), [SPS, IDR])
+
+  def test_mixed_start_codes(self):
+    self.assertEqual(split_nal_units(b"\x00\x00\x00\x01" + SPS + b"\x00\x00\x01" + PPS + b"\x00\x00\x00\x01" + IDR), [SPS, PPS, IDR])
+
+  def test_no_start_code(self):
+    self.assertEqual(split_nal_units(IDR), [])
+
+  def test_nal_types(self):
+    self.assertEqual([nal_type(unit) for unit in (SPS, PPS, IDR, SLICE)], [NAL_SPS, NAL_PPS, 5, 1])
+
+class PacketFanoutTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.fanout = PacketFanout()
+
+  async def receive(self, subscriber, count):
+    return [bytes(await asyncio.wait_for(subscriber.get(), 1)) for _ in range(count)]
+
+  async def test_keyframe_with_parameter_sets_is_unchanged(self):
+    subscriber = self.fanout.subscribe()
+    self.fanout.publish(make_packet(SPS, PPS, IDR, keyframe=True), keyframe=True)
+    self.assertEqual(split_nal_units((await self.receive(subscriber, 1))[0]), [SPS, PPS, IDR])
+
+  async def test_parameter_sets_prefixed_to_later_keyframes(self):
+    subscriber = self.fanout.subscribe()
+    self.fanout.publish(make_packet(SPS, PPS, IDR, keyframe=True), keyframe=True)
+    self.fanout.publish(make_packet(SLICE))
+    self.fanout.publish(make_packet(IDR, keyframe=True), keyframe=True)
+
+    _, delta, keyframe = await self.receive(subscriber, 3)
+    self.assertEqual(split_nal_units(delta), [SLICE])
+    self.assertEqual(split_nal_units(keyframe), [SPS, PPS, IDR])
+
+  async def test_keyframe_before_parameter_sets_is_unchanged(self):
+    subscriber = self.fanout.subscribe()
+    self.fanout.publish(make_packet(IDR, keyframe=True), keyframe=True)
+    self.assertEqual(split_nal_units((await self.receive(subscriber, 1))[0]), [IDR])
+
+  async def test_replay_starts_on_keyframe(self):
+    self.fanout.publish(make_packet(SLICE))
+    self.fanout.publish(make_packet(SPS, PPS, IDR, keyframe=True), keyframe=True)
+    self.fanout.publish(make_packet(SLICE))
+    self.assertEqual(self.fanout.gop_length, 2)
+
+    subscriber = self.fanout.subscribe(replay=True)
+    self.fanout.publish(make_packet(SLICE))
+    packets = await self.receive(subscriber, 3)
+    self.assertEqual([nal_type(split_nal_units(packet)[-1]) for packet in packets], [5, 1, 1])
+
+  async def test_overflow_skips_to_next_keyframe(self):
+    subscriber = self.fanout.subscribe(maxsize=2)
+    for _ in range(4):
+      self.fanout.publish(make_packet(SLICE))
+    self.fanout.publish(make_packet(SPS, PPS, IDR, keyframe=True), keyframe=True)
+    await asyncio.sleep(0)
+
+    self.assertEqual(subscriber.overflows, 1)
+    self.assertEqual(subscriber.dropped, 4)  # The two queued, then the deltas up to the keyframe
+    self.assertEqual(split_nal_units((await self.receive(subscriber, 1))[0]), [SPS, PPS, IDR])
+
+  async def test_close_wakes_subscribers(self):
+    subscriber = self.fanout.subscribe()
+    self.fanout.close()
+    self.assertIsNone(await asyncio.wait_for(subscriber.get(), 1))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from libs.peers import Peer, PeerManager, PEERS_REMOVED, PEERS_REJECTED, RTP_HISTORY_ATTRIBUTE
+
+# Run from src: python -m unittest discover tests
+
+class FakePeerConnection:
+  """The parts of RTCPeerConnection PeerManager uses, with a connection state the test sets."""
+  def __init__(self, senders=()):
+    self.connectionState = "new"
+    self.handlers = {}
+    self.senders = list(senders)
+    self.closed = False
+
+  def on(self, event):
+    def register(handler):
+      self.handlers[event] = handler
+      return handler
+    return register
+
+  def getSenders(self):
+    return self.senders
+
+  async def close(self):
+    self.closed = True
+
+  async def change_state(self, state):
+    self.connectionState = state
+    await self.handlers["connectionstatechange"]()
+
+class FakeTrack:
+  def __init__(self, queued_bytes=0):
+    self.queued_bytes = queued_bytes
+    self.stopped = False
+
+  def stop(self):
+    self.stopped = True
+
+## A sender holding RTP packets for retransmission where aiortc keeps them
+def make_sender(*sizes):
+  sender = SimpleNamespace()
+  setattr(sender, RTP_HISTORY_ATTRIBUTE, {index: SimpleNamespace(payload=bytes(size)) for index, size in enumerate(sizes)})
+  return sender
+
+class PeerMemoryTest(unittest.TestCase):
+  def test_counts_queued_and_retransmission_bytes(self):
+    peer = Peer(1, FakePeerConnection([make_sender(100, 200)]))
+    peer.tracks.append(FakeTrack(queued_bytes=50))
+    self.assertEqual(peer.memory(), 350)
+
+  def test_unknown_without_rtp_history(self):
+    peer = Peer(1, FakePeerConnection([SimpleNamespace()]))
+    peer.tracks.append(FakeTrack(queued_bytes=50))
+    self.assertIsNone(peer.memory())
+
+class PeerManagerTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.manager = PeerManager(max_peers=2, connect_timeout=0.05, disconnect_timeout=0.05, reap_interval=0.02)
+
+  async def asyncTearDown(self):
+    await self.manager.close_all()
+
+  async def test_refuses_peers_over_the_cap(self):
+    before = PEERS_REJECTED.get()
+    self.assertIsNotNone(self.manager.add(FakePeerConnection()))
+    self.assertIsNotNone(self.manager.add(FakePeerConnection()))
+    self.assertTrue(self.manager.full)
+    self.assertIsNone(self.manager.add(FakePeerConnection()))
+    self.assertEqual(self.manager.count(), 2)
+    self.assertEqual(PEERS_REJECTED.get(), before + 1)
+
+  async def test_room_again_after_a_peer_closes(self):
+    pcs = [FakePeerConnection(), FakePeerConnection()]
+    for pc in pcs:
+      self.manager.add(pc)
+    await pcs[0].change_state("closed")
+    self.assertIsNotNone(self.manager.add(FakePeerConnection()))
+
+  async def test_reaps_peers_that_never_connect(self):
+    before = PEERS_REMOVED.get(reason="connect_timeout")
+    pc = FakePeerConnection()
+    track = FakeTrack()
+    self.manager.add(pc).tracks.append(track)
+    await asyncio.sleep(0.15)
+
+    self.assertEqual(self.manager.count(), 0)
+    self.assertTrue(pc.closed)
+    self.assertTrue(track.stopped)
+    self.assertEqual(PEERS_REMOVED.get(reason="connect_timeout"), before + 1)
+
+  async def test_keeps_connected_peers(self):
+    pc = FakePeerConnection()
+    self.manager.add(pc)
+    await pc.change_state("connected")
+    await asyncio.sleep(0.15)
+    self.assertEqual(self.manager.count("connected"), 1)
+
+  async def test_reaps_peers_that_stay_disconnected(self):
+    before = PEERS_REMOVED.get(reason="disconnect_timeout")
+    pc = FakePeerConnection()
+    self.manager.add(pc)
+    await pc.change_state("connected")
+    await pc.change_state("disconnected")
+    await asyncio.sleep(0.15)
+
+    self.assertEqual(self.manager.count(), 0)
+    self.assertEqual(PEERS_REMOVED.get(reason="disconnect_timeout"), before + 1)
+
+  async def test_memory_unknown_if_any_peer_is(self):
+    self.manager.add(FakePeerConnection([make_sender(100)]))
+    self.assertEqual(self.manager.memory(), 100)
+    self.manager.add(FakePeerConnection([SimpleNamespace()]))
+    self.assertIsNone(self.manager.memory())
+    self.assertIsNone(self.manager.stats()["memory"])
+
+if __name__ == "__main__":
+  unittest.main()
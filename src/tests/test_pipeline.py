@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+from libs.pipeline import ItemContext, Pipeline, Stage, POLICY_BLOCK, POLICY_DROP_NEWEST, POLICY_DROP_OLDEST
+
+# Run from src: python -m unittest discover tests
+
+class PipelineTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.gate = asyncio.Event()
+    self.handled = []
+    self.completed = []
+    self.dropped = []
+
+  async def asyncTearDown(self):
+    await self.pipeline.stop()
+
+  async def handle(self, context):
+    await self.gate.wait()
+    self.handled.append(context.name)
+
+  def start(self, policy=POLICY_BLOCK, queue_size=1, stages=None):
+    stages = stages or [Stage("capture", self.handle, queue_size=queue_size, policy=policy)]
+    self.pipeline = Pipeline(stages, on_complete=lambda context: self.completed.append(context.name), on_drop=lambda context: self.dropped.append(context.name))
+    self.pipeline.start()
+
+  async def fill(self, *names):
+    # The first item is taken by the (blocked) worker, the rest wait in the queue
+    results = []
+    for name in names:
+      results.append(await self.pipeline.put(ItemContext(name=name)))
+      await asyncio.sleep(0)
+    return results
+
+  async def drain(self):
+    self.gate.set()
+    for _ in range(10):
+      await asyncio.sleep(0)
+
+  async def test_drop_newest(self):
+    self.start(POLICY_DROP_NEWEST)
+    self.assertEqual(await self.fill("a", "b", "c"), [True, True, False])
+    await self.drain()
+
+    self.assertEqual(self.handled, ["a", "b"])
+    self.assertEqual(self.dropped, ["c"])
+    self.assertEqual(self.pipeline.stats()["capture"]["dropped"], 1)
+
+  async def test_drop_oldest(self):
+    self.start(POLICY_DROP_OLDEST)
+    self.assertEqual(await self.fill("a", "b", "c", "d"), [True, True, True, True])
+    await self.drain()
+
+    self.assertEqual(self.handled, ["a", "d"])
+    self.assertEqual(self.dropped, ["b", "c"])
+    self.assertEqual(self.pipeline.stats()["capture"]["dropped"], 2)
+
+  async def test_submit_drops_when_full(self):
+    self.start()
+    self.assertTrue(self.pipeline.submit(ItemContext(name="a")))
+    await asyncio.sleep(0)
+    self.assertTrue(self.pipeline.submit(ItemContext(name="b")))
+    self.assertFalse(self.pipeline.submit(ItemContext(name="c")))
+    await self.drain()
+
+    self.assertEqual(self.handled, ["a", "b"])
+    self.assertEqual(self.dropped, ["c"])
+
+  async def test_items_flow_through_stages(self):
+    classified = []
+    async def classify(context):
+      classified.append(context.name)
+
+    self.gate.set()
+    self.start(stages=[Stage("capture", self.handle), Stage("classify", classify)])
+    await self.fill("a", "b")
+    await self.drain()
+
+    self.assertEqual(classified, ["a", "b"])
+    self.assertEqual(self.completed, ["a", "b"])
+
+  async def test_failed_item_completes_with_error(self):
+    async def fail(context):
+      raise RuntimeError("boom")
+
+    errors = []
+    self.pipeline = Pipeline([Stage("capture", fail)], on_complete=lambda context: errors.append(context.error))
+    self.pipeline.start()
+    await self.pipeline.put(ItemContext())
+    await self.drain()
+
+    self.assertEqual(len(errors), 1)
+    self.assertIsInstance(errors[0], RuntimeError)
+    self.assertEqual(self.pipeline.stats()["capture"]["failed"], 1)
+
+  async def test_stop_lets_shielded_stage_finish(self):
+    # Like actuate: stopping mid-way must still close what was opened
+    receptacle = []
+    async def actuate(context):
+      receptacle.append("open")
+      await asyncio.sleep(0.05)
+      receptacle.append("close")
+
+    self.start(stages=[Stage("actuate", actuate, shield=True)])
+    await self.pipeline.put(ItemContext(name="a"))
+    await asyncio.sleep(0.01)
+    self.assertEqual(receptacle, ["open"])
+
+    await self.pipeline.stop()
+    self.assertEqual(receptacle, ["open", "close"])
+    self.assertFalse(self.pipeline.running)
+    self.assertEqual(self.pipeline.shielded, set())
+
+  async def test_stop_cancels_unshielded_stage(self):
+    receptacle = []
+    async def actuate(context):
+      receptacle.append("open")
+      await asyncio.sleep(0.05)
+      receptacle.append("close")
+
+    self.start(stages=[Stage("actuate", actuate)])
+    await self.pipeline.put(ItemContext(name="a"))
+    await asyncio.sleep(0.01)
+    await self.pipeline.stop()
+    await asyncio.sleep(0.06)
+    self.assertEqual(receptacle, ["open"])
+
+if __name__ == "__main__":
+  unittest.main()
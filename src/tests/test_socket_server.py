@@ -0,0 +1,212 @@
+import asyncio
+import json
+import unittest
+from libs.message_codecs import CODECS, JSON, find_codec, negotiate
+from libs.socket_server import ClientWriter, WebSocketServer, WEBSOCKET_EVICTIONS
+
+# Run from src: python -m unittest discover tests
+
+class FakeWebSocket:
+  """Records what is sent; send() waits on `gate`, so a test can stall the client."""
+  def __init__(self, subprotocol=None):
+    self.subprotocol = subprotocol
+    self.remote_address = ("127.0.0.1", 0)
+    self.sent = []
+    self.closed = None
+    self.gate = asyncio.Event()
+    self.gate.set()
+    self.error = None
+
+  async def send(self, payload):
+    await self.gate.wait()
+    if self.error is not None:
+      raise self.error
+    self.sent.append(payload)
+
+  async def close(self, code=1000, reason=""):
+    self.closed = (code, reason)
+
+async def settle():
+  for _ in range(5):
+    await asyncio.sleep(0)
+
+class ClientWriterTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.websocket = FakeWebSocket()
+    self.evicted = []
+
+  def writer(self, **options):
+    self.client = ClientWriter(self.websocket, lambda websocket, reason: self.evicted.append(reason), **options)
+    return self.client
+
+  async def asyncTearDown(self):
+    self.client.stop()
+
+  async def test_sends_in_order(self):
+    writer = self.writer()
+    for payload in ("a", "b", "c"):
+      self.assertTrue(writer.enqueue(payload))
+    await settle()
+    self.assertEqual(self.websocket.sent, ["a", "b", "c"])
+    self.assertEqual(self.evicted, [])
+
+  async def test_full_queue_refuses(self):
+    self.websocket.gate.clear()
+    writer = self.writer(max_queue=2)
+    writer.enqueue("a")
+    await settle()  # "a" is being sent; the queue holds two more
+    self.assertTrue(writer.enqueue("b"))
+    self.assertTrue(writer.enqueue("c"))
+    self.assertFalse(writer.enqueue("d"))
+
+  async def test_lagging_client_is_evicted(self):
+    self.websocket.gate.clear()
+    writer = self.writer(max_lag=0.05)
+    writer.enqueue("a")
+    await settle()
+    writer.enqueue("b")
+    await asyncio.sleep(0.1)
+    self.websocket.gate.set()
+    await settle()
+
+    self.assertEqual(self.websocket.sent, ["a"])
+    self.assertEqual(self.evicted, ["lag"])
+
+  async def test_send_error_evicts_without_reason(self):
+    self.websocket.error = ConnectionResetError()
+    writer = self.writer()
+    writer.enqueue("a")
+    await settle()
+    self.assertEqual(self.evicted, [None])
+
+class WebSocketServerEvictionTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.server = WebSocketServer(send_queue_size=1, max_send_lag=5.0)
+
+  async def asyncTearDown(self):
+    for websocket in list(self.server.clients):
+      self.server._remove_client(websocket)
+
+  async def test_broadcast_reaches_every_client(self):
+    clients = [FakeWebSocket(), FakeWebSocket()]
+    for websocket in clients:
+      await self.server.register_client(websocket)
+    self.server._broadcast({"type": "status"})
+    await settle()
+    for websocket in clients:
+      self.assertEqual(websocket.sent, ['{"type": "status"}'])
+
+  async def test_stalled_client_is_evicted_on_full_queue(self):
+    stalled, healthy = FakeWebSocket(), FakeWebSocket()
+    stalled.gate.clear()
+    await self.server.register_client(stalled)
+    await self.server.register_client(healthy)
+    before = WEBSOCKET_EVICTIONS.get(reason="queue")
+
+    for index in range(3):
+      self.server._broadcast({"type": "status", "index": index})
+      await settle()
+
+    self.assertNotIn(stalled, self.server.clients)
+    self.assertIn(healthy, self.server.clients)
+    self.assertEqual(len(healthy.sent), 3)
+    self.assertEqual(stalled.closed, (1008, "Too slow"))
+    self.assertEqual(WEBSOCKET_EVICTIONS.get(reason="queue"), before + 1)
+
+  async def test_failed_send_closes_as_error(self):
+    broken = FakeWebSocket()
+    broken.error = RuntimeError("boom")
+    await self.server.register_client(broken)
+    self.server._broadcast({"type": "status"})
+    await settle()
+
+    self.assertNotIn(broken, self.server.clients)
+    self.assertEqual(broken.closed, (1011, "Send failed"))
+
+class BroadcastEventsTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.server = WebSocketServer()
+    self.plain, self.batching = FakeWebSocket(), FakeWebSocket()
+    for websocket in (self.plain, self.batching):
+      await self.server.register_client(websocket)
+    await self.server.handle_message(self.batching, json.dumps({"type": "hello", "batch": True}))
+    await settle()
+    self.hello = json.loads(self.batching.sent.pop())
+
+  async def asyncTearDown(self):
+    for websocket in list(self.server.clients):
+      self.server._remove_client(websocket)
+
+  async def test_hello_opts_in(self):
+    self.assertTrue(self.hello["batch"])
+    self.assertTrue(self.server.writers[self.batching].batching)
+    self.assertFalse(self.server.writers[self.plain].batching)
+
+  async def test_single_event_is_sent_as_is(self):
+    self.server.broadcast_events([{"type": "status"}])
+    await settle()
+    for websocket in (self.plain, self.batching):
+      self.assertEqual([json.loads(payload) for payload in websocket.sent], [{"type": "status"}])
+
+  async def test_batch_only_for_clients_that_opted_in(self):
+    events = [{"type": "status", "data": index} for index in range(3)]
+    self.server.broadcast_events(events)
+    await settle()
+
+    self.assertEqual([json.loads(payload) for payload in self.plain.sent], events)
+    self.assertEqual([json.loads(payload) for payload in self.batching.sent], [{"type": "batch", "events": events}])
+
+  async def test_hello_opts_out(self):
+    await self.server.handle_message(self.batching, json.dumps({"type": "hello", "batch": False}))
+    await settle()
+    self.assertFalse(json.loads(self.batching.sent[-1])["batch"])
+    self.assertFalse(self.server.writers[self.batching].batching)
+
+class SubprotocolTest(unittest.IsolatedAsyncioTestCase):
+  async def asyncSetUp(self):
+    self.server = WebSocketServer()
+
+  async def asyncTearDown(self):
+    for websocket in list(self.server.clients):
+      self.server._remove_client(websocket)
+
+  def test_find_codec_by_name_or_subprotocol(self):
+    self.assertIs(find_codec("json"), JSON)
+    self.assertIs(find_codec("bloobin.json"), JSON)
+    self.assertIsNone(find_codec("bloobin.protobuf"))
+    self.assertIsNone(find_codec(None))
+
+  def test_negotiate_falls_back_to_json(self):
+    self.assertIs(negotiate([]), JSON)
+    self.assertIs(negotiate(["chat", "bloobin.protobuf"]), JSON)
+
+  @unittest.skipUnless("msgpack" in CODECS and "cbor" in CODECS, "needs msgpack and cbor2")
+  def test_negotiate_takes_clients_first_choice(self):
+    self.assertEqual(negotiate(["bloobin.cbor", "bloobin.msgpack"]).name, "cbor")
+    self.assertEqual(negotiate(["bloobin.protobuf", "bloobin.msgpack", "bloobin.cbor"]).name, "msgpack")
+
+  @unittest.skipUnless("msgpack" in CODECS, "needs msgpack")
+  def test_selects_offered_subprotocol(self):
+    self.assertEqual(self.server._select_subprotocol(None, ["chat", "bloobin.msgpack"]), "bloobin.msgpack")
+
+  def test_no_subprotocol_without_a_known_one(self):
+    self.assertIsNone(self.server._select_subprotocol(None, []))
+    self.assertIsNone(self.server._select_subprotocol(None, ["chat"]))
+
+  @unittest.skipUnless("msgpack" in CODECS, "needs msgpack")
+  async def test_client_gets_negotiated_codec(self):
+    websocket = FakeWebSocket(subprotocol="bloobin.msgpack")
+    await self.server.register_client(websocket)
+    self.assertEqual(self.server.writers[websocket].codec.name, "msgpack")
+
+    await self.server.send_message(websocket, {"type": "pong"})
+    await settle()
+    self.assertEqual(CODECS["msgpack"].decode(websocket.sent[0]), {"type": "pong"})
+
+  async def test_client_without_subprotocol_gets_json(self):
+    websocket = FakeWebSocket()
+    await self.server.register_client(websocket)
+    self.assertIs(self.server.writers[websocket].codec, JSON)
+
+if __name__ == "__main__":
+  unittest.main()